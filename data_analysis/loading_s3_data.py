@@ -5,6 +5,15 @@ import boto3
 from boto3 import session
 import configparser
 import pandas as pd
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+#Cache of the signed urls (see get_signed_urls), only readable by the user as the urls give access to the videos
+URL_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'asd_ensemble', 'signed_urls.json')
+
+#S3 client shared by the functions of this file (see get_s3_client)
+_s3_client = None
 
 
 def loading_credentials():
@@ -58,31 +67,101 @@ def download_s3_data(bucket_name, file_name, new_file_name):
     s3_client.download_file(bucket_name, file_name, new_file_name)
 
 
-def get_signed_urls(s3_bucket_name, dataset_path, time_limit = 600):
+def get_s3_client():
+    """This function returns the S3 client, created once and reused by every call (boto3 clients are thread-safe).
+    Returns:
+        s3_client (boto3.client): Client connection."""
+    global _s3_client
+    if _s3_client is None:
+        AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY = loading_credentials()
+        _, _s3_client = connect_s3(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+    return _s3_client
+
+def client_access_key(s3_client):
+    """This function returns the access key id the client signs the urls with, or None if it cannot be found."""
+    #botocore does not expose the credentials of a client publicly
+    credentials = getattr(getattr(s3_client, '_request_signer', None), '_credentials', None)
+    return getattr(credentials, 'access_key', None)
+
+def load_url_cache(cache_path):
+    """This function loads the cache of signed urls, mapping 'access_key_id/bucket/key' to the url and its expiry
+    time."""
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+def save_url_cache(cache, cache_path):
+    """This function saves the cache of signed urls, dropping the expired ones. The signed urls are bearer
+    credentials, so the cache folder is created private (0700) and the file is only readable by the user (0600)."""
+    if cache_path is None:
+        return
+    now = time.time()
+    cache_dir = os.path.dirname(os.path.abspath(cache_path))
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump({k: v for k, v in cache.items() if v['expires'] > now}, f)
+    os.replace(tmp_path, cache_path)
+
+def get_signed_urls(s3_bucket_name, dataset_path, time_limit = 600, max_workers=None,
+                    cache_path=None, min_validity=None, s3_client=None):
     """This functions gets the signed urls from the s3 bucket for all videos in a given dataset path.
+    The urls are generated once per unique video key and assigned to the dataframe in one pass. With cache_path, they
+    are cached with their expiry time and the access key id which signed them, so a later call with the same
+    credentials reuses the urls which are still valid for at least min_validity seconds.
     Args:
         s3_bucket_name (str): Name of the s3 bucket.
         dataset_path (str): Path to the dataset.
-        time_limit (int): Time limit for the signed url."""
-    #Load the information from the config file
-    AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY = loading_credentials()
-
-    #Define the client session and the client connection
-    session, s3_client = connect_s3(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        time_limit (int): Time limit for the signed url.
+        max_workers (int): Number of threads used to sign the urls. Default is None (no thread pool).
+        cache_path (str): Path to the cache of signed urls, e.g. URL_CACHE_PATH (a private file in the user's home).
+        The urls give access to the videos until they expire. Default is None (no cache).
+        min_validity (int): Minimum remaining validity in seconds of a cached url. Default is time_limit/2.
+        s3_client (boto3.client): Client used to sign the urls. Default is the shared client (see get_s3_client).
+    Returns:
+        pd.DataFrame: The dataset with a 'signed_url' column."""
+    if s3_client is None:
+        s3_client = get_s3_client()
+    if min_validity is None:
+        min_validity = time_limit / 2
 
     #Read the dataset form the dataset path
     df = pd.read_csv(dataset_path)
 
-    #Get the list of all videos keys in the dataset
-    videos_keys = df["video_key"].tolist()
-
-    #Generate the signed url for each video key
-    for key in videos_keys:
-        url = s3_client.generate_presigned_url('get_object', 
-                                       Params = {'Bucket': s3_bucket_name, 'Key': key}, 
+    #We reuse the cached urls which are still valid long enough and were signed with the same credentials
+    access_key = client_access_key(s3_client)
+    if access_key is None:
+        cache_path = None
+    cache = load_url_cache(cache_path)
+    now = time.time()
+    urls = {}
+    missing_keys = []
+    for key in df["video_key"].unique():
+        cached = cache.get(f'{access_key}/{s3_bucket_name}/{key}')
+        if cached is not None and cached['expires'] - now >= min_validity:
+            urls[key] = cached['url']
+        else:
+            missing_keys.append(key)
+
+    #Generate the signed url for each missing video key
+    def sign(key):
+        return s3_client.generate_presigned_url('get_object',
+                                       Params = {'Bucket': s3_bucket_name, 'Key': key},
                                        ExpiresIn = time_limit) #this url will be available for time_limit seconds
-        df.loc[df['video_key'] == key, 'signed_url'] = url
-
+    if max_workers is None:
+        new_urls = [sign(key) for key in missing_keys]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            new_urls = list(executor.map(sign, missing_keys))
+
+    for key, url in zip(missing_keys, new_urls):
+        urls[key] = url
+        cache[f'{access_key}/{s3_bucket_name}/{key}'] = {'url': url, 'expires': now + time_limit}
+    if missing_keys:
+        save_url_cache(cache, cache_path)
+
+    df['signed_url'] = df['video_key'].map(urls)
     return df
 
 if __name__ == "__main__":
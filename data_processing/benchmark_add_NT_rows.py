@@ -0,0 +1,57 @@
+"""This file benchmarks the construction of the final dataset (add_NT_rows) on synthetic videos,
+to check that its running time grows linearly with the number of videos.
+Usage: python benchmark_add_NT_rows.py [number of videos ...]"""
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+from feature_engineering import add_NT_rows, add_NT_rows_explode
+
+
+def make_synthetic_dataset(number_of_videos, max_windows=5, window_length=150, random_state=0):
+    """This function creates a dataframe shaped like the output of cut_into_windows and select_max_window_size,
+    with random windows of eye directions for number_of_videos videos."""
+    rng = np.random.default_rng(random_state)
+    number_of_windows = rng.integers(1, max_windows + 1, number_of_videos)
+    window = [[0.1, 0.2]] * window_length
+    confidences = [0.9] * window_length
+
+    df = pd.DataFrame({
+        'video_key': [f'video_{i}' for i in range(number_of_videos)],
+        'ASD': rng.integers(0, 2, number_of_videos),
+        'child_id': rng.integers(0, number_of_videos // 3 + 1, number_of_videos),
+        'age': rng.integers(2, 10, number_of_videos),
+        'gender': rng.choice(['Male', 'Female'], number_of_videos),
+    })
+    df['eye_directions_windows'] = [[window] * k for k in number_of_windows]
+    df['confidences_windows'] = [[confidences] * k for k in number_of_windows]
+    df['total_confidence_windows'] = [list(rng.random(k)) for k in number_of_windows]
+    df['number_of_frames_with_face_windows'] = [list(rng.integers(50, window_length, k)) for k in number_of_windows]
+    df['eye_directions_max_window_size'] = [window] * number_of_videos
+    df['confidences_max_window_size'] = [confidences] * number_of_videos
+    df['total_confidence_max_window_size'] = rng.random(number_of_videos)
+    df['number_of_frames_with_face_max_window_size'] = window_length
+    return df
+
+
+def benchmark(sizes):
+    """This function prints the time taken by add_NT_rows and add_NT_rows_explode for each number of videos."""
+    print(f"{'videos':>8} {'rows':>8} {'add_NT_rows (s)':>16} {'explode (s)':>12} {'us/video':>9}")
+    for size in sizes:
+        df = make_synthetic_dataset(size)
+
+        start = time.perf_counter()
+        df_final = add_NT_rows(df)
+        records_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        add_NT_rows_explode(df)
+        explode_time = time.perf_counter() - start
+
+        print(f'{size:>8} {len(df_final):>8} {records_time:>16.3f} {explode_time:>12.3f} {1e6 * records_time / size:>9.1f}')
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000, 100000]
+    benchmark(sizes)
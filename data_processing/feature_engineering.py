@@ -1,15 +1,16 @@
 """This file contains the functions used to engineer the eye gazing features 
 Author : Marie Huynh"""
 
+import itertools
 import pandas as pd
 import numpy as np
 
 def truncate_confidence(sequence):
     """This function truncates a sequence that has None at the beginning or at the end."""
     #We get the index of the first non None value
-    first_non_none_index = sequence.index(next(x for x in sequence if x is not None))
+    first_non_none_index = next(i for i, x in enumerate(sequence) if x is not None)
     #We get the index of the last non None value
-    last_non_none_index = len(sequence) - sequence[::-1].index(next(x for x in sequence[::-1] if x is not None)) - 1
+    last_non_none_index = next(i for i in range(len(sequence) - 1, -1, -1) if sequence[i] is not None)
     #We truncate the sequence
     sequence = sequence[first_non_none_index:last_non_none_index+1]
     return sequence
@@ -17,115 +18,150 @@ def truncate_confidence(sequence):
 def truncate_eye_directions(sequence):
     """This function truncates a sequence of eye directions that has [None, None] at the beginning or at the end."""
     #We get the index of the first non [None, None] value
-    first_non_none_index = sequence.index(next(x for x in sequence if x != [None, None]))
+    first_non_none_index = next(i for i, x in enumerate(sequence) if x != [None, None])
     #We get the index of the last non [None, None] value
-    last_non_none_index = len(sequence) - sequence[::-1].index(next(x for x in sequence[::-1] if x != [None, None])) - 1
+    last_non_none_index = next(i for i in range(len(sequence) - 1, -1, -1) if sequence[i] != [None, None])
     #We truncate the sequence
     sequence = sequence[first_non_none_index:last_non_none_index+1]
     return sequence
 
+def window_boundaries(missing, s, sequence_starts=None):
+    """This function finds the windows of continuous time series with no more than s seconds (s*5 frames) of
+    missing data in between, in one sequence or in several concatenated sequences.
+    A window is closed as soon as it contains more than s*5 consecutive missing frames, so a run of L missing
+    frames closes L // (s*5 + 1) windows. The last frame of each sequence also closes a window.
+    Args:
+        missing (np.ndarray): boolean mask of the missing frames
+        s (float): maximum number of seconds of missing data in a window
+        sequence_starts (np.ndarray): index of the first frame of each concatenated sequence. Default is [0].
+    Returns:
+        starts, ends (np.ndarray): first and last (included) frame of each window, missing frames included
+    """
+    n = len(missing)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if sequence_starts is None:
+        sequence_starts = np.zeros(1, dtype=np.int64)
+    sequence_starts = np.asarray(sequence_starts, dtype=np.int64)
+    max_run = int(np.floor(s*5)) + 1
+
+    #We compute the run-length encoding of the missing frames (runs do not cross sequences)
+    is_sequence_start = np.zeros(n + 1, dtype=bool)
+    is_sequence_start[sequence_starts] = True
+    previous_missing = np.concatenate(([False], missing[:-1])) & ~is_sequence_start[:-1]
+    next_missing = np.concatenate((missing[1:], [False])) & ~is_sequence_start[1:]
+    run_starts = np.flatnonzero(missing & ~previous_missing)
+    run_ends = np.flatnonzero(missing & ~next_missing) + 1
+
+    #A run closes a window every max_run missing frames
+    number_of_closures = (run_ends - run_starts) // max_run
+    closure_rank = np.arange(number_of_closures.sum()) - np.repeat(np.cumsum(number_of_closures) - number_of_closures, number_of_closures)
+    closures = np.repeat(run_starts, number_of_closures) + (closure_rank + 1) * max_run - 1
+
+    #The last frame of each (non empty) sequence closes a window
+    sequence_ends = np.concatenate((sequence_starts[1:], [n])) - 1
+    sequence_ends = sequence_ends[sequence_ends >= sequence_starts]
+
+    ends = np.union1d(closures, sequence_ends)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    return starts, ends
+
+def window_features(eye_directions, confidences, s, sequence_starts=None):
+    """This function computes the windows of one or several concatenated sequences (see window_boundaries)
+    and their features, without iterating over the frames in Python.
+    Args:
+        eye_directions (list): [yaw, pitch] of each frame, [None, None] for the frames with missing data
+        confidences (list): confidence of each frame, None for the frames with missing data
+        s (float): maximum number of seconds of missing data in a window
+        sequence_starts (np.ndarray): index of the first frame of each concatenated sequence. Default is [0].
+    Returns:
+        eye_starts, eye_ends (np.ndarray): slice of eye_directions of each window, without the missing frames at the borders
+        confidence_starts, confidence_ends (np.ndarray): slice of confidences of each window, without the missing frames at the borders
+        total_confidences (np.ndarray): mean confidence of each window
+        number_of_frames_with_face (np.ndarray): number of frames with a confidence in each window
+        window_starts (np.ndarray): first frame of each window, missing frames included
+    Only the windows with at least one frame with face are returned.
+    """
+    n = len(eye_directions)
+    if n == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty, np.zeros(0), empty, empty
+
+    #None is converted to nan, so the missing frames are the rows full of nan
+    eye_missing = np.isnan(np.array(eye_directions, dtype=float).reshape(n, -1)).all(axis=1)
+    confidences = np.array(confidences, dtype=float)
+    confidence_present = ~np.isnan(confidences)
+
+    starts, ends = window_boundaries(eye_missing, s, sequence_starts)
+
+    #The windows are contiguous, so we can reduce each of them with reduceat
+    number_of_frames_with_face = np.add.reduceat(confidence_present.astype(np.int64), starts)
+    number_of_eye_directions = np.add.reduceat((~eye_missing).astype(np.int64), starts)
+    sum_confidences = np.add.reduceat(np.where(confidence_present, confidences, 0.0), starts)
+
+    #We only keep the windows with at least one frame with face
+    keep = (number_of_frames_with_face > 0) & (number_of_eye_directions > 0)
+    starts, ends = starts[keep], ends[keep]
+    number_of_frames_with_face = number_of_frames_with_face[keep]
+    total_confidences = sum_confidences[keep] / number_of_frames_with_face
+
+    #We truncate the missing frames at the beginning and at the end of each window
+    eye_present = np.flatnonzero(~eye_missing)
+    eye_starts = eye_present[np.searchsorted(eye_present, starts)]
+    eye_ends = eye_present[np.searchsorted(eye_present, ends, side='right') - 1] + 1
+    confidence_indices = np.flatnonzero(confidence_present)
+    confidence_starts = confidence_indices[np.searchsorted(confidence_indices, starts)]
+    confidence_ends = confidence_indices[np.searchsorted(confidence_indices, ends, side='right') - 1] + 1
+
+    return eye_starts, eye_ends, confidence_starts, confidence_ends, total_confidences, number_of_frames_with_face, starts
+
 def cut_into_windows(row, s):
     """This function cuts the eye_directions and confidences lists into windows of continuous time series with no more than s seconds of
-    missing data in between. It returns a list of windows in the column Windows. Each window is a dictionary with the following keys:"""
-    
+    missing data in between. It sets the following columns, with one element per window:
+    eye_directions_windows, confidences_windows, total_confidence_windows (mean confidence) and number_of_frames_with_face_windows."""
     eye_directions = row['eye_directions']
     confidences = row['confidences']
 
-    eye_directions_windows = []
-    confidences_windows = []
-    total_confidence_windows = []
-    number_of_frames_with_face_windows = []
-   
-    #We initialize the number of frames with face in the window to 0
-    number_of_frames_with_face = 0
-    #We initialize the total confidence in the window to 0
-    total_confidence = 0
-    #We initialize the number of None values in the window to 0
-    number_of_consecutive_none = 0
-    #We initialize the list of eye directions in the window to []
-    eye_directions_window = []
-    #We initialize the list of confidences in the window to []
-    confidences_window = []
-    
-    i = 0
-    #We iterate through the eye_directions and confidences lists
-    while i < len(eye_directions):
-        eye_directions_window.append(eye_directions[i])
-        confidences_window.append(confidences[i])
-        # print(confidences_window)
-        #If the eye_directions[i] is not [None, None]
-        if eye_directions[i] != [None, None]:
-            #We set the number_of_consecutive_none to 0
-            number_of_consecutive_none = 0
-    
-        #If the eye_directions[i] is None
-        else:
-            #We increment the number of None values in the window
-            number_of_consecutive_none += 1
-    
-
-        #If the number of None values in the window is greater than s*10
-        if number_of_consecutive_none > s*5:
-
-            confidences_window_without_none = [x for x in confidences_window if x is not None]
-
-            #We only append the window if there is at least one non None value in the window
-            if len(confidences_window_without_none) != 0:
-                #We compute the total confidence in the window
-                total_confidence = sum([x for x in confidences_window if x is not None])
-                total_confidence = total_confidence/len([x for x in confidences_window if x is not None])
-                
-                #We compute the number of frames with face in the window
-                number_of_frames_with_face = len([x for x in confidences_window if x is not None])
-
-                #We delete truncate the window from the beginning None values and the end None values
-                eye_directions_window = truncate_eye_directions(eye_directions_window)
-                confidences_window = truncate_confidence(confidences_window)
-                
-                eye_directions_windows.append(eye_directions_window)
-                confidences_windows.append(confidences_window)
-                total_confidence_windows.append(total_confidence)
-                number_of_frames_with_face_windows.append(number_of_frames_with_face)
-
-            #We reset everything
-            number_of_consecutive_none = 0
-            eye_directions_window = []
-            confidences_window = []
-            total_confidence = 0
-            number_of_frames_with_face = 0
-        
-        #If we are at the end of the list, we append the last window
-        if i == len(eye_directions) - 1:
-            confidences_window_without_none = [x for x in confidences_window if x is not None]
-
-            #We only append the window if there is at least one non None value in the window
-            if len(confidences_window_without_none) != 0:
-                #We compute the total confidence in the window
-                total_confidence = sum([x for x in confidences_window if x is not None])
-                total_confidence = total_confidence/len([x for x in confidences_window if x is not None])
-                
-                #We compute the number of frames with face in the window
-                number_of_frames_with_face = len([x for x in confidences_window if x is not None])
-                
-                #We delete truncate the window from the beginning None values and the end None values
-                eye_directions_window = truncate_eye_directions(eye_directions_window)
-                confidences_window = truncate_confidence(confidences_window)
-
-                eye_directions_windows.append(eye_directions_window)
-                confidences_windows.append(confidences_window)
-                total_confidence_windows.append(total_confidence)
-                number_of_frames_with_face_windows.append(number_of_frames_with_face)
-
-        i += 1
+    eye_starts, eye_ends, confidence_starts, confidence_ends, total_confidences, number_of_frames_with_face, _ = \
+        window_features(eye_directions, confidences, s)
 
     #We set the new columns
-    row['eye_directions_windows'] = eye_directions_windows
-    row['confidences_windows'] = confidences_windows
-    row['total_confidence_windows'] = total_confidence_windows
-    row['number_of_frames_with_face_windows'] = number_of_frames_with_face_windows
+    row['eye_directions_windows'] = [eye_directions[a:b] for a, b in zip(eye_starts, eye_ends)]
+    row['confidences_windows'] = [confidences[a:b] for a, b in zip(confidence_starts, confidence_ends)]
+    row['total_confidence_windows'] = total_confidences.tolist()
+    row['number_of_frames_with_face_windows'] = number_of_frames_with_face.tolist()
 
     return row
 
+def cut_all_into_windows(df, s):
+    """This function is equivalent to df.apply(lambda row: cut_into_windows(row, s), axis=1), but the windows of
+    all the videos are computed at once on the concatenated eye_directions and confidences.
+    It returns a copy of df with the new columns."""
+    df = df.copy()
+    lengths = df['eye_directions'].map(len).to_numpy()
+    sequence_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    eye_directions = list(itertools.chain.from_iterable(df['eye_directions']))
+    confidences = list(itertools.chain.from_iterable(df['confidences']))
+
+    eye_starts, eye_ends, confidence_starts, confidence_ends, total_confidences, number_of_frames_with_face, window_starts = \
+        window_features(eye_directions, confidences, s, sequence_starts)
+
+    #We find the video of each window and group the windows by video
+    video_index = np.searchsorted(sequence_starts, window_starts, side='right') - 1
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(video_index, minlength=len(df)))))
+    eye_directions_windows = [eye_directions[a:b] for a, b in zip(eye_starts, eye_ends)]
+    confidences_windows = [confidences[a:b] for a, b in zip(confidence_starts, confidence_ends)]
+    total_confidences = total_confidences.tolist()
+    number_of_frames_with_face = number_of_frames_with_face.tolist()
+
+    #We set the new columns
+    df['eye_directions_windows'] = [eye_directions_windows[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    df['confidences_windows'] = [confidences_windows[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    df['total_confidence_windows'] = [total_confidences[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    df['number_of_frames_with_face_windows'] = [number_of_frames_with_face[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    return df
+
 def select_max_window_size(row):
     """This function selects the max window size for a given video. 
     It returns the updated row."""
@@ -157,59 +193,52 @@ def select_max_window_size(row):
     return row
 
 
+FINAL_COLUMNS = ['video_key', 'ASD', 'child_id', 'age', 'gender', 'eye_directions', 'confidences', 'total_confidence', 'number_of_frames_with_face']
+ID_COLUMNS = ['video_key', 'ASD', 'child_id', 'age', 'gender']
+WINDOWS_COLUMNS = ['eye_directions_windows', 'confidences_windows', 'total_confidence_windows', 'number_of_frames_with_face_windows']
+MAX_WINDOW_COLUMNS = ['eye_directions_max_window_size', 'confidences_max_window_size', 'total_confidence_max_window_size', 'number_of_frames_with_face_max_window_size']
+
+
 def add_NT_rows(df):
-    """This function creates a final dataset with more rows for NT children."""
-    df_final = pd.DataFrame(columns=df.columns)
-    #We only keep the columns that we need
-    df_final = df_final[['video_key', 'ASD', 'child_id', 'age', 'gender', 'eye_directions', 'confidences', 'total_confidence', 'number_of_frames_with_face']]
+    """This function creates a final dataset with more rows for NT children.
+    For NT videos, every window of more than 20 seconds of eye direction data becomes a row.
+    For ASD videos, the window with the max window size becomes a row.
+    The rows are collected in lists and the dataframe is built once at the end."""
+    records = []
+    columns = {column: df[column].tolist() for column in ID_COLUMNS + WINDOWS_COLUMNS + MAX_WINDOW_COLUMNS}
 
     for i in range(len(df)):
-        label = df.iloc[i]['ASD']
+        ids = [columns[column][i] for column in ID_COLUMNS]
         #If the label is 0 (NT)
-        if (label == 0) :
+        if columns['ASD'][i] == 0:
             #For each window of more than 20 seconds of eye direction data, we create a new row
-            eye_directions_windows = df['eye_directions_windows'][i] 
-            confidences_windows = df['confidences_windows'][i]
-            total_confidence_windows = df['total_confidence_windows'][i]
-            number_of_frames_with_face_windows = df['number_of_frames_with_face_windows'][i]
-
-            for eye_dir, conf, total_conf, nb_frames_face in zip(eye_directions_windows, confidences_windows, total_confidence_windows, number_of_frames_with_face_windows):
-                #If the window is more than 20 seconds of eye direction data
-                if nb_frames_face > 20*5:
-                    #We create a new row
-                    # Create a new row as a dictionary
-                    new_row = {
-                        'video_key': [df.at[i, 'video_key']],
-                        'ASD': [df.at[i, 'ASD']],
-                        'child_id': [df.at[i, 'child_id']],
-                        'age': [df.at[i, 'age']],
-                        'gender': [df.at[i, 'gender']],
-                        'eye_directions': [eye_dir],
-                        'confidences': [conf],
-                        'total_confidence': [total_conf],
-                        'number_of_frames_with_face': [nb_frames_face]
-                    }
-                    new_df = pd.DataFrame(new_row, index=[0])
-                    
-                    #We append the new row to the dataframe
-                    df_final = pd.concat([df_final, new_df], ignore_index=True)
-
+            for window in zip(*(columns[column][i] for column in WINDOWS_COLUMNS)):
+                #window = (eye_dir, conf, total_conf, nb_frames_face)
+                if window[3] > 20*5:
+                    records.append(ids + list(window))
         #If the label is 1 (ASD)
         else:
-            #We append the row with the max window size to the dataframe
-            new_row = pd.DataFrame({
-                'video_key': [df.at[i, 'video_key']],
-                'ASD': [df.at[i, 'ASD']],
-                'child_id': [df.at[i, 'child_id']],
-                'age': [df.at[i, 'age']],
-                'gender': [df.at[i, 'gender']],
-                'eye_directions': [df.at[i, 'eye_directions_max_window_size']],
-                'confidences': [df.at[i, 'confidences_max_window_size']],
-                'total_confidence': [df.at[i, 'total_confidence_max_window_size']],
-                'number_of_frames_with_face': [df.at[i, 'number_of_frames_with_face_max_window_size']]
-            })
-            new_df = pd.DataFrame(new_row, index=[0])
-            #We concatenate the new row to the dataframe
-            df_final = pd.concat([df_final, new_df], ignore_index=True)
-    return df_final
+            #We append the row with the max window size
+            records.append(ids + [columns[column][i] for column in MAX_WINDOW_COLUMNS])
+
+    return pd.DataFrame.from_records(records, columns=FINAL_COLUMNS)
+
+
+def add_NT_rows_explode(df):
+    """This function creates the same dataset as add_NT_rows with pandas operations only:
+    the windows of the NT videos are expanded into rows with explode."""
+    df = df.reset_index(drop=True)
+    is_NT = df['ASD'] == 0
+
+    #Each window of a NT video becomes a row, and we keep the windows of more than 20 seconds of eye direction data
+    df_NT = df.loc[is_NT, ID_COLUMNS + WINDOWS_COLUMNS].explode(WINDOWS_COLUMNS)
+    df_NT.columns = FINAL_COLUMNS
+    df_NT = df_NT[df_NT['number_of_frames_with_face'] > 20*5]
+
+    #Each ASD video becomes the row of its max window size
+    df_ASD = df.loc[~is_NT, ID_COLUMNS + MAX_WINDOW_COLUMNS]
+    df_ASD.columns = FINAL_COLUMNS
 
+    #We keep the order of the videos
+    df_final = pd.concat([df_NT, df_ASD]).sort_index(kind='stable')
+    return df_final.reset_index(drop=True).infer_objects()
@@ -0,0 +1,148 @@
+"""This file contains the pipelined uploader used to send the frames of a video to S3.
+The frames are encoded to JPEG in memory by the decoding thread and pushed into a bounded queue, which is drained
+by a pool of upload threads. Decoding and network I/O overlap, and the decoding thread blocks when the queue is
+full (backpressure), so the memory used does not depend on the length of the video.
+Any object with an upload_fileobj(Fileobj, Key) method can be used as the bucket: a boto3 Bucket resource, or
+LocalBucket to test the pipeline without S3."""
+
+import io
+import os
+import time
+import queue
+import random
+import threading
+import cv2
+
+
+class LocalBucket:
+    """Local stand-in for a boto3 Bucket resource, the objects are written in a folder.
+    Args:
+        root (str): Folder where the objects are written.
+        failure_rate (float): Probability that an upload attempt raises an error, to test the retries (0 <= failure_rate
+        < 1).
+        seed (int): Seed of the random failures. Default is 0.
+    """
+
+    def __init__(self, root, failure_rate=0.0, seed=0):
+        if not 0 <= failure_rate < 1:
+            raise ValueError(f'failure_rate must be in [0, 1), got {failure_rate}')
+        self.root = root
+        self.failure_rate = failure_rate
+        self.attempts = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def upload_fileobj(self, Fileobj, Key):
+        with self._lock:
+            self.attempts += 1
+            failed = self._random.random() < self.failure_rate
+            self.failures += failed
+        if failed:
+            raise IOError(f'Simulated upload failure for {Key}')
+        path = os.path.join(self.root, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Fileobj.read())
+
+
+def encode_jpeg(frame, quality=95):
+    """This function encodes a frame to JPEG in memory (95 is the default quality of cv2.imwrite)."""
+    success, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not success:
+        raise ValueError('Error encoding the frame.')
+    return buffer.tobytes()
+
+
+def upload_with_retries(upload_bucket, body, key, retries=3, backoff=0.5):
+    """This function uploads a JPEG to the bucket, retrying with an exponential backoff.
+    Returns:
+        int: Number of failed attempts before the upload succeeded.
+    Raises:
+        The error of the last attempt if every attempt failed."""
+    for attempt in range(retries + 1):
+        try:
+            upload_bucket.upload_fileobj(Fileobj=io.BytesIO(body), Key=key)
+            return attempt
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def upload_frames(frames, upload_bucket, key_prefix, max_workers=8, queue_size=32, retries=3, backoff=0.5,
+                  jpeg_quality=95):
+    """This function encodes the frames of a video and uploads them to the bucket with a pool of threads.
+    Args:
+        frames (iterable): (frame_number, frame) pairs, for example stream_frames(signed_url, fps).
+        upload_bucket: Bucket with an upload_fileobj method (boto3 Bucket resource or LocalBucket).
+        key_prefix (str): The frames are uploaded to f'{key_prefix}/frame{frame_number:04d}.jpg'.
+        max_workers (int): Number of upload threads.
+        queue_size (int): Maximum number of encoded frames waiting to be uploaded.
+        retries (int): Number of retries of a failed upload.
+        backoff (float): Waiting time before the first retry in seconds, doubled at every retry.
+        jpeg_quality (int): Quality of the JPEG encoding.
+    Returns:
+        dict: Statistics of the upload (number of frames, failed uploads, retries, bytes, time and throughput)."""
+    frame_queue = queue.Queue(maxsize=queue_size)
+    stats = {'frames': 0, 'uploaded': 0, 'failed': 0, 'retries': 0, 'bytes': 0, 'failed_keys': []}
+    stats_lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                return
+            key, body = item
+            try:
+                retried = upload_with_retries(upload_bucket, body, key, retries, backoff)
+                with stats_lock:
+                    stats['uploaded'] += 1
+                    stats['retries'] += retried
+                    stats['bytes'] += len(body)
+            except Exception as e:
+                print(f'Upload of {key} failed: {e}')
+                with stats_lock:
+                    stats['failed'] += 1
+                    stats['retries'] += retries
+                    stats['failed_keys'].append(key)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max_workers)]
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    decode_time = 0.0
+    try:
+        frames = iter(frames)
+        while True:
+            decode_start = time.perf_counter()
+            try:
+                frame_number, frame = next(frames)
+            except StopIteration:
+                break
+            body = encode_jpeg(frame, jpeg_quality)
+            decode_time += time.perf_counter() - decode_start
+            #put blocks while the queue is full, so the decoding waits for the uploads
+            frame_queue.put((f'{key_prefix}/frame{frame_number:04d}.jpg', body))
+            stats['frames'] += 1
+    finally:
+        #We stop the workers once the queue is drained, even if the decoding failed
+        for _ in threads:
+            frame_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    total_time = time.perf_counter() - start
+    stats['decode_seconds'] = decode_time
+    stats['total_seconds'] = total_time
+    stats['frames_per_second'] = stats['uploaded'] / total_time if total_time > 0 else 0.0
+    stats['megabytes_per_second'] = stats['bytes'] / 1e6 / total_time if total_time > 0 else 0.0
+    return stats
+
+
+def print_upload_stats(video_key, stats):
+    """Prints the statistics returned by upload_frames."""
+    print(f"{video_key}: {stats['uploaded']}/{stats['frames']} frames uploaded in {stats['total_seconds']:.1f}s "
+          f"({stats['frames_per_second']:.1f} frames/s, {stats['megabytes_per_second']:.2f} MB/s, "
+          f"decoding {stats['decode_seconds']:.1f}s), {stats['retries']} retries, {stats['failed']} failed")
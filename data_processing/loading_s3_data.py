@@ -6,6 +6,16 @@ from boto3 import session
 import configparser
 import pandas as pd
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+
+#Cache of the signed urls (see get_signed_urls), only readable by the user as the urls give access to the videos
+URL_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'asd_ensemble', 'signed_urls.json')
+
+#S3 client shared by the functions of this file (see get_s3_client)
+_s3_client = None
+
 
 def loading_credentials():
     """This function loads the credentials from the config file.
@@ -58,31 +68,101 @@ def download_s3_data(bucket_name, file_name, new_file_name):
     s3_client.download_file(bucket_name, file_name, new_file_name)
 
 
-def get_signed_urls(s3_bucket_name, dataset_path, time_limit = 600):
+def get_s3_client():
+    """This function returns the S3 client, created once and reused by every call (boto3 clients are thread-safe).
+    Returns:
+        s3_client (boto3.client): Client connection."""
+    global _s3_client
+    if _s3_client is None:
+        AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY = loading_credentials()
+        _, _s3_client = connect_s3(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+    return _s3_client
+
+def client_access_key(s3_client):
+    """This function returns the access key id the client signs the urls with, or None if it cannot be found."""
+    #botocore does not expose the credentials of a client publicly
+    credentials = getattr(getattr(s3_client, '_request_signer', None), '_credentials', None)
+    return getattr(credentials, 'access_key', None)
+
+def load_url_cache(cache_path):
+    """This function loads the cache of signed urls, mapping 'access_key_id/bucket/key' to the url and its expiry
+    time."""
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path) as f:
+        return json.load(f)
+
+def save_url_cache(cache, cache_path):
+    """This function saves the cache of signed urls, dropping the expired ones. The signed urls are bearer
+    credentials, so the cache folder is created private (0700) and the file is only readable by the user (0600)."""
+    if cache_path is None:
+        return
+    now = time.time()
+    cache_dir = os.path.dirname(os.path.abspath(cache_path))
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump({k: v for k, v in cache.items() if v['expires'] > now}, f)
+    os.replace(tmp_path, cache_path)
+
+def get_signed_urls(s3_bucket_name, dataset_path, time_limit = 600, max_workers=None,
+                    cache_path=None, min_validity=None, s3_client=None):
     """This functions gets the signed urls from the s3 bucket for all videos in a given dataset path.
+    The urls are generated once per unique video key and assigned to the dataframe in one pass. With cache_path, they
+    are cached with their expiry time and the access key id which signed them, so a later call with the same
+    credentials reuses the urls which are still valid for at least min_validity seconds.
     Args:
         s3_bucket_name (str): Name of the s3 bucket.
         dataset_path (str): Path to the dataset.
-        time_limit (int): Time limit for the signed url."""
-    #Load the information from the config file
-    AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY = loading_credentials()
-
-    #Define the client session and the client connection
-    session, s3_client = connect_s3(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        time_limit (int): Time limit for the signed url.
+        max_workers (int): Number of threads used to sign the urls. Default is None (no thread pool).
+        cache_path (str): Path to the cache of signed urls, e.g. URL_CACHE_PATH (a private file in the user's home).
+        The urls give access to the videos until they expire. Default is None (no cache).
+        min_validity (int): Minimum remaining validity in seconds of a cached url. Default is time_limit/2.
+        s3_client (boto3.client): Client used to sign the urls. Default is the shared client (see get_s3_client).
+    Returns:
+        pd.DataFrame: The dataset with a 'signed_url' column."""
+    if s3_client is None:
+        s3_client = get_s3_client()
+    if min_validity is None:
+        min_validity = time_limit / 2
 
     #Read the dataset form the dataset path
     df = pd.read_csv(dataset_path)
 
-    #Get the list of all videos keys in the dataset
-    videos_keys = df["video_key"].tolist()
+    #We reuse the cached urls which are still valid long enough and were signed with the same credentials
+    access_key = client_access_key(s3_client)
+    if access_key is None:
+        cache_path = None
+    cache = load_url_cache(cache_path)
+    now = time.time()
+    urls = {}
+    missing_keys = []
+    for key in df["video_key"].unique():
+        cached = cache.get(f'{access_key}/{s3_bucket_name}/{key}')
+        if cached is not None and cached['expires'] - now >= min_validity:
+            urls[key] = cached['url']
+        else:
+            missing_keys.append(key)
 
-    #Generate the signed url for each video key
-    for key in videos_keys:
-        url = s3_client.generate_presigned_url('get_object', 
-                                       Params = {'Bucket': s3_bucket_name, 'Key': key}, 
+    #Generate the signed url for each missing video key
+    def sign(key):
+        return s3_client.generate_presigned_url('get_object',
+                                       Params = {'Bucket': s3_bucket_name, 'Key': key},
                                        ExpiresIn = time_limit) #this url will be available for time_limit seconds
-        df.loc[df['video_key'] == key, 'signed_url'] = url
+    if max_workers is None:
+        new_urls = [sign(key) for key in missing_keys]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            new_urls = list(executor.map(sign, missing_keys))
+
+    for key, url in zip(missing_keys, new_urls):
+        urls[key] = url
+        cache[f'{access_key}/{s3_bucket_name}/{key}'] = {'url': url, 'expires': now + time_limit}
+    if missing_keys:
+        save_url_cache(cache, cache_path)
 
+    df['signed_url'] = df['video_key'].map(urls)
     return df
 
 def load_json_from_s3(s3, bucket, json_filename):
@@ -106,29 +186,98 @@ if __name__ == "__main__":
 
     print(df_signed_urls.head())
     
-def download_folder_from_s3(bucket_name, folder_prefix, local_directory):
+def list_s3_objects(s3_client, bucket_name, prefix):
+    """This function lists all the objects of the bucket under a prefix, following the pagination
+    (list_objects returns at most 1000 keys per call).
+    Returns:
+        list: Objects with their 'Key', 'Size' and 'ETag'."""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    return objects
+
+def file_md5(path, chunk_size=1 << 20):
+    """This function computes the md5 hash of a local file (the ETag of an object uploaded in one part)."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def is_downloaded(obj, local_file_path, check_etag=True):
+    """This function checks if an object was already downloaded: same size and, for objects uploaded in one part,
+    same md5 as the ETag (the ETag of a multipart upload is not the md5 of the file, so only the size is checked)."""
+    if not os.path.exists(local_file_path) or os.path.getsize(local_file_path) != obj['Size']:
+        return False
+    etag = obj.get('ETag', '').strip('"')
+    if check_etag and etag and '-' not in etag:
+        return file_md5(local_file_path) == etag
+    return True
+
+def download_folder_from_s3(bucket_name, folder_prefix, local_directory, max_workers=16, check_etag=True,
+                            s3_client=None):
     """This function downloads a folder from the S3 bucket.
+    The objects are listed with a paginator and downloaded by a pool of threads. The files already downloaded
+    (same size and ETag) are skipped, so an interrupted download can be resumed. python local_s3.py checks the
+    pagination, the resume and the skipping against a local stand-in for the S3 client.
     Args:
         bucket_name (str): Name of the bucket where the data is stored.
         folder_prefix (str): Prefix of the folder to download.
-        local_directory (str): Local directory where to download the folder."""
-    # Load the information from the config file
-    AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY = loading_credentials()
-    s3_client = boto3.client('s3',
-                            aws_access_key_id=AWS_ACCESS_KEY_ID,
-                            aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+        local_directory (str): Local directory where to download the folder.
+        max_workers (int): Number of download threads.
+        check_etag (bool): Compare the md5 of the existing files with the ETag of the objects.
+        s3_client (boto3.client): Client used to download. Default is the shared client (see get_s3_client),
+        any S3-compatible endpoint can be used by passing its client.
+    Returns:
+        dict: Statistics of the download (files downloaded, skipped and failed, bytes, time and throughput)."""
+    if s3_client is None:
+        s3_client = get_s3_client()
 
-    # List objects in the specified S3 bucket with the given prefix (folder)
-    objects = s3_client.list_objects(Bucket=bucket_name, Prefix=folder_prefix)
+    # List all the objects in the specified S3 bucket with the given prefix (folder)
+    objects = [obj for obj in list_s3_objects(s3_client, bucket_name, folder_prefix) if not obj['Key'].endswith('/')]
 
     # Create the local directory if it doesn't exist
     os.makedirs(local_directory, exist_ok=True)
 
-    # Iterate over the objects and download them to the local directory
-    for obj in objects.get('Contents', []):
-        s3_key = obj['Key']
-        print(s3_key)
-        local_file_path = os.path.join(local_directory, os.path.basename(s3_key))
-        s3_client.download_file(bucket_name, s3_key, local_file_path)
-        print(f'Downloaded: {s3_key} to {local_file_path}')
-    
\ No newline at end of file
+    #We skip the files which are already downloaded
+    to_download = []
+    stats = {'files': len(objects), 'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    for obj in objects:
+        local_file_path = os.path.join(local_directory, os.path.basename(obj['Key']))
+        if is_downloaded(obj, local_file_path, check_etag):
+            stats['skipped'] += 1
+        else:
+            to_download.append((obj, local_file_path))
+    print(f"{stats['files']} files in s3://{bucket_name}/{folder_prefix}, {stats['skipped']} already downloaded")
+
+    def download(item):
+        obj, local_file_path = item
+        #We download to a temporary file so an interrupted download is not mistaken for a complete file
+        s3_client.download_file(bucket_name, obj['Key'], local_file_path + '.part')
+        os.replace(local_file_path + '.part', local_file_path)
+        return obj
+
+    start = time.perf_counter()
+    total_bytes = sum(obj['Size'] for obj, _ in to_download)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download, item): item for item in to_download}
+        for i, future in enumerate(as_completed(futures), 1):
+            obj, _ = futures[future]
+            try:
+                future.result()
+                stats['downloaded'] += 1
+                stats['bytes'] += obj['Size']
+            except Exception as e:
+                stats['failed'] += 1
+                print(f"Failed: {obj['Key']} ({e})")
+            if i % 100 == 0 or i == len(to_download):
+                elapsed = time.perf_counter() - start
+                print(f"{i}/{len(to_download)} files, {stats['bytes'] / 1e6:.1f}/{total_bytes / 1e6:.1f} MB, "
+                      f"{stats['bytes'] / 1e6 / elapsed:.2f} MB/s, {stats['downloaded'] / elapsed:.1f} files/s")
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['megabytes_per_second'] = stats['bytes'] / 1e6 / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    print(f"Downloaded {stats['downloaded']} files, skipped {stats['skipped']}, failed {stats['failed']} "
+          f"({stats['megabytes_per_second']:.2f} MB/s)")
+    return stats
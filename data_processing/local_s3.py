@@ -0,0 +1,158 @@
+"""This file contains a local stand-in for the S3 client and checks download_folder_from_s3 against it: the
+pagination of the listing, the resume of an interrupted download (.part files) and the skipping of the files already
+downloaded (size and ETag).
+Usage: python local_s3.py [work directory]"""
+
+import os
+import sys
+import math
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from loading_s3_data import download_folder_from_s3
+
+
+class LocalS3Client:
+    """Local stand-in for the boto3 S3 client used by download_folder_from_s3, the objects of a bucket are the files
+    of the folder root/bucket_name. The folders are listed as 'folder/' keys, like the folders created in the console.
+    Args:
+        root (str): Folder containing one folder per bucket.
+        page_size (int): Maximum number of keys per list_objects_v2 page (1000 on S3).
+        multipart_etags (bool): Give the ETags the form of a multipart upload ('<md5>-1'), which is not the md5 of the
+        file, so that only the size of the downloaded files can be compared.
+        fail_keys (set): Keys whose download is interrupted after writing half of the file, to test the resume.
+    """
+
+    def __init__(self, root, page_size=1000, multipart_etags=False, fail_keys=()):
+        self.root = root
+        self.page_size = page_size
+        self.multipart_etags = multipart_etags
+        self.fail_keys = set(fail_keys)
+        self.pages = 0
+        self.downloads = 0
+        self._lock = threading.Lock()
+
+    def list_objects(self, Bucket, Prefix=''):
+        """Returns every object of the bucket under the prefix, sorted by key like S3."""
+        bucket_root = os.path.join(self.root, Bucket)
+        objects = []
+        for directory, folders, files in os.walk(bucket_root):
+            relative = os.path.relpath(directory, bucket_root)
+            prefix = '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+            if prefix:
+                objects.append({'Key': prefix, 'Size': 0, 'ETag': '"d41d8cd98f00b204e9800998ecf8427e"'})
+            for name in files:
+                with open(os.path.join(directory, name), 'rb') as f:
+                    content = f.read()
+                etag = hashlib.md5(content).hexdigest() + ('-1' if self.multipart_etags else '')
+                objects.append({'Key': prefix + name, 'Size': len(content), 'ETag': f'"{etag}"'})
+        return sorted([obj for obj in objects if obj['Key'].startswith(Prefix)], key=lambda obj: obj['Key'])
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise ValueError(f'Unsupported operation {operation_name}')
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix=''):
+                objects = client.list_objects(Bucket, Prefix)
+                for start in range(0, max(len(objects), 1), client.page_size):
+                    client.pages += 1
+                    page = objects[start:start + client.page_size]
+                    yield {'Contents': page, 'KeyCount': len(page)} if page else {'KeyCount': 0}
+        return Paginator()
+
+    def download_file(self, Bucket, Key, Filename):
+        with self._lock:
+            self.downloads += 1
+        with open(os.path.join(self.root, Bucket, *Key.split('/')), 'rb') as f:
+            content = f.read()
+        with open(Filename, 'wb') as f:
+            if Key in self.fail_keys:
+                f.write(content[:len(content) // 2])
+                raise IOError(f'Simulated interrupted download of {Key}')
+            f.write(content)
+
+
+def make_bucket(root, bucket_name, prefix, number_of_objects, seed=0):
+    """This function writes number_of_objects random files under prefix in the local bucket.
+    Returns:
+        list: Keys of the objects."""
+    rng = np.random.default_rng(seed)
+    folder = os.path.join(root, bucket_name, *prefix.strip('/').split('/'))
+    os.makedirs(folder, exist_ok=True)
+    keys = []
+    for i in range(number_of_objects):
+        with open(os.path.join(folder, f'frame{i:04d}.jpg'), 'wb') as f:
+            f.write(rng.bytes(int(rng.integers(1, 5000))))
+        keys.append(f"{prefix.strip('/')}/frame{i:04d}.jpg")
+    return keys
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+    print(f'OK: {message}')
+
+
+def check_download_folder(work_dir, number_of_objects=25, page_size=7):
+    """This function runs download_folder_from_s3 against LocalS3Client and checks the pagination, the resume of an
+    interrupted download and the skipping of the files already downloaded."""
+    bucket_root = os.path.join(work_dir, 'buckets')
+    local_directory = os.path.join(work_dir, 'downloaded')
+    bucket_name, prefix = 'bucket', 'videos/frames'
+    keys = make_bucket(bucket_root, bucket_name, prefix, number_of_objects)
+    local_path = lambda key: os.path.join(local_directory, os.path.basename(key))
+
+    #First download, interrupted on one file: the listing follows every page (the folder marker is a key too)
+    client = LocalS3Client(bucket_root, page_size, fail_keys={keys[3]})
+    stats = download_folder_from_s3(bucket_name, prefix, local_directory, max_workers=4, s3_client=client)
+    check(client.pages == math.ceil((number_of_objects + 1) / page_size),
+          f'listed {number_of_objects} objects and the folder marker in {client.pages} pages of {page_size} keys')
+    check(stats['downloaded'] == number_of_objects - 1 and stats['failed'] == 1, 'one interrupted download')
+    check(not os.path.exists(local_path(keys[3])) and os.path.exists(local_path(keys[3]) + '.part'),
+          'the interrupted download is left as a .part file, not as the final file')
+
+    #Resume: only the interrupted file is downloaded again
+    client = LocalS3Client(bucket_root, page_size)
+    stats = download_folder_from_s3(bucket_name, prefix, local_directory, max_workers=4, s3_client=client)
+    check(stats['downloaded'] == 1 and stats['skipped'] == number_of_objects - 1 and client.downloads == 1,
+          'the resume only downloads the interrupted file')
+    with open(local_path(keys[3]), 'rb') as f, open(os.path.join(bucket_root, bucket_name, *keys[3].split('/')),
+                                                     'rb') as g:
+        check(f.read() == g.read(), 'the resumed file matches the object')
+
+    #A local file with the right size but a different content is detected by its md5
+    with open(local_path(keys[5]), 'r+b') as f:
+        first_byte = f.read(1)
+        f.seek(0)
+        f.write(bytes([first_byte[0] ^ 0xFF]))
+    stats = download_folder_from_s3(bucket_name, prefix, local_directory, s3_client=LocalS3Client(bucket_root))
+    check(stats['downloaded'] == 1 and stats['skipped'] == number_of_objects - 1,
+          'a modified file of the same size is downloaded again (ETag)')
+
+    #With multipart ETags only the size is compared
+    with open(local_path(keys[7]), 'r+b') as f:
+        f.truncate(os.path.getsize(local_path(keys[7])) - 1)
+    stats = download_folder_from_s3(bucket_name, prefix, local_directory,
+                                    s3_client=LocalS3Client(bucket_root, multipart_etags=True))
+    check(stats['downloaded'] == 1 and stats['skipped'] == number_of_objects - 1,
+          'a truncated file is downloaded again with multipart ETags (size)')
+
+    #Nothing is downloaded once the folder is complete
+    client = LocalS3Client(bucket_root, page_size)
+    stats = download_folder_from_s3(bucket_name, prefix, local_directory, s3_client=client)
+    check(stats['skipped'] == number_of_objects and client.downloads == 0, 'a complete folder is not downloaded again')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        check_download_folder(sys.argv[1])
+    else:
+        work_dir = tempfile.mkdtemp()
+        try:
+            check_download_folder(work_dir)
+        finally:
+            shutil.rmtree(work_dir)
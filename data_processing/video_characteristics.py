@@ -1,414 +1,296 @@
 """This file is used to extract the characteristics of the videos.
+The VideoCharacteristics class counts the timestamps of the faces detected by Rekognition once, and every
+characteristic then makes a single pass over the faces it needs; the get_* functions are kept for convenience and
+use it.
+Usage: python video_characteristics.py output.csv rekognition_1.json [rekognition_2.json ...]
 Author : Mahdi Honarmand"""
 
+import os
+import sys
+import json
 import math
+from functools import partial
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+POSE_CATEGORIES = ['Pitch', 'Roll', 'Yaw']
+QUALITY_CATEGORIES = ['Sharpness', 'Brightness']
+
+
+class VideoCharacteristics:
+    """Characteristics of a video computed from its Rekognition face detection output.
+    The timestamps are counted once when the object is created. Every characteristic then only reads the face
+    attributes it needs, so the characteristics based on the timestamps and on the default attributes of Rekognition
+    (Confidence, BoundingBox, Pose, Quality) work on outputs made without FaceAttributes=['ALL'].
+    Args:
+        video_data (list): Rekognition output of the video (video_data[0]['Faces'], video_data[0]['VideoMetadata'])
+    """
+
+    def __init__(self, video_data):
+        self.faces = [item['Face'] for item in video_data[0]['Faces']]
+        self.video_duration = video_data[0]['VideoMetadata']['DurationMillis']
+        self.number_of_faces = len(self.faces)
+        self.timestamps = [item['Timestamp'] for item in video_data[0]['Faces']]
+        self.timestamp_counts = Counter(self.timestamps)
+        self._first_faces = None
+        self._single_faces = None
+
+    def first_faces(self):
+        """Returns the first face of every timestamp."""
+        if self._first_faces is None:
+            seen_timestamps = set()
+            self._first_faces = []
+            for timestamp, face in zip(self.timestamps, self.faces):
+                if timestamp not in seen_timestamps:
+                    seen_timestamps.add(timestamp)
+                    self._first_faces.append(face)
+        return self._first_faces
+
+    def single_faces(self):
+        """Returns the faces alone in their timestamp."""
+        if self._single_faces is None:
+            self._single_faces = [face for timestamp, face in zip(self.timestamps, self.faces)
+                                  if self.timestamp_counts[timestamp] == 1]
+        return self._single_faces
+
+    def _single_face_average(self, value):
+        """Returns the average of value(face) over the faces alone in their timestamp, or the 'NA'/'n=0' flags."""
+        if self.number_of_faces == 0:
+            return 'NA'
+        single_faces = self.single_faces()
+        if len(single_faces) == 0:
+            return 'n=0'
+        return sum(value(face) for face in single_faces) / len(single_faces)
+
+    def _rounded(self, value, ndigits):
+        if isinstance(value, str):
+            return value
+        return round(value, ndigits)
+
+    def _majority(self, value, positive, negative):
+        average = self._single_face_average(value)
+        if isinstance(average, str):
+            return average
+        return positive if average > 0.5 else negative
+
+    def no_face_proportion_1(self):
+        if self.number_of_faces == 0:
+            return 1.00
+        no_face_duration = 0
+        ts1 = 0
+        for ts2 in self.timestamps + [self.video_duration]:
+            diff = ts2 - ts1
+            if diff > 500:
+                no_face_duration += diff - 500
+            ts1 = ts2
+        return round(no_face_duration / self.video_duration, 2)
+
+    def no_face_proportion_2(self):
+        if self.number_of_faces == 0:
+            return 1.00
+        proportion = 1.00 - len(self.timestamp_counts) / (math.ceil(self.video_duration / 500) + 1)
+        return round(proportion, 2)
+
+    def _number_of_multi_face_timestamps(self):
+        return sum(1 for count in self.timestamp_counts.values() if count != 1)
+
+    def multi_face_proportion_1(self):
+        if self.number_of_faces == 0:
+            return 0.00
+        proportion = self._number_of_multi_face_timestamps() / (math.ceil(self.video_duration / 500) + 1)
+        return round(proportion, 2)
+
+    def multi_face_proportion_2(self):
+        if self.number_of_faces == 0:
+            return 'NA'
+        return round(self._number_of_multi_face_timestamps() / len(self.timestamp_counts), 2)
+
+    def eyes_closed_proportion(self):
+        return self._rounded(self._single_face_average(lambda face: face['EyesOpen']['Value'] == 'False'), 2)
+
+    def eyes_closed_confidence(self):
+        return self._rounded(self._single_face_average(lambda face: face['EyesOpen']['Confidence']), 1)
+
+    def _first_face_average(self, value):
+        if self.number_of_faces == 0:
+            return 'NA'
+        return round(sum(value(face) for face in self.first_faces()) / len(self.timestamp_counts), 1)
+
+    def average_confidence_1(self):
+        return self._first_face_average(lambda face: face['Confidence'])
+
+    def average_confidence_2(self):
+        return self._rounded(self._single_face_average(lambda face: face['Confidence']), 1)
+
+    def average_quality(self, category):    # category = 'Sharpness' or 'Brightness'
+        return self._first_face_average(lambda face: face['Quality'][category])
+
+    def average_pose_1(self, category):    # category = 'Pitch', 'Roll', 'Yaw'
+        if self.number_of_faces == 0:
+            return 'NA'
+        return round(sum(face['Pose'][category] for face in self.faces) / self.number_of_faces, 1)
+
+    def average_pose_2(self, category):    # category = 'Pitch', 'Roll', 'Yaw'
+        return self._rounded(self._single_face_average(lambda face: face['Pose'][category]), 1)
+
+    def age_low(self):
+        return self._rounded(self._single_face_average(lambda face: face['AgeRange']['Low']), 1)
+
+    def age_high(self):
+        return self._rounded(self._single_face_average(lambda face: face['AgeRange']['High']), 1)
+
+    def gender(self):
+        return self._majority(lambda face: face['Gender']['Value'] == 'Male', 'Male', 'Female')
+
+    def gender_confidence(self):
+        return self._rounded(self._single_face_average(lambda face: face['Gender']['Confidence']), 1)
+
+    def eyeglasses(self):
+        return self._majority(lambda face: face['Eyeglasses']['Value'] == 'True', 'True', 'False')
+
+    def eyeglasses_confidence(self):
+        return self._rounded(self._single_face_average(lambda face: face['Eyeglasses']['Confidence']), 1)
+
+    def sunglasses(self):
+        return self._majority(lambda face: face['Sunglasses']['Value'] == 'True', 'True', 'False')
+
+    def sunglasses_confidence(self):
+        return self._rounded(self._single_face_average(lambda face: face['Sunglasses']['Confidence']), 1)
+
+    def average_size(self):
+        return self._single_face_average(lambda face: face['BoundingBox']['Height'] * face['BoundingBox']['Width'])
+
+    def characteristics(self):
+        """Returns the name and the function of every characteristic, in the order of the columns of to_record."""
+        characteristics = [
+            ('no_face_proportion_1', self.no_face_proportion_1),
+            ('no_face_proportion_2', self.no_face_proportion_2),
+            ('multi_face_proportion_1', self.multi_face_proportion_1),
+            ('multi_face_proportion_2', self.multi_face_proportion_2),
+            ('eyes_closed_proportion', self.eyes_closed_proportion),
+            ('eyes_closed_confidence', self.eyes_closed_confidence),
+            ('average_confidence_1', self.average_confidence_1),
+            ('average_confidence_2', self.average_confidence_2),
+        ]
+        for category in QUALITY_CATEGORIES:
+            characteristics.append((f'average_{category.lower()}', partial(self.average_quality, category)))
+        for category in POSE_CATEGORIES:
+            characteristics.append((f'average_{category.lower()}_1', partial(self.average_pose_1, category)))
+            characteristics.append((f'average_{category.lower()}_2', partial(self.average_pose_2, category)))
+        characteristics += [
+            ('age_low', self.age_low),
+            ('age_high', self.age_high),
+            ('gender', self.gender),
+            ('gender_confidence', self.gender_confidence),
+            ('eyeglasses', self.eyeglasses),
+            ('eyeglasses_confidence', self.eyeglasses_confidence),
+            ('sunglasses', self.sunglasses),
+            ('sunglasses_confidence', self.sunglasses_confidence),
+            ('average_size', self.average_size),
+        ]
+        return characteristics
+
+    def to_record(self):
+        """Returns all the characteristics of the video as a dict.
+        The characteristics whose face attributes are missing from the Rekognition output (e.g. AgeRange when the
+        faces were detected with the default attributes) are None."""
+        record = {}
+        for name, characteristic in self.characteristics():
+            try:
+                record[name] = characteristic()
+            except KeyError:
+                record[name] = None
+        return record
+
+
+def get_video_characteristics(json_path):
+    """This function loads a Rekognition json file and returns the characteristics of the video as a dict.
+    The 'video_key' of the record is the name of the json file without its extension."""
+    with open(json_path) as f:
+        video_data = json.load(f)
+    record = {'video_key': os.path.splitext(os.path.basename(json_path))[0]}
+    record.update(VideoCharacteristics(video_data).to_record())
+    return record
+
+
+def get_all_video_characteristics(json_paths, max_workers=None, chunksize=16):
+    """This function computes the characteristics of many videos in a process pool.
+    Args:
+        json_paths (list): Paths to the Rekognition json files.
+        max_workers (int): Number of processes. Default is the number of CPUs. Use 1 to run in this process.
+        chunksize (int): Number of json files sent to a process at a time.
+    Returns:
+        pd.DataFrame: One row per video, in the order of json_paths."""
+    if max_workers == 1:
+        records = [get_video_characteristics(path) for path in json_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            records = list(executor.map(get_video_characteristics, json_paths, chunksize=chunksize))
+    return pd.DataFrame(records)
 
 
 def get_no_face_proportion_1(video_data):
-    if len(video_data[0]['Faces']) == 0:
-        return 1.00
-    
-    video_duration = video_data[0]['VideoMetadata']['DurationMillis']
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    timestamps.append(video_duration)
-
-    no_face_duration = 0
-    ts1 = 0
-    for ts2 in timestamps:
-        diff = ts2 - ts1
-        if diff > 500:
-            no_face_duration += diff - 500
-        ts1 = ts2
-        
-    proportion = no_face_duration/video_duration
-    
-    return round(proportion, 2)
+    return VideoCharacteristics(video_data).no_face_proportion_1()
 
 def get_no_face_proportion_2(video_data):
-    if len(video_data[0]['Faces']) == 0:
-        return 1.00
-        
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-        
-    video_duration = video_data[0]['VideoMetadata']['DurationMillis']
- 
-    proportion = 1.00 - len(set(timestamps))/(math.ceil(video_duration/500)+1)
-    
-    return round(proportion, 2)
+    return VideoCharacteristics(video_data).no_face_proportion_2()
 
 def get_multi_face_proportion_1(video_data):
-    if len(video_data[0]['Faces']) == 0:
-        return 0.00
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    multi_face_timestamps = []
-    for item in timestamps:
-        if timestamps.count(item) != 1:
-            multi_face_timestamps.append(item)
-            
-    video_duration = video_data[0]['VideoMetadata']['DurationMillis']
-        
-    proportion = len(set(multi_face_timestamps)) / (math.ceil(video_duration/500)+1)
-    
-    return round(proportion, 2)  
+    return VideoCharacteristics(video_data).multi_face_proportion_1()
 
 def get_multi_face_proportion_2(video_data):
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-        
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    multi_face_timestamps = []
-    for item in timestamps:
-        if timestamps.count(item) != 1:
-            multi_face_timestamps.append(item)
-        
-    proportion = len(set(multi_face_timestamps)) / len(set(timestamps))
-    
-    return round(proportion, 2)  
-
-def get_eyes_closed_proportion(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    proportion = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            if item['Face']['EyesOpen']['Value'] == 'False':
-                proportion += 1
-            n += 1
-            
-    if n == 0:
-        return 'n=0'        
-    proportion /= n
-    
-    return round(proportion, 2)  
-
-def get_eyes_closed_confidence(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['EyesOpen']['Confidence']
-            n += 1
-            
-    if n == 0:
-        return 'n=0'        
-    average /= n
-    
-    return round(average, 1)
+    return VideoCharacteristics(video_data).multi_face_proportion_2()
+
+def get_eyes_closed_proportion(video_data):
+    return VideoCharacteristics(video_data).eyes_closed_proportion()
+
+def get_eyes_closed_confidence(video_data):
+    return VideoCharacteristics(video_data).eyes_closed_confidence()
 
 def get_average_confidence_1(video_data):
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    average = 0
-    for item in video_data[0]['Faces']:
-        timestamp = item['Timestamp']
-        if timestamp not in timestamps:
-            average += item['Face']['Confidence']
-            timestamps.append(timestamp)
-            
-    if len(timestamps) == 0:
-        return 'len(timestamps)=0'
-    average /= len(timestamps)
-    
-    return round(average, 1)
+    return VideoCharacteristics(video_data).average_confidence_1()
 
 def get_average_confidence_2(video_data):
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['Confidence']
-            n += 1
-        
-    if n == 0:
-        return 'n=0'
-    average /= n
-    
-    return round(average, 1)
+    return VideoCharacteristics(video_data).average_confidence_2()
 
 def get_average_quality(category, video_data):    # category = 'Sharpness' or 'Brightness'
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    average = 0
-    for item in video_data[0]['Faces']:
-        timestamp = item['Timestamp']
-        if timestamp not in timestamps:
-            average += item['Face']['Quality'][category]
-            timestamps.append(timestamp)
-            
-    if len(timestamps) == 0:
-        return 'len(timestamps)=0'        
-    average /= len(timestamps)
-    
-    return round(average, 1)
+    return VideoCharacteristics(video_data).average_quality(category)
 
 def get_average_pose_1(category, video_data):    # category = 'Pitch', 'Roll', 'Yaw'
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    average = 0
-    for item in video_data[0]['Faces']:
-        average += item['Face']['Pose'][category]
-        
-    average /= len(video_data[0]['Faces'])
-    
-    return round(average, 1)
+    return VideoCharacteristics(video_data).average_pose_1(category)
 
 def get_average_pose_2(category, video_data):    # category = 'Pitch', 'Roll', 'Yaw'
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['Pose'][category]
-            n += 1
-        
-    if n == 0:
-        return 'n=0'
-    average /= n
-    
-    return round(average, 1)
-
-def get_age_low(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['AgeRange']['Low']
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    return round(average, 1)
-
-def get_age_high(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['AgeRange']['High']
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    return round(average, 1)
-
-def get_gender(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            gender = item['Face']['Gender']['Value']
-            if gender == 'Male':
-                average += 1
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    if average > 0.5:
-        return 'Male'
-    return 'Female'
-
-def get_gender_confidence(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['Gender']['Confidence']
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    return round(average, 1)
-
-def get_eyeglasses(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            eyeglasses = item['Face']['Eyeglasses']['Value']
-            if eyeglasses == 'True':
-                average += 1
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    if average > 0.5:
-        return 'True'
-    return 'False'
-
-def get_eyeglasses_confidence(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['Eyeglasses']['Confidence']
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    return round(average, 1)
-
-def get_sunglasses(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            sunglasses = item['Face']['Sunglasses']['Value']
-            if sunglasses == 'True':
-                average += 1
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    if average > 0.5:
-        return 'True'
-    return 'False'
-
-def get_sunglasses_confidence(video_data):    
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            average += item['Face']['Sunglasses']['Confidence']
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    return round(average, 1)
+    return VideoCharacteristics(video_data).average_pose_2(category)
+
+def get_age_low(video_data):
+    return VideoCharacteristics(video_data).age_low()
+
+def get_age_high(video_data):
+    return VideoCharacteristics(video_data).age_high()
+
+def get_gender(video_data):
+    return VideoCharacteristics(video_data).gender()
+
+def get_gender_confidence(video_data):
+    return VideoCharacteristics(video_data).gender_confidence()
+
+def get_eyeglasses(video_data):
+    return VideoCharacteristics(video_data).eyeglasses()
+
+def get_eyeglasses_confidence(video_data):
+    return VideoCharacteristics(video_data).eyeglasses_confidence()
+
+def get_sunglasses(video_data):
+    return VideoCharacteristics(video_data).sunglasses()
+
+def get_sunglasses_confidence(video_data):
+    return VideoCharacteristics(video_data).sunglasses_confidence()
 
 def get_average_size(video_data):
-    if len(video_data[0]['Faces']) == 0:
-        return 'NA'
-    
-    timestamps = []
-    for item in video_data[0]['Faces']:
-        timestamps.append(item['Timestamp'])
-    
-    average = 0
-    n = 0
-    for item in video_data[0]['Faces']:
-        if timestamps.count(item['Timestamp']) == 1:
-            height = item['Face']['BoundingBox']['Height']
-            width = item['Face']['BoundingBox']['Width']
-            average += height*width
-            n += 1
-            
-    if n == 0:
-        return 'n=0'         
-    average /= n
-    
-    return average 
\ No newline at end of file
+    return VideoCharacteristics(video_data).average_size()
+
+
+if __name__ == '__main__':
+    df = get_all_video_characteristics(sys.argv[2:])
+    df.to_csv(sys.argv[1], index=False)
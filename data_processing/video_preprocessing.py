@@ -3,11 +3,56 @@ Author : Marie Huynh"""
 
 import cv2
 from loading_s3_data import *
-import requests
+from frame_uploader import upload_frames, print_upload_stats
 import os
 
+def stream_frames(source, fps=1, flip_rotated=True, verbose=False):
+    """This function opens a video once and yields the frames sampled at a specified frames-per-second rate.
+    The skipped frames are only grabbed (not decoded), and only the kept frames are retrieved.
+    Args:
+        source (str): Signed URL or local path of the video.
+        fps (int): Frames per second to capture.
+        flip_rotated (bool): Flip the frames vertically if the video is rotated (the first kept frame is vertical).
+        verbose (bool): Print the framerate and the frame interval of the video.
+    Yields:
+        (int, np.ndarray): Number of the frame among the kept frames (starting at 1) and the BGR frame."""
+    vidcap = cv2.VideoCapture(source)
+    if not vidcap.isOpened():
+        print("Error opening video file.")
+        return
+
+    framerate = int(vidcap.get(cv2.CAP_PROP_FPS))
+    frame_interval = max(round(framerate/fps), 1)  # Calculate frame interval based on desired fps
+    if verbose:
+        print("The framerate is :", framerate)
+        print("The frame interval is :", frame_interval)
+
+    count = 0
+    rotated = None
+    try:
+        while vidcap.grab():
+            count += 1
+            #We only decode the frames we keep
+            if count % frame_interval != 0:
+                continue
+            success, frame = vidcap.retrieve()
+            if not success:
+                continue
+            #We check the rotation on the first kept frame instead of opening the video a second time
+            if rotated is None:
+                rotated = frame.shape[0] > frame.shape[1]
+                if rotated and verbose:
+                    print("Video is rotated.")
+            if rotated and flip_rotated:
+                frame = cv2.flip(frame, 0)
+            yield count // frame_interval, frame
+    finally:
+        vidcap.release()
+
+
 def video_to_image(signed_url, video_key, path_to_save='../data/frames_data/', fps=1):
     """This function converts a video into a sequence of images and saves it locally.
+    The video is streamed from the signed URL, it is not downloaded to a temporary file.
     Args:
         signed_url (str): Signed URL for the video.
         video_key (str): Key for the video.
@@ -20,118 +65,35 @@ def video_to_image(signed_url, video_key, path_to_save='../data/frames_data/', f
     final_saving_path = os.path.join(path_to_save, modified_video_key)
     os.makedirs(final_saving_path, exist_ok=True)
 
-    # Download the video file from the signed URL
-    response = requests.get(signed_url)
-    file_bytes = response.content
-    with open('temp_video.mp4', 'wb') as f:
-        f.write(file_bytes)
-
-    # Open the downloaded video file
-    cap = cv2.VideoCapture('temp_video.mp4')
-
-    # Check if the video opened successfully
-    if (cap.isOpened() == False): 
-        print("Error opening video file.")
-
-    # Set the video frame rate
-    fps = cap.get(cv2.CAP_PROP_FPS) * fps
-
-    # Read until the end of the video file
-    i = 0
-    count = 0
-    while(cap.isOpened()):
-        # Capture frame-by-frame
-        ret, frame = cap.read()
-        count += 1
-        #The function captures a frame every int(cap.get(cv2.CAP_PROP_FPS) / fps) frames 
-        # to achieve the desired fps of the output images
-        if ret == True and count % int(cap.get(cv2.CAP_PROP_FPS) / fps) == 0:
-            # Save the image
-            cv2.imwrite(os.path.join(final_saving_path, f'frame{i:04d}.jpg'), frame)
-            i += 1
-        # Break the loop if the end of the video file is reached
-        elif not ret:
-            break
-
-    # Release the video capture object and delete the downloaded video file
-    cap.release()
-    os.remove('temp_video.mp4')
-
-    # Close all windows
-    cv2.destroyAllWindows()
-
-
-def check_rotation(signed_url):
-    """This function checks if a video is rotated.
-    Args:
-        signed_url (str): Signed URL for the video.
-    Returns:
-        bool: True if the video is rotated, False otherwise."""
-    # Load the video using OpenCV
-    cap = cv2.VideoCapture(signed_url)
-    # Read the first frame
-    ret, frame = cap.read()
-    # Check if the frame is valid
-    if not ret:
-        print("Error reading video frame.")
-        return False
-    # Check if the video is rotated
-    if frame.shape[0] > frame.shape[1]:
-        # Video is vertically oriented (rotated)
-        return True
-    else:
-        # Video is horizontally oriented (not rotated)
-        return False
+    for i, (_, frame) in enumerate(stream_frames(signed_url, fps, flip_rotated=False)):
+        # Save the image
+        cv2.imwrite(os.path.join(final_saving_path, f'frame{i:04d}.jpg'), frame)
 
 
-def split(signed_url, video_key, upload_bucket, fps, upload_folder=''):
+def split(signed_url, video_key, upload_bucket, fps, upload_folder='', max_workers=8, queue_size=32):
     """This function splits a video into frames at a specified frames-per-second rate and uploads them to S3.
+    The frames are encoded in memory and uploaded by a pool of threads while the video is decoded (see upload_frames).
     Args:
         signed_url (str): Signed URL for the video.
         video_key (str): Key for the video.
-        upload_bucket (str): Name of the bucket where the frames will be uploaded.
+        upload_bucket: Bucket where the frames are uploaded, with an upload_fileobj method (boto3 Bucket resource or
+        LocalBucket, see frame_uploader.py).
         fps (int): Frames per second to capture.
+        upload_folder (str): Name of the folder where the frames will be uploaded.
+        max_workers (int): Number of upload threads.
+        queue_size (int): Maximum number of encoded frames waiting to be uploaded.
     Returns:
-        None"""
-
-    # Create the folder to save the images    
-    flipFlag = 0
-    if check_rotation(signed_url):
-        flipFlag = 1
-        print("Video is rotated.")
-    
-    vidcap = cv2.VideoCapture(signed_url)
-    success, image = vidcap.read()
-
-    count = 1  # Start the count at 1
-    framerate = int(vidcap.get(cv2.CAP_PROP_FPS))
-    frame_interval = round(framerate/fps)  # Calculate frame interval based on desired fps
-    print("The framerate is :", framerate)
-    print("The frame interval is :", frame_interval)
-    temp_file_path = 'data/frames_' + str(video_key)
-    os.makedirs(temp_file_path, exist_ok=True)
-
-    while success:
-        if count % frame_interval == 0:
-            cv2.imwrite(f"{temp_file_path}/frame{count//frame_interval:04d}.jpg", image)  # save frame as JPEG file
-            #We add the folder to the key if we want to upload the frames in a specific folder
-            if upload_folder != '':
-                k = f"{upload_folder}/frames/{video_key}/frame{count//frame_interval:04d}.jpg"
-            else:
-                k = f"frames/{video_key}/frame{count//frame_interval:04d}.jpg"
-            filename = f"{temp_file_path}/frame{count//frame_interval:04d}.jpg"
-
-            upload_bucket.upload_file(filename, k)
-            os.remove(filename)
-
-        success, image = vidcap.read()
-        if flipFlag:
-            image = cv2.flip(image, 0)
-
-        count += 1
+        dict: Statistics of the upload."""
+    #We add the folder to the key if we want to upload the frames in a specific folder
+    if upload_folder != '':
+        key_prefix = f"{upload_folder}/frames/{video_key}"
+    else:
+        key_prefix = f"frames/{video_key}"
 
-    vidcap.release()
-    cv2.destroyAllWindows()
+    stats = upload_frames(stream_frames(signed_url, fps, verbose=True), upload_bucket, key_prefix,
+                          max_workers=max_workers, queue_size=queue_size)
+    print_upload_stats(video_key, stats)
+    return stats
 
 
 def splitallFrames(signed_urls, allFilenames, upload_bucket, fps, upload_folder=''):
@@ -140,7 +102,8 @@ def splitallFrames(signed_urls, allFilenames, upload_bucket, fps, upload_folder=
         signed_urls (list): List of signed urls for the videos.
         allFilenames (list): List of video keys.
         framerates (list): List of frame rates for the videos.
-        upload_bucket (str): Name of the bucket where the frames will be uploaded.
+        upload_bucket: Bucket where the frames are uploaded, with an upload_fileobj method (boto3 Bucket resource or
+        LocalBucket, see frame_uploader.py).
         fps (int): Frames per second to capture.
         upload_folder (str): Name of the folder where the frames will be uploaded.
     Returns:
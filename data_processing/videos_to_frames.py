@@ -1,52 +1,143 @@
 """This file is used to convert videos to frames which will be used to test the AWS vision API.
+Every video is a separate job submitted to a pool of processes, so a long video only keeps one worker busy while the
+other workers take the next videos. The jobs are submitted longest first (when the durations are known), and the
+status of every video is appended to a manifest so an interrupted run can be resumed.
+Usage: python videos_to_frames.py --csv finish.csv --n_workers 5 --manifest frames_manifest.jsonl
 Author: Marie Huynh"""
 import cv2
 from loading_s3_data import *
 import requests
 import os
 from video_preprocessing import *
+from frame_uploader import LocalBucket
 import concurrent.futures
+import multiprocessing
+import argparse
+import time
 import json
 import boto3
 
-def process_video(signed_url, filename, upload_bucket):
-    """Process a single video."""
-    splitallFrames([signed_url], [filename], upload_bucket, fps=10, upload_folder='Downsampling')
-    print("Video uploaded: {}".format(filename))
+#Bucket used by the worker process, created once per process by init_worker
+upload_bucket = None
 
-def process_videos_in_thread(thread_id, signed_urls, filenames, upload_bucket):
-    for i in range(thread_id, len(signed_urls), 5):
-        signed_url = signed_urls[i]
-        filename = filenames[i]
-        process_video(signed_url, filename, upload_bucket)
-        print(f"Thread {thread_id}: Video {filename} uploaded")
 
-if __name__ == "__main__":
+def init_worker(upload_bucket_name, local_root=None):
+    """This function creates the upload bucket of a worker process (boto3 resources cannot be sent between processes).
+    Args:
+        upload_bucket_name (str): Name of the bucket where the frames will be uploaded.
+        local_root (str): If given, the frames are written to this folder with a LocalBucket instead of S3."""
+    global upload_bucket
+    if local_root is not None:
+        upload_bucket = LocalBucket(local_root)
+        return
     AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY = loading_credentials()
-    client = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
     resource = boto3.resource('s3', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
-    bucket_name = 'headsup-du1r3b78fy'
-    upload_bucket = 'bmi212marie'
+    upload_bucket = resource.Bucket(upload_bucket_name)
 
-    # We get all the signed URLs from the CSV file
-    df_signed = get_signed_urls('headsup-du1r3b78fy', 'finish.csv', time_limit=200000000)
 
-    # We want to split the videos into frames and store them in the S3 bucket 'bmi212marie'
+def process_video(signed_url, filename, fps=10, upload_folder='Downsampling'):
+    """Process a single video in a worker process.
+    Returns:
+        dict: Status of the video for the manifest."""
+    start = time.perf_counter()
+    try:
+        stats = split(signed_url, filename, upload_bucket, fps, upload_folder)
+    except Exception as e:
+        return {'video_key': filename, 'status': 'failed', 'error': repr(e), 'frames': 0,
+                'seconds': time.perf_counter() - start}
+    status = 'done' if stats['failed'] == 0 else 'failed'
+    return {'video_key': filename, 'status': status, 'frames': stats['uploaded'], 'failed_frames': stats['failed'],
+            'seconds': time.perf_counter() - start}
+
+
+def load_manifest(manifest_path):
+    """This function reads the manifest of a previous run.
+    Returns:
+        dict: Last status of every video key found in the manifest."""
+    statuses = {}
+    if not os.path.exists(manifest_path):
+        return statuses
+    with open(manifest_path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                statuses[record['video_key']] = record
+    return statuses
+
+
+def order_jobs(df_signed, duration_column='VideoDuration'):
+    """This function orders the videos longest first, so the longest videos do not end up alone at the end of the run.
+    The order of the csv is kept if the durations are unknown."""
+    if duration_column in df_signed.columns:
+        return df_signed.sort_values(duration_column, ascending=False, kind='stable')
+    return df_signed
+
 
-    # We define the videos we want to split
-    df_signed = df_signed
-    video_keys = df_signed['video_key'].tolist()
+def run_jobs(df_signed, upload_bucket_name, n_workers=5, fps=10, upload_folder='Downsampling',
+             manifest_path='frames_manifest.jsonl', duration_column='VideoDuration', local_root=None):
+    """This function splits the videos into frames and uploads them with a pool of processes.
+    Args:
+        df_signed (pd.DataFrame): Videos with their 'video_key' and 'signed_url' (see get_signed_urls).
+        upload_bucket_name (str): Name of the bucket where the frames will be uploaded.
+        n_workers (int): Number of processes.
+        fps (int): Frames per second to capture.
+        upload_folder (str): Name of the folder where the frames will be uploaded.
+        manifest_path (str): Path to the manifest, the videos already done in it are skipped.
+        duration_column (str): Column used to order the videos longest first.
+        local_root (str): If given, the frames are written to this folder instead of S3.
+    Returns:
+        dict: Statistics of the run (videos done and failed, frames, time and frames per second)."""
+    done = {key for key, record in load_manifest(manifest_path).items() if record['status'] == 'done'}
+    df_jobs = order_jobs(df_signed[~df_signed['video_key'].isin(done)], duration_column)
+    print(f'{len(done)} videos already done, {len(df_jobs)} videos to process with {n_workers} workers')
 
-    # We select the signed URLs for which the column 'video_key' is in video_keys
-    allFilenames = df_signed[df_signed['video_key'].isin(video_keys)]['video_key'].tolist()
-    signed_urls = df_signed[df_signed['video_key'].isin(video_keys)]['signed_url'].tolist()
-    upload_bucket = resource.Bucket(upload_bucket)
+    stats = {'done': 0, 'failed': 0, 'frames': 0}
+    start = time.perf_counter()
+    #We use spawn so OpenCV and boto3 are initialized in each worker instead of being forked
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=init_worker,
+                                                initargs=(upload_bucket_name, local_root)) as executor, \
+            open(manifest_path, 'a') as manifest:
+        futures = [executor.submit(process_video, signed_url, video_key, fps, upload_folder)
+                   for video_key, signed_url in zip(df_jobs['video_key'], df_jobs['signed_url'])]
 
-    # Create a ThreadPoolExecutor with 5 worker threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        # Launch threads to process videos
-        futures = [executor.submit(process_videos_in_thread, thread_id, signed_urls, allFilenames, upload_bucket) for thread_id in range(5)]
+        for future in concurrent.futures.as_completed(futures):
+            record = future.result()
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
 
-        # Wait for all threads to complete
-        concurrent.futures.wait(futures)
+            stats[record['status']] += 1
+            stats['frames'] += record['frames']
+            elapsed = time.perf_counter() - start
+            print(f"Video {record['video_key']} {record['status']} ({record['frames']} frames in "
+                  f"{record['seconds']:.1f}s) - {stats['done'] + stats['failed']}/{len(futures)} videos, "
+                  f"{stats['frames'] / elapsed:.1f} frames/s overall")
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['frames_per_second'] = stats['frames'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv', type=str, default='finish.csv', help='Dataset of the videos to split')
+    parser.add_argument('--bucket_name', type=str, default='headsup-du1r3b78fy', help='Bucket of the videos')
+    parser.add_argument('--upload_bucket', type=str, default='bmi212marie', help='Bucket where the frames are uploaded')
+    parser.add_argument('--upload_folder', type=str, default='Downsampling')
+    parser.add_argument('--fps', type=int, default=10)
+    parser.add_argument('--n_workers', type=int, default=5)
+    parser.add_argument('--manifest', type=str, default='frames_manifest.jsonl')
+    parser.add_argument('--local_root', type=str, default=None, help='Write the frames to this folder instead of S3')
+    parser.add_argument('--cache_urls', action='store_true',
+                        help=f'Reuse the signed URLs cached in {URL_CACHE_PATH} (private to the user)')
+    args = parser.parse_args()
+
+    # We get all the signed URLs from the CSV file
+    df_signed = get_signed_urls(args.bucket_name, args.csv, time_limit=200000000,
+                                cache_path=URL_CACHE_PATH if args.cache_urls else None)
 
+    stats = run_jobs(df_signed, args.upload_bucket, n_workers=args.n_workers, fps=args.fps,
+                     upload_folder=args.upload_folder, manifest_path=args.manifest, local_root=args.local_root)
+    print(f"{stats['done']} videos done, {stats['failed']} failed, {stats['frames']} frames in "
+          f"{stats['seconds']:.1f}s ({stats['frames_per_second']:.1f} frames/s)")
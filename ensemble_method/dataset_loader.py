@@ -1,16 +1,34 @@
 import pandas as pd
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 from sklearn.preprocessing import StandardScaler
+from feature_cache import load_feature_cache, as_ragged, RaggedDataset
 
 
+FEATURE_COLUMNS = ['head_features', 'eye_gazing_features', 'face_feature']
+#Csv files of the aligned head, eye and face features of every split
+SPLIT_CSV = {'train': './splits/train_eye_head_face.csv', 'val': './splits/val_eye_head_face.csv',
+             'test': './splits/test_eye_head_face.csv'}
 
-def load_test_data():
+
+def load_cached_data(csv_path):
+    """This function loads the head, eye and face features of a split from the binary feature cache
+    (see feature_cache.py) instead of parsing the csv file with eval."""
+    features, y = load_feature_cache(csv_path, FEATURE_COLUMNS)
+    X_head = features['head_features']
+    X_eye = features['eye_gazing_features']
+    X_face = features['face_feature']
+    return X_head, y, X_eye, y, X_face, y
+
+
+def load_test_data(use_cache=True):
     """This function loads the data from the csv files."""
+    if use_cache:
+        return load_cached_data(SPLIT_CSV['test'])
     #We load the train, validation and test data
-    df = pd.read_csv('./splits/test_eye_head_face.csv')
+    df = pd.read_csv(SPLIT_CSV['test'])
     #df_eye = pd.read_csv('./splits/train_eye.csv')
 
     #We convert the 'eye_gazing_features' column from string to list
@@ -34,9 +52,11 @@ def load_test_data():
     return X_head, y_head, X_eye, y_eye, X_face, y_face
 
 
-def load_val_data():
+def load_val_data(use_cache=True):
     """This function loads the data from the csv files."""
-    df = pd.read_csv('./splits/val_eye_head_face.csv')
+    if use_cache:
+        return load_cached_data(SPLIT_CSV['val'])
+    df = pd.read_csv(SPLIT_CSV['val'])
     #df_eye = pd.read_csv('./splits/train_eye.csv')
 
     #We convert the 'eye_gazing_features' column from string to list
@@ -60,10 +80,12 @@ def load_val_data():
     return X_head, y_head, X_eye, y_eye, X_face, y_face
 
 
-def load_train_data():
+def load_train_data(use_cache=True):
     """This function loads the data from the csv files."""
+    if use_cache:
+        return load_cached_data(SPLIT_CSV['train'])
     #We load the train, validation and test data
-    df = pd.read_csv('./splits/train_eye_head_face.csv')
+    df = pd.read_csv(SPLIT_CSV['train'])
     #df_eye = pd.read_csv('./splits/train_eye.csv')
 
     #We convert the 'eye_gazing_features' column from string to list
@@ -86,16 +108,8 @@ def load_train_data():
     
     return X_head, y_head, X_eye, y_eye, X_face, y_face
 
-class dataset(Dataset):
-    def __init__(self, X, y):
-        self.X = [torch.from_numpy(np.array(x)).float() for x in X]
-        self.y = torch.from_numpy(y).long()
-
-    def __len__(self):
-        return len(self.X)
-
-    def __getitem__(self, index):
-        return self.X[index], self.y[index]
+class dataset(RaggedDataset):
+    """Dataset of one modality, its samples are views of the memory-mapped feature cache (see RaggedDataset)."""
 
 
 def collate_fn(batch):
@@ -177,6 +191,142 @@ def get_train_loader(batch_size=25, normalize=True):
 
     return body_loader, eye_loader, face_loader
 
+class MultimodalDataset(Dataset):
+    """Dataset yielding the aligned head, eye and face sequences of a video with its label,
+    so the three modalities can be batched (and shuffled) together by a single DataLoader.
+    Every modality is a RaggedFeatures and the samples are views of its values buffer (see RaggedDataset)."""
+    def __init__(self, X_head, X_eye, X_face, y):
+        self.X_head = as_ragged(X_head)
+        self.X_eye = as_ragged(X_eye)
+        self.X_face = as_ragged(X_face)
+        self.y = torch.from_numpy(np.asarray(y)).long()
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getitem__(self, index):
+        return (torch.from_numpy(self.X_head[index]), torch.from_numpy(self.X_eye[index]),
+                torch.from_numpy(self.X_face[index]), self.y[index])
+
+
+def multimodal_collate_fn(batch):
+    """Pads each modality of the batch to its longest sequence.
+    Returns:
+        inputs (list): padded head, eye and face tensors of shape (batch_size, seq_length, num_features)
+        lengths (list): sequence lengths of the head, eye and face tensors
+        y (torch.Tensor): labels of the batch
+    """
+    X_head, X_eye, X_face, y = zip(*batch)
+    inputs = [pad_sequence(X, batch_first=True, padding_value=0) for X in (X_head, X_eye, X_face)]
+    lengths = [torch.tensor([len(x) for x in X]) for X in (X_head, X_eye, X_face)]
+    y = torch.stack(y)
+
+    return inputs, lengths, y
+
+
+MODALITIES = {'head': 0, 'eye': 1, 'face': 2}
+
+
+def get_multimodal_loader(split, batch_size=25, shuffle=False, num_workers=0, bucket_size=None, bucket_by='face'):
+    """This function returns a single dataloader over the aligned head, eye and face data of a split.
+    Args:
+        split (str): 'train', 'val' or 'test'
+        batch_size (int): batch size
+        shuffle (bool): whether to shuffle the videos at every epoch
+        num_workers (int): number of worker processes used to build the batches
+        bucket_size (int): if set, the batches are built with a BucketBatchSampler grouping videos whose
+        bucket_by sequences have similar lengths, to reduce padding. Default is None (random batches).
+        bucket_by (str): modality ('head', 'eye' or 'face') whose lengths are used for bucketing
+    """
+    load_functions = {'train': load_train_data, 'val': load_val_data, 'test': load_test_data}
+    X_head, y, X_eye, _, X_face, _ = load_functions[split]()
+    multimodal_dataset = MultimodalDataset(X_head, X_eye, X_face, y)
+
+    if bucket_size is None:
+        return DataLoader(multimodal_dataset, batch_size=batch_size, shuffle=shuffle,
+                          num_workers=num_workers, collate_fn=multimodal_collate_fn)
+
+    sequences = [multimodal_dataset.X_head, multimodal_dataset.X_eye, multimodal_dataset.X_face][MODALITIES[bucket_by]]
+    sampler = BucketBatchSampler(sequences.lengths(), batch_size, bucket_size, shuffle=shuffle)
+    print(f'Padding efficiency of the {split} batches ({bucket_by}): {sampler.padding_efficiency():.4f}')
+    return DataLoader(multimodal_dataset, batch_sampler=sampler,
+                      num_workers=num_workers, collate_fn=multimodal_collate_fn)
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler grouping sequences of similar lengths so that batches need less padding.
+    At every epoch the indices are shuffled and split into chunks of batch_size * bucket_size samples,
+    each chunk is sorted by length and cut into batches, and the batches are shuffled.
+    Args:
+        lengths (list): sequence length of every sample of the dataset
+        batch_size (int): number of samples per batch
+        bucket_size (int): number of batches per chunk sorted together. Default is 50.
+        shuffle (bool): whether to shuffle the samples and the batches. If False, the samples are
+        sorted by length over the whole dataset. Default is True.
+        drop_last (bool): whether to drop the last incomplete batch of every chunk. Default is False.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=50, shuffle=True, drop_last=False):
+        self.lengths = torch.as_tensor(np.asarray(lengths), dtype=torch.long)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        return iter(self.make_batches())
+
+    def __len__(self):
+        n = len(self.lengths)
+        chunk_size = self.batch_size * self.bucket_size if self.shuffle else max(n, 1)
+        chunk_sizes = [chunk_size] * (n // chunk_size) + ([n % chunk_size] if n % chunk_size else [])
+        if self.drop_last:
+            return sum(size // self.batch_size for size in chunk_sizes)
+        return sum((size + self.batch_size - 1) // self.batch_size for size in chunk_sizes)
+
+    def make_batches(self):
+        """Returns the list of batches (lists of indices) of one epoch."""
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths))
+            chunks = torch.split(indices, self.batch_size * self.bucket_size)
+        else:
+            chunks = [torch.arange(len(self.lengths))]
+
+        batches = []
+        for chunk in chunks:
+            # Sort the chunk by decreasing length (stable, so the shuffle order breaks the ties)
+            order = torch.sort(self.lengths[chunk], descending=True, stable=True)[1]
+            for batch in torch.split(chunk[order], self.batch_size):
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def padding_efficiency(self):
+        """Returns the fraction of real (non padded) timesteps over one epoch of batches."""
+        return padding_efficiency(self.lengths, self.make_batches())
+
+
+def padding_efficiency(lengths, batches):
+    """This function computes the fraction of real (non padded) timesteps in padded batches.
+    Args:
+        lengths (list): sequence length of every sample of the dataset
+        batches (list): list of batches, each batch being a list of sample indices
+    Returns:
+        float: number of real timesteps / number of timesteps after padding each batch to its longest sequence
+    """
+    lengths = torch.as_tensor(np.asarray(lengths), dtype=torch.long)
+    real, padded = 0, 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += batch_lengths.sum().item()
+        padded += batch_lengths.max().item() * len(batch)
+    return real / max(padded, 1)
+
+
+
 def class_weights(train_loader, num_classes=2):
     """This function computes the class weights for the training data to feed into the loss function."""
     # Assume train_loader is your DataLoader
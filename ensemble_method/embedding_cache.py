@@ -0,0 +1,78 @@
+"""This file contains the functions used to precompute the hidden vectors of the frozen head, eye and face backbones.
+The backbones of late_fusion_hidden_layer are frozen, so their 64-dim hidden vectors only depend on the weights
+and on the video. We run each backbone once over a split and store the concatenated hidden vectors on disk,
+keyed by a hash of the weights files and of the split csv, so the fusion head can be trained directly on these
+tensors."""
+
+import os
+import hashlib
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from dataset_loader import multimodal_collate_fn, SPLIT_CSV
+from feature_cache import csv_hash
+
+EMBEDDINGS_DIR = 'embeddings'
+#Version of the hidden vectors of the backbones, part of the cache key (2: packed sequences in the Modified models)
+EMBEDDINGS_VERSION = 2
+
+
+def weights_hash(weights_paths):
+    """This function computes the sha1 hash of the content of a list of weights files."""
+    sha1 = hashlib.sha1()
+    for path in weights_paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def compute_embeddings(backbones, multimodal_loader, device, batch_size=25):
+    """This function runs the frozen backbones once over a split.
+    Args:
+        backbones (list): head, eye and face backbones returning their last hidden vector
+        multimodal_loader: multimodal dataloader of the split (see get_multimodal_loader)
+        device: the device used to run the backbones
+    Returns:
+        embeddings (torch.Tensor): concatenated head, eye and face hidden vectors, shape (num_videos, 3 * hidden_size)
+        labels (torch.Tensor): labels of the videos
+    """
+    # We iterate the dataset in order (no shuffling) so the embeddings are aligned with the labels
+    loader = DataLoader(multimodal_loader.dataset, batch_size=batch_size, shuffle=False,
+                        num_workers=multimodal_loader.num_workers, collate_fn=multimodal_collate_fn)
+    for backbone in backbones:
+        backbone.eval()
+
+    embeddings = []
+    labels = []
+    with torch.no_grad():
+        for inputs, input_lengths, y in loader:
+            hidden = [backbone(x.to(device), x_len) for backbone, x, x_len in zip(backbones, inputs, input_lengths)]
+            embeddings.append(torch.cat(hidden, dim=1).cpu())
+            labels.append(y)
+
+    return torch.cat(embeddings), torch.cat(labels)
+
+
+def load_embeddings(split, backbones, weights_paths, multimodal_loader, device, cache_dir=EMBEDDINGS_DIR):
+    """This function loads the embeddings of a split from the disk, computing them if they are not cached yet.
+    Args:
+        split (str): 'train', 'val' or 'test'
+        backbones (list): head, eye and face backbones returning their last hidden vector
+        weights_paths (list): weights files of the backbones, used to key the cache with the csv of the split
+        multimodal_loader: multimodal dataloader of the split
+        device: the device used to run the backbones
+    Returns:
+        TensorDataset: dataset of (embedding, label) pairs
+    """
+    #The features of a split can be regenerated with the same labels (e.g. another fps or color conversion of the
+    #landmark extraction), so the key includes the hash of its csv
+    path = os.path.join(cache_dir, f'{split}_v{EMBEDDINGS_VERSION}_{weights_hash(weights_paths)[:16]}_'
+                                   f'{csv_hash(SPLIT_CSV[split])[:16]}.pt')
+    cache = torch.load(path) if os.path.exists(path) else None
+    if cache is None or not torch.equal(cache['labels'], multimodal_loader.dataset.y):
+        embeddings, labels = compute_embeddings(backbones, multimodal_loader, device)
+        cache = {'embeddings': embeddings, 'labels': labels}
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(cache, path)
+
+    return TensorDataset(cache['embeddings'], cache['labels'])
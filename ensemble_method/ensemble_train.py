@@ -10,27 +10,21 @@ import torch.nn.functional as F
 import matplotlib.pyplot as plt
 import sklearn.metrics
 import optuna
+from embedding_cache import load_embeddings
+from evaluation import Evaluator, print_metrics
 
 BATCH_SIZE = 32
 lr = 0.0005
 hidden_size = 64
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+BACKBONE_WEIGHTS = ['./weights/model_head_banging_2.pt', './weights/model_eye_gaze_v3.pt', './weights/model_face.pt']
+FUSION_WEIGHTS = './weights/model_fusion.pt'
 
 def get_probs():
     body_loader, eye_loader, face_loader = get_test_loader_eye(25)
     #body_loader, _ = get_test_loader_head()
 
-    head_lstm = GRUModel(input_size = 20, hidden_size = 64, num_layers = 3).to(device)
-    head_lstm.load_state_dict(torch.load('./weights/model_head_banging_2.pt', map_location = 'cpu'))
-    head_lstm.eval()
-
-    GRU_eyes = ModifiedGRUModel(input_size = 8, hidden_size = 64, num_layers = 4).to(device)
-    GRU_eyes.load_state_dict(torch.load('./weights/model_eye_gaze_v3.pt', map_location = 'cpu'))
-    GRU_eyes.eval()
-
-    face = ModifiedGRUModel(input_size = 1434, hidden_size = 64, num_layers = 2).to(device)
-    face.load_state_dict(torch.load('./weights/model_face.pt', map_location = 'cpu'))
-    face.eval()
+    head_lstm, GRU_eyes, face = [load_model(path, device) for path in BACKBONE_WEIGHTS]
 
     head_output=[]
     eye_output=[]
@@ -71,13 +65,17 @@ def get_probs():
     return head_output, eye_output, face_output, final_labels_1, final_labels_2, final_labels_3
 
 
-def late_fusion_probs():
-    
+def late_fusion_probs(df_path='full_df.csv', output_path='full_df.csv'):
+    """This function adds the late fusion probabilities of the test videos to a dataframe.
+    Args:
+        df_path (str): csv file of the test videos, in the order of the test loader
+        output_path (str): csv file where the dataframe is saved
+    """
     probs_1, probs_2, preds_3, labels_1, labels_2, labels_3  = get_probs()
 
     final_prob = [(prob_1 + probs_2[i] + preds_3[i])/3 for i, prob_1 in enumerate(probs_1)]
     acc = sklearn.metrics.accuracy_score([round(prob) for prob in final_prob], labels_1)
-    df = pd.read_csv('/Users/colinkalicki/Desktop/autism_digital_profiling/ensembling_methods/full_df.csv')
+    df = pd.read_csv(df_path)
     df['int_fusion'] = final_prob
     df['late_fusion'] = probs_1
     df['head_preds'] = probs_1
@@ -92,14 +90,13 @@ def late_fusion_probs():
     acc_3 = sklearn.metrics.accuracy_score(probs_3, labels_1)
 
     
-    df.to_csv('full_df.csv')
+    df.to_csv(output_path)
 
 
 
 def train_late_fusion(epochs, model, batch_size, optimizer):
-    head_loader_train, eye_loader_train = get_train_loader(batch_size)
-    head_loader_val, eye_loader_val = get_val_loader(25)
-    head_loader_test, eye_loader_test = get_test_loader_eye()
+    train_loader = get_multimodal_loader('train', batch_size, shuffle=True)
+    test_loader = get_multimodal_loader('test', 25)
 
     late_probs_model = model
     late_probs_model.train()
@@ -113,20 +110,17 @@ def train_late_fusion(epochs, model, batch_size, optimizer):
 
     for epoch in range(epochs):
         total_loss = 0
-        head_progress_bar = tqdm(enumerate(head_loader_train), total=len(head_loader_train), desc="Training")
-        eye_loader_train_iter = iter(eye_loader_train)
-        for i, (head_inputs, labels, head_input_lengths) in head_progress_bar:
-            head_inputs = head_inputs
-            labels = labels
-            eye_inputs, labels2, eye_input_lengths = next(eye_loader_train_iter)
-            inputs = [head_inputs, eye_inputs]
-            input_lengths = [head_input_lengths, eye_input_lengths]
+        progress_bar = tqdm(enumerate(train_loader), total=len(train_loader), desc="Training")
+        for i, (inputs, input_lengths, labels) in progress_bar:
+            # The late fusion model only uses the head and eye modalities
+            inputs = inputs[:2]
+            input_lengths = input_lengths[:2]
             optimizer.zero_grad()
 
             # Forward pass
             outputs = late_probs_model(inputs, input_lengths)
             loss = criterion(outputs.float(), labels.float())
-            total_loss += loss.item() * head_inputs.size(0)
+            total_loss += loss.item() * labels.size(0)
 
             # Calculate accuracy
             predicted = torch.round(outputs) # Use torch.max to get the index of the max log-probability.
@@ -138,60 +132,35 @@ def train_late_fusion(epochs, model, batch_size, optimizer):
             loss.backward()
             optimizer.step()
 
-            head_progress_bar.set_postfix({'loss': loss.item()})
+            progress_bar.set_postfix({'loss': loss.item()})
 
-        epoch_loss = total_loss / len(head_loader_train.dataset)
+        epoch_loss = total_loss / len(train_loader.dataset)
         epoch_acc = total_correct / total_samples
         print(f'Epoch: [{epoch+1}/{epochs}], Loss: {epoch_loss:.4f}, Accuracy: {epoch_acc:.4f}')
 
         # Append the loss for this epoch to the list of losses
     train_losses.append(epoch_loss)
-    misclassifications = {0: 0, 1: 0} 
-    test_correct=0
-    test_total = 0
-    test_loss = 0
-    test_accuracy = 0
     late_probs_model.eval()
-    head_progress_bar = tqdm(enumerate(head_loader_test), total=len(head_loader_test), desc="Training")
-    eye_loader_train_iter = iter(eye_loader_test)
-    for i, (head_inputs, labels, head_input_lengths) in head_progress_bar:
-        head_inputs = head_inputs
-        labels = labels
-        eye_inputs, labels2, eye_input_lengths = next(eye_loader_train_iter)
-        inputs = [head_inputs, eye_inputs]
-        input_lengths = [head_input_lengths, eye_input_lengths]
-
-        test_outputs = late_probs_model(inputs, input_lengths)
-        labels = labels.float()  # Convert labels to long
-
-        test_predicted = torch.round(test_outputs)  # get the index of the max log-probability
-        test_correct += (test_predicted == labels).sum().item()
-        test_total += labels.size(0)
-
-            # Track misclassifications per class
-        for i in range(labels.size(0)):
-            if test_predicted[i] != labels[i]:
-                misclassifications[int(labels[i].item())] += 1
-
-            #Compute the loss and accumulate it
-        loss = criterion(test_outputs, labels)
-        test_loss += loss.item() * head_inputs.size(0)
-
-    #Calculate the average test loss over all batches
-    test_loss = test_loss / len(head_loader_test.dataset)
-    test_accuracy = test_correct / test_total
-
-       
-    print(f'Test Loss: {test_loss:.4f}, Test Accuracy: {test_accuracy:.4f}')
-    for class_label, misclassified_count in misclassifications.items():
-        print(f'Misclassifications for class {class_label}: {misclassified_count}')
+    metrics = evaluate_fusion(late_probs_model, test_loader, criterion, num_modalities=2)
+    print_metrics(metrics)
     
-    return test_accuracy
+    return metrics['accuracy']
 
 def train_int_fusion(epochs, model, batch_size, optimizer, train_loader, val_loader, test_loader):
-    head_loader_train, eye_loader_train, face_loader_train = train_loader
-    head_loader_val, eye_loader_val, face_loader_val= val_loader
-    head_loader_test, eye_loader_test, face_loader_test = test_loader
+    """Trains the intermediate fusion model.
+    Args:
+        train_loader, val_loader, test_loader: multimodal dataloaders (see get_multimodal_loader).
+        The training videos are reshuffled at every epoch in batches of batch_size (bucketed by length
+        if train_loader uses a BucketBatchSampler).
+    """
+    if isinstance(train_loader.batch_sampler, BucketBatchSampler):
+        sampler = train_loader.batch_sampler
+        train_sampler = BucketBatchSampler(sampler.lengths, batch_size, sampler.bucket_size)
+        train_loader = DataLoader(train_loader.dataset, batch_sampler=train_sampler,
+                                  num_workers=train_loader.num_workers, collate_fn=multimodal_collate_fn)
+    else:
+        train_loader = DataLoader(train_loader.dataset, batch_size=batch_size, shuffle=True,
+                                  num_workers=train_loader.num_workers, collate_fn=multimodal_collate_fn)
 
     late_probs_model = model
     late_probs_model.train()
@@ -205,25 +174,19 @@ def train_int_fusion(epochs, model, batch_size, optimizer, train_loader, val_loa
 
     for epoch in range(epochs):
         total_loss = 0
-        head_progress_bar = tqdm(enumerate(head_loader_train), total=len(head_loader_train), desc="Training")
-        eye_loader_train_iter = iter(eye_loader_train)
-        face_loader_train_iter = iter(face_loader_train)
+        progress_bar = tqdm(enumerate(train_loader), total=len(train_loader), desc="Training")
 
         late_probs_model.train()
         
-        for i, (head_inputs, labels, head_input_lengths) in head_progress_bar:
-            head_inputs = head_inputs
+        for i, (inputs, input_lengths, labels) in progress_bar:
             labels = labels.to(device)
-            eye_inputs, labels2, eye_input_lengths = next(eye_loader_train_iter)
-            face_inputs, labels2, face_input_lengths = next(face_loader_train_iter)
-            inputs = [head_inputs.to(device), eye_inputs.to(device), face_inputs.to(device)]
-            input_lengths = [head_input_lengths.to(device), eye_input_lengths.to(device), face_input_lengths.to(device)]
+            inputs = [x.to(device) for x in inputs]
             optimizer.zero_grad()
 
             # Forward pass
             outputs = late_probs_model(inputs, input_lengths)
             loss = criterion(outputs.float(), labels.float())
-            total_loss += loss.item() * head_inputs.size(0)
+            total_loss += loss.item() * labels.size(0)
 
             # Calculate accuracy
             predicted = torch.round(outputs) # Use torch.max to get the index of the max log-probability.
@@ -235,99 +198,39 @@ def train_int_fusion(epochs, model, batch_size, optimizer, train_loader, val_loa
             loss.backward()
             optimizer.step()
 
-            head_progress_bar.set_postfix({'loss': loss.item()})
+            progress_bar.set_postfix({'loss': loss.item()})
 
-        epoch_loss = total_loss / len(head_loader_train.dataset)
+        epoch_loss = total_loss / len(train_loader.dataset)
         epoch_acc = total_correct / total_samples
         print(f'Epoch: [{epoch+1}/{epochs}], Loss: {epoch_loss:.4f}, Accuracy: {epoch_acc:.4f}')
-        head_progress_bar = tqdm(enumerate(head_loader_val), total=len(head_loader_val), desc="Training")
-        eye_loader_train_iter = iter(eye_loader_val)
-        test_correct=0
-        test_total = 0
-        val_loss = 0
-        misclassifications = {0: 0, 1: 0} 
-        test_accuracy = 0
-        late_probs_model.eval()
-        eye_loader_val_iter = iter(eye_loader_val)
-        face_loader_val_iter = iter(face_loader_val)
-        
-        for i, (head_inputs, labels, head_input_lengths) in head_progress_bar:
-            head_inputs = head_inputs
-            labels = labels
-            eye_inputs, labels2, eye_input_lengths = next(eye_loader_val_iter)
-            face_inputs, labels2, face_input_lengths = next(face_loader_val_iter)
-            inputs = [head_inputs.to(device), eye_inputs.to(device), face_inputs.to(device)]
-            input_lengths = [head_input_lengths.to(device), eye_input_lengths.to(device), face_input_lengths.to(device)]
-
-            test_outputs = late_probs_model(inputs, input_lengths)
-            labels = labels.float()  # Convert labels to long
-
-            test_predicted = torch.round(test_outputs)  # get the index of the max log-probability
-            test_correct += (test_predicted == labels).sum().item()
-            test_total += labels.size(0)
-
-            # Track misclassifications per class
-            for i in range(labels.size(0)):
-                if test_predicted[i] != labels[i]:
-                    misclassifications[int(labels[i].item())] += 1
-
-            #Compute the loss and accumulate it
-            loss = criterion(test_outputs, labels)
-            val_loss += loss.item() * head_inputs.size(0)
-
-        #Calculate the average test loss over all batches
-        val_loss = val_loss / len(head_loader_val.dataset)
-        test_accuracy = test_correct / test_total
+        metrics = evaluate_fusion(late_probs_model, val_loader, criterion)
+        val_loss = metrics['loss']
         # Append the loss for this epoch to the list of losses
         train_losses.append(epoch_loss)
-        print(f'Val Loss: {val_loss:.4f}, Val Accuracy: {test_accuracy:.4f}')
+        print(f"Val Loss: {val_loss:.4f}, Val Accuracy: {metrics['accuracy']:.4f}")
 
-    misclassifications = {0: 0, 1: 0} 
-    test_correct=0
-    test_total = 0
-    test_loss = 0
-    test_accuracy = 0
     late_probs_model.eval()
-    head_progress_bar = tqdm(enumerate(head_loader_test), total=len(head_loader_test), desc="Training")
-    eye_loader_train_iter = iter(eye_loader_test)
-    eye_loader_test_iter = iter(eye_loader_test)
-    face_loader_test_iter = iter(face_loader_test)
-        
-    for i, (head_inputs, labels, head_input_lengths) in head_progress_bar:
-        head_inputs = head_inputs
-        labels = labels
-        eye_inputs, labels2, eye_input_lengths = next(eye_loader_test_iter)
-        face_inputs, labels2, face_input_lengths = next(face_loader_test_iter)
-        inputs = [head_inputs.to(device), eye_inputs.to(device), face_inputs.to(device)]
-        input_lengths = [head_input_lengths.to(device), eye_input_lengths.to(device), face_input_lengths.to(device)]
-
-        test_outputs = late_probs_model(inputs, input_lengths)
-        labels = labels.float()  # Convert labels to long
-
-        test_predicted = torch.round(test_outputs)  # get the index of the max log-probability
-        test_correct += (test_predicted == labels).sum().item()
-        test_total += labels.size(0)
-
-            # Track misclassifications per class
-        for i in range(labels.size(0)):
-            if test_predicted[i] != labels[i]:
-                misclassifications[int(labels[i].item())] += 1
-
-            #Compute the loss and accumulate it
-        loss = criterion(test_outputs, labels)
-        test_loss += loss.item() * head_inputs.size(0)
-
-    #Calculate the average test loss over all batches
-    test_loss = test_loss / len(head_loader_test.dataset)
-    test_accuracy = test_correct / test_total
-
-       
-    print(f'Test Loss: {test_loss:.4f}, Test Accuracy: {test_accuracy:.4f}')
-    for class_label, misclassified_count in misclassifications.items():
-        print(f'Misclassifications for class {class_label}: {misclassified_count}')
+    print_metrics(evaluate_fusion(late_probs_model, test_loader, criterion))
 
     return val_loss
 
+def evaluate_fusion(model, loader, criterion, num_modalities=3):
+    """Evaluates a fusion model on a multimodal loader.
+    Args:
+        num_modalities: number of modalities (head, eye, face) used by the model
+    Returns:
+        dict: the metrics computed by Evaluator (loss, accuracy, AUC, confusion matrix, misclassifications)
+    """
+    model.eval()
+    evaluator = Evaluator(len(loader.dataset), device=device)
+    with torch.inference_mode():
+        for inputs, input_lengths, labels in loader:
+            inputs = [x.to(device) for x in inputs[:num_modalities]]
+            labels = labels.to(device)
+            outputs = model(inputs, input_lengths[:num_modalities])
+            evaluator.update(outputs, labels, criterion(outputs.view(-1), labels.float()))
+    return evaluator.compute()
+
 #late fusion model based on accuracies of individual prediction
 def accuracy_based_ensemble(predictions_list, true_labels):
     """
@@ -402,28 +305,103 @@ def objective_int(trial, train_loader, val_loader, test_loader):
    
 
     # Create the model
-    
+    head_lstm, GRU_eyes, face_gru = load_backbones()
+    model = late_fusion_hidden_layer(hidden_size*3, hidden_size, 1, GRU_eyes, head_lstm, face_gru, dropout).to(device)
+    # Create the optimizer
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+
+
+    val_loss = train_int_fusion(num_epochs, model, batch_size, optimizer, train_loader, val_loader, test_loader)
+
+
+
+    return val_loss
+
+def load_backbones():
+    """Loads the pretrained head, eye and face backbones of the intermediate fusion model,
+    which return their last hidden vector instead of the probabilities."""
     head_lstm = GRUModel_last_output(input_size = 20, hidden_size = 64, num_layers = 3).to(device)
-    head_lstm.load_state_dict(torch.load('./weights/model_head_banging_2.pt', map_location = 'cpu'))
-    
+    head_lstm.load_state_dict(torch.load(BACKBONE_WEIGHTS[0], map_location = 'cpu'))
 
     GRU_eyes = ModifiedGRUModel_hidden_output(input_size = 8, hidden_size = 64, num_layers = 4).to(device)
-    GRU_eyes.load_state_dict(torch.load('./weights/model_eye_gaze_v3.pt', map_location = 'cpu'))
+    GRU_eyes.load_state_dict(torch.load(BACKBONE_WEIGHTS[1], map_location = 'cpu'))
 
     face_gru = ModifiedGRUModel_hidden_output(input_size = 1434, hidden_size = 64, num_layers = 2).to(device)
-    face_gru.load_state_dict(torch.load('./weights/model_face.pt', map_location = 'cpu'))
+    face_gru.load_state_dict(torch.load(BACKBONE_WEIGHTS[2], map_location = 'cpu'))
 
-    model = late_fusion_hidden_layer(hidden_size*3, hidden_size, 1, GRU_eyes, head_lstm, face_gru, dropout).to(device)
-    # Create the optimizer
-    optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+    return head_lstm, GRU_eyes, face_gru
 
+def train_fusion_head(epochs, model, batch_size, optimizer, train_data, val_data, test_data):
+    """Trains the fusion head of the intermediate fusion model on the precomputed hidden vectors of the frozen backbones.
+    Args:
+        train_data, val_data, test_data: TensorDatasets of (embedding, label) pairs (see embedding_cache.py)
+    Returns:
+        the validation loss of the last epoch
+    """
+    train_loader = DataLoader(train_data, batch_size=batch_size, shuffle=True)
+    val_loader = DataLoader(val_data, batch_size=len(val_data))
+    test_loader = DataLoader(test_data, batch_size=len(test_data))
+    criterion = nn.BCELoss()
 
-    val_loss = train_int_fusion(num_epochs, model, batch_size, optimizer, train_loader, val_loader, test_loader)
+    for epoch in range(epochs):
+        model.train()
+        total_loss = 0
+        total_correct = 0
+        for embeddings, labels in train_loader:
+            embeddings, labels = embeddings.to(device), labels.to(device).float()
+            optimizer.zero_grad()
 
+            # Forward pass
+            outputs = model(embeddings).view(-1)
+            loss = criterion(outputs, labels)
+            total_loss += loss.detach() * labels.size(0)
+            total_correct += (torch.round(outputs) == labels).sum()
 
+            # Backward and optimize
+            loss.backward()
+            optimizer.step()
+
+        epoch_loss = total_loss.item() / len(train_data)
+        epoch_acc = total_correct.item() / len(train_data)
+        val_loss, val_accuracy = evaluate_fusion_head(model, val_loader, criterion)
+        print(f'Epoch: [{epoch+1}/{epochs}], Loss: {epoch_loss:.4f}, Accuracy: {epoch_acc:.4f}, Val Loss: {val_loss:.4f}, Val Accuracy: {val_accuracy:.4f}')
+
+    test_loss, test_accuracy = evaluate_fusion_head(model, test_loader, criterion)
+    print(f'Test Loss: {test_loss:.4f}, Test Accuracy: {test_accuracy:.4f}')
 
     return val_loss
 
+def evaluate_fusion_head(model, loader, criterion):
+    """Computes the loss and the accuracy of the fusion head on a loader of precomputed embeddings."""
+    model.eval()
+    evaluator = Evaluator(len(loader.dataset), device=device)
+    with torch.inference_mode():
+        for embeddings, labels in loader:
+            embeddings, labels = embeddings.to(device), labels.to(device)
+            outputs = model(embeddings).view(-1)
+            evaluator.update(outputs, labels, criterion(outputs, labels.float()))
+    metrics = evaluator.compute()
+    return metrics['loss'], metrics['accuracy']
+
+def objective_int_cached(trial, train_data, val_data, test_data):
+    """Function to be optimized by Optuna, training only the fusion head on the precomputed embeddings.
+    It searches the same hyperparameters as objective_int.
+    Args:
+        trial: the current trial
+        """
+    # Hyperparameters to be tuned
+    batch_size = trial.suggest_categorical('batch_size', [15, 20, 25, 30])
+    num_epochs = trial.suggest_int('num_epochs', 20, 60)
+    learning_rate = trial.suggest_loguniform('learning_rate', 1e-5, 1e-3)
+    hidden_size =  64
+    dropout = trial.suggest_uniform('dropout', 0.1, 0.6)
+    weight_decay = trial.suggest_loguniform('weight_decay', 1e-5, 1e-2)
+
+    model = fusion_head(hidden_size*3, hidden_size, 1, dropout).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
+
+    return train_fusion_head(num_epochs, model, batch_size, optimizer, train_data, val_data, test_data)
+
 def hyperparameter_tuning_late(num_trials=50):
     """Function to tune the hyperparameters of the model using Optuna.
     Args:
@@ -458,19 +436,25 @@ def hyperparameter_tuning_late(num_trials=50):
 
     
 
-def hyperparameter_tuning_int(num_trials=50):
+def hyperparameter_tuning_int(num_trials=50, cached_embeddings=True):
     """Function to tune the hyperparameters of the model using Optuna.
     Args:
         num_trials (int): Number of hyperparameter tuning trials to run.
+        cached_embeddings (bool): whether to run the frozen backbones only once over each split and train the
+        fusion head on the stored hidden vectors (see embedding_cache.py). Default is True.
     """
-    head, face, eye = get_train_loader(25)
-    train_loader = [head, face, eye]
-    head, face, eye = get_val_loader(25)
-    val_loader = [head, face, eye]
-    head, face, eye = get_test_loader_eye(25)
-    test_loader = [head, face, eye]
+    train_loader = get_multimodal_loader('train', 25, shuffle=True)
+    val_loader = get_multimodal_loader('val', 25)
+    test_loader = get_multimodal_loader('test', 25)
     study = optuna.create_study(direction='minimize')
-    study.optimize(lambda trial: objective_int(trial, train_loader, val_loader, test_loader), n_trials=num_trials)
+    if cached_embeddings:
+        backbones = load_backbones()
+        train_data = load_embeddings('train', backbones, BACKBONE_WEIGHTS, train_loader, device)
+        val_data = load_embeddings('val', backbones, BACKBONE_WEIGHTS, val_loader, device)
+        test_data = load_embeddings('test', backbones, BACKBONE_WEIGHTS, test_loader, device)
+        study.optimize(lambda trial: objective_int_cached(trial, train_data, val_data, test_data), n_trials=num_trials)
+    else:
+        study.optimize(lambda trial: objective_int(trial, train_loader, val_loader, test_loader), n_trials=num_trials)
 
     print('Best trial:')
     trial = study.best_trial
@@ -479,28 +463,28 @@ def hyperparameter_tuning_int(num_trials=50):
     for key, value in trial.params.items():
         print(f"    {key}: {value}")
 
-    
-    head_lstm = GRUModel_last_output(input_size = 20, hidden_size = 64, num_layers = 3).to(device)
-    head_lstm.load_state_dict(torch.load('./weights/model_head_banging_2.pt', map_location = 'cpu'))
-    
-
-    GRU_eyes = ModifiedGRUModel_hidden_output(input_size = 8, hidden_size = 64, num_layers = 4).to(device)
-    GRU_eyes.load_state_dict(torch.load('./weights/model_eye_gaze_v3.pt', map_location = 'cpu'))
-
-
-    face_gru = ModifiedGRUModel_hidden_output(input_size = 1434, hidden_size = 64, num_layers = 2).to(device)
-    face_gru.load_state_dict(torch.load('./weights/model_face.pt', map_location = 'cpu'))
-
+    head_lstm, GRU_eyes, face_gru = load_backbones()
     best_model = late_fusion_hidden_layer(hidden_size*3, hidden_size, 1, GRU_eyes, head_lstm, face_gru, trial.params['dropout']).to(device)
 
-
-    # Create the optimizer with the best learning rate and weight decay
-    optimizer = optim.Adam(best_model.parameters(), lr=trial.params['learning_rate'], weight_decay=trial.params['weight_decay'])
-
-    # Train the model with the best number of epochs
-    val_loss = train_int_fusion(trial.params['num_epochs'], best_model, trial.params['batch_size'], optimizer)
+    if cached_embeddings:
+        head = fusion_head(hidden_size*3, hidden_size, 1, trial.params['dropout']).to(device)
+        optimizer = optim.Adam(head.parameters(), lr=trial.params['learning_rate'], weight_decay=trial.params['weight_decay'])
+        val_loss = train_fusion_head(trial.params['num_epochs'], head, trial.params['batch_size'], optimizer, train_data, val_data, test_data)
+        # The fusion head layers have the same names as in the full model, we load them one by one and strictly so
+        # that a renamed or resized layer raises an error instead of keeping its random weights
+        for name, layer in head.named_children():
+            getattr(best_model, name).load_state_dict(layer.state_dict())
+    else:
+        # Create the optimizer with the best learning rate and weight decay
+        optimizer = optim.Adam(best_model.parameters(), lr=trial.params['learning_rate'], weight_decay=trial.params['weight_decay'])
+
+        # Train the model with the best number of epochs
+        val_loss = train_int_fusion(trial.params['num_epochs'], best_model, trial.params['batch_size'], optimizer, train_loader, val_loader, test_loader)
 
     print(val_loss)
+    #We save the model so the scoring service can load its fusion head (see scoring_service.py)
+    torch.save(best_model.state_dict(), FUSION_WEIGHTS)
+    return best_model
 
 if __name__ == '__main__':
     torch.manual_seed(0)
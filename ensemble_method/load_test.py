@@ -0,0 +1,94 @@
+"""This file load-tests the scoring service (see scoring_service.py) with random videos sent by concurrent clients,
+and reports the latency percentiles and the throughput.
+Usage: python load_test.py --url http://127.0.0.1:8000 --requests 500 --concurrency 16"""
+
+import io
+import json
+import time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+#Number of features per frame of every modality
+FEATURE_SIZES = {'head': 20, 'eye': 8, 'face': 1434}
+
+
+def random_video(rng, min_frames=50, max_frames=300):
+    """This function creates the random features of a video (all the modalities have the same number of frames)."""
+    num_frames = int(rng.integers(min_frames, max_frames + 1))
+    return {modality: rng.standard_normal((num_frames, size)).astype(np.float32)
+            for modality, size in FEATURE_SIZES.items()}
+
+
+def encode_request(video, use_json=False):
+    """This function encodes the features of a video as a .npz archive (or as JSON).
+    Returns:
+        (bytes, str): body and content type of the request"""
+    if use_json:
+        return json.dumps({key: value.tolist() for key, value in video.items()}).encode(), 'application/json'
+    buffer = io.BytesIO()
+    np.savez(buffer, **video)
+    return buffer.getvalue(), 'application/x-npz'
+
+
+def send_request(url, body, content_type):
+    """This function sends a request to the service.
+    Returns:
+        (float, dict): latency in milliseconds and response"""
+    request = urllib.request.Request(url + '/score', data=body, headers={'Content-Type': content_type})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        result = json.loads(response.read())
+    return 1000 * (time.perf_counter() - start), result
+
+
+def load_test(url, num_requests=500, concurrency=16, num_videos=32, use_json=False, seed=0):
+    """This function sends num_requests requests from concurrency client threads and reports the latency and the
+    throughput.
+    Returns:
+        dict: p50, p90 and p99 latency in milliseconds, requests per second and number of failed requests"""
+    rng = np.random.default_rng(seed)
+    #We encode a pool of videos beforehand so the clients only measure the service
+    bodies = [encode_request(random_video(rng), use_json) for _ in range(num_videos)]
+    with urllib.request.urlopen(url + '/stats') as response:
+        stats_before = json.loads(response.read())
+
+    def run(i):
+        try:
+            return send_request(url, *bodies[i % num_videos])[0]
+        except Exception as e:
+            print(f'Request {i} failed: {e}')
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(run, range(num_requests)))
+    total_seconds = time.perf_counter() - start
+
+    with urllib.request.urlopen(url + '/stats') as response:
+        stats_after = json.loads(response.read())
+    num_batches = stats_after['batches'] - stats_before['batches']
+    num_scored = stats_after['requests'] - stats_before['requests']
+
+    latencies = np.array([latency for latency in latencies if latency is not None])
+    results = {'p50_ms': float(np.percentile(latencies, 50)), 'p90_ms': float(np.percentile(latencies, 90)),
+               'p99_ms': float(np.percentile(latencies, 99)), 'requests_per_second': len(latencies) / total_seconds,
+               'failed': num_requests - len(latencies), 'mean_batch_size': num_scored / max(num_batches, 1)}
+    print(f"{num_requests} requests, {concurrency} clients ({'JSON' if use_json else 'npz'}): "
+          f"p50 {results['p50_ms']:.1f} ms, p90 {results['p90_ms']:.1f} ms, p99 {results['p99_ms']:.1f} ms, "
+          f"{results['requests_per_second']:.1f} requests/s, mean batch size {results['mean_batch_size']:.2f}, "
+          f"{results['failed']} failed")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--json', action='store_true', help='send the features as JSON instead of npz')
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        load_test(args.url, args.requests, concurrency, use_json=args.json)
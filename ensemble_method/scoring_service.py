@@ -0,0 +1,279 @@
+"""This file contains a local HTTP service scoring videos with the head, eye and face models and the fusion head.
+The models are loaded once when the service starts. The requests received at the same time are batched together by a
+single scoring thread: it waits at most max_latency_ms after the first request of a batch for other requests, up to
+max_batch_size, and scores the whole batch with one forward pass per modality.
+A request is a POST /score with the head, eye and face features of a video, either as JSON
+({"head": [[...], ...], "eye": [[...], ...], "face": [[...], ...]}) or as a .npz archive with the same keys
+(Content-Type: application/x-npz, much cheaper to parse for the 1434 face features). The response is
+{"head": p, "eye": p, "face": p, "fused": p}, the probabilities of ASD of every modality and of the ensemble.
+Usage: python scoring_service.py --port 8000 [--fusion_weights ./weights/model_fusion.pt]"""
+
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+import torch.nn.utils.rnn as rnn_utils
+from models import load_model, fusion_head, pooled_lengths, GRUModel, ModifiedGRUModel, ModifiedLSTMModel
+
+MODALITIES = ['head', 'eye', 'face']
+SCORING_WEIGHTS = {'head': './weights/model_head_banging_2.pt', 'eye': './weights/model_eye_gaze_v3.pt',
+                   'face': './weights/model_face.pt'}
+
+
+def input_size(model):
+    """This function returns the number of features per frame expected by a model."""
+    return model.cnn.in_channels if isinstance(model, (ModifiedGRUModel, ModifiedLSTMModel)) else model.gru.input_size
+
+
+def min_frames(model):
+    """This function returns the minimum number of frames a model can score (the Modified models need one
+    pooling window after the convolution)."""
+    if isinstance(model, (ModifiedGRUModel, ModifiedLSTMModel)):
+        return model.cnn.kernel_size[0] + model.maxpool.kernel_size - 1
+    return 1
+
+
+def backbone_outputs(model, x, lengths):
+    """This function runs a model on a padded batch and returns both its probabilities of ASD and the last hidden
+    vector of its top recurrent layer (the input of the fusion head, see GRUModel_last_output and
+    ModifiedGRUModel_hidden_output), so each modality is only run once.
+    Returns:
+        probs (torch.Tensor): probabilities of ASD, shape (batch_size,)
+        hidden (torch.Tensor): hidden vectors, shape (batch_size, hidden_size)
+    """
+    if isinstance(model, GRUModel):
+        packed_input = rnn_utils.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        _, h_n = model.gru(packed_input)
+        hidden = h_n[-1]
+        out = model.fc(hidden)
+    elif isinstance(model, (ModifiedGRUModel, ModifiedLSTMModel)):
+        x = model.maxpool(model.relu(model.cnn(x.permute(0, 2, 1)))).permute(0, 2, 1)
+        lengths = pooled_lengths(lengths, model.cnn.kernel_size[0], model.maxpool.kernel_size)
+        packed_input = rnn_utils.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        if isinstance(model, ModifiedGRUModel):
+            _, h_n = model.gru(packed_input)
+        else:
+            _, (h_n, _) = model.lstm(packed_input)
+        hidden = h_n[-1]
+        out = model.fc(hidden)
+    else:
+        raise TypeError(f'Scoring is not supported for {type(model).__name__}')
+    return model.sigmoid(out)[:, 1], hidden
+
+
+def run_backbone(model, sequences):
+    """This function scores a list of sequences of one modality in a single padded batch (the models pack the
+    sequences, so every video gets the probability it has when it is scored alone).
+    Returns:
+        probs (torch.Tensor): probabilities of ASD, shape (len(sequences),)
+        hidden (torch.Tensor): hidden vectors, shape (len(sequences), hidden_size)
+    """
+    x = rnn_utils.pad_sequence(sequences, batch_first=True)
+    lengths = torch.tensor([len(sequence) for sequence in sequences])
+    return backbone_outputs(model, x, lengths)
+
+
+def load_fusion_head(path):
+    """This function loads the fusion head from a fusion_head or a late_fusion_hidden_layer state dict (only its
+    fully connected layers are kept)."""
+    state = torch.load(path, map_location='cpu')
+    state = {key: value for key, value in state.items() if key.split('.')[0] in ('fc1', 'fc2', 'fc3', 'fc4')}
+    hidden_size, concat_size = state['fc1.weight'].shape
+    model = fusion_head(concat_size, hidden_size, state['fc4.weight'].shape[0], dropout=0.0)
+    model.load_state_dict(state)
+    return model.eval()
+
+
+class EnsembleScorer:
+    """Head, eye and face models and fusion head, loaded once.
+    Args:
+        weights (dict): path of the weights of the 'head', 'eye' and 'face' models. Default is SCORING_WEIGHTS.
+        fusion_weights (str): path of the weights of the fusion head. If None, the fused probability is the mean of
+        the probabilities of the three modalities (as in late_fusion_probs). Default is None.
+    """
+    def __init__(self, weights=SCORING_WEIGHTS, fusion_weights=None):
+        self.models = {modality: load_model(weights[modality]) for modality in MODALITIES}
+        self.fusion_head = load_fusion_head(fusion_weights) if fusion_weights is not None else None
+
+    def parse_inputs(self, inputs):
+        """This function converts the features of a request to float32 tensors and checks their shapes.
+        Raises:
+            ValueError: if a modality is missing or has the wrong shape
+        """
+        tensors = {}
+        for modality in MODALITIES:
+            if modality not in inputs:
+                raise ValueError(f'Missing {modality} features')
+            x = torch.as_tensor(np.asarray(inputs[modality], dtype=np.float32))
+            model = self.models[modality]
+            if x.dim() != 2 or x.size(1) != input_size(model) or x.size(0) < min_frames(model):
+                raise ValueError(f'The {modality} features must have shape (frames >= {min_frames(model)}, '
+                                 f'{input_size(model)}), got {tuple(x.shape)}')
+            tensors[modality] = x
+        return tensors
+
+    def score_batch(self, batch):
+        """This function scores a batch of requests.
+        Args:
+            batch (list): parsed requests (see parse_inputs)
+        Returns:
+            list: one dict of 'head', 'eye', 'face' and 'fused' probabilities per request
+        """
+        with torch.inference_mode():
+            probs, hidden = {}, []
+            for modality in MODALITIES:
+                probs[modality], h = run_backbone(self.models[modality], [inputs[modality] for inputs in batch])
+                hidden.append(h)
+            if self.fusion_head is not None:
+                probs['fused'] = self.fusion_head(torch.cat(hidden, dim=1)).view(-1)
+            else:
+                probs['fused'] = (probs['head'] + probs['eye'] + probs['face']) / 3
+        probs = {key: value.tolist() for key, value in probs.items()}
+        return [{key: value[i] for key, value in probs.items()} for i in range(len(batch))]
+
+
+class DynamicBatcher:
+    """Scores the requests of all the client threads in batches, on a single scoring thread.
+    Args:
+        scorer (EnsembleScorer): the models
+        max_batch_size (int): maximum number of requests per batch. Default is 16.
+        max_latency_ms (float): maximum time the first request of a batch waits for other requests. Default is 5.
+    """
+    def __init__(self, scorer, max_batch_size=16, max_latency_ms=5):
+        self.scorer = scorer
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.requests = queue.Queue()
+        self.num_batches = 0
+        self.num_requests = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, inputs):
+        """This function checks a request and queues it.
+        Returns:
+            Future: resolved with the probabilities of the request once its batch is scored
+        """
+        future = Future()
+        self.requests.put((self.scorer.parse_inputs(inputs), future))
+        return future
+
+    def next_batch(self):
+        """This function waits for a request, then collects the requests arriving before the latency budget ends."""
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = self.scorer.score_batch([inputs for inputs, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            self.num_batches += 1
+            self.num_requests += len(batch)
+
+    def stats(self):
+        return {'batches': self.num_batches, 'requests': self.num_requests,
+                'mean_batch_size': self.num_requests / max(self.num_batches, 1)}
+
+
+def make_handler(batcher):
+    """This function creates the HTTP request handler of the service."""
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            elif self.path == '/stats':
+                self.send_json(200, batcher.stats())
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                if self.headers.get('Content-Type') == 'application/x-npz':
+                    inputs = dict(np.load(io.BytesIO(body)))
+                else:
+                    inputs = json.loads(body)
+                future = batcher.submit(inputs)
+            except Exception as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                self.send_json(200, future.result())
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            #We do not log every request
+            pass
+
+    return ScoringHandler
+
+
+class ScoringServer(ThreadingHTTPServer):
+    #The default backlog of 5 pending connections resets the connections of concurrent clients
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(host='127.0.0.1', port=8000, weights=SCORING_WEIGHTS, fusion_weights=None, max_batch_size=16,
+          max_latency_ms=5):
+    """This function loads the models and serves the requests until interrupted."""
+    torch.set_grad_enabled(False)
+    batcher = DynamicBatcher(EnsembleScorer(weights, fusion_weights), max_batch_size, max_latency_ms)
+    server = ScoringServer((host, port), make_handler(batcher))
+    print(f'Scoring service listening on http://{host}:{port} (batches of up to {max_batch_size} requests, '
+          f'{max_latency_ms} ms latency budget)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--head_weights', type=str, default=SCORING_WEIGHTS['head'])
+    parser.add_argument('--eye_weights', type=str, default=SCORING_WEIGHTS['eye'])
+    parser.add_argument('--face_weights', type=str, default=SCORING_WEIGHTS['face'])
+    parser.add_argument('--fusion_weights', type=str, default=None,
+                        help='weights of the fusion head (default: mean of the three probabilities)')
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    parser.add_argument('--max_latency_ms', type=float, default=5)
+    args = parser.parse_args()
+
+    weights = {'head': args.head_weights, 'eye': args.eye_weights, 'face': args.face_weights}
+    serve(args.host, args.port, weights, args.fusion_weights, args.max_batch_size, args.max_latency_ms)
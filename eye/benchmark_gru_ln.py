@@ -0,0 +1,100 @@
+"""This file benchmarks the GRUModel_LN recurrence (precomputed input projections and scripted loop over the packed
+time steps, see layer_norm_gru_scan in models.py) against the previous implementation, which stepped the
+LayerNormGRUCells of all the layers at every time step of the padded batch with a single hidden state, and against
+nn.GRU without cuDNN (same sizes, no layer normalization).
+Usage: python benchmark_gru_ln.py --input_size 8 --hidden_size 64 --num_layers 2 --device cpu"""
+
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from models import GRUModel, GRUModel_LN
+from export import example_inputs
+
+
+def legacy_forward(model, x, lengths):
+    """This function is the previous GRUModel_LN.forward (a single hidden state shared by the layers, every time step
+    of the padded batch), kept to measure the speedup. Its outputs differ from the per-layer hidden states."""
+    batch_size, seq_len, _ = x.size()
+    h = torch.zeros(batch_size, model.hidden_size).to(x.device)
+    out = []
+    for t in range(seq_len):
+        x_t = x[:, t, :]
+        for i in range(model.num_layers):
+            h = model.cells[i](x_t, h)
+            x_t = h
+        out.append(h.unsqueeze(1))
+    out = torch.cat(out, dim=1)
+    last_output = out[torch.arange(len(out)), lengths - 1]
+    return model.sigmoid(model.fc(last_output)).squeeze()
+
+
+def stepped_forward(model, x, lengths):
+    """This function steps the LayerNormGRUCells of every sequence and every layer one by one, with one hidden state
+    per layer, to check the outputs of the vectorized recurrence."""
+    last_outputs = []
+    for i, length in enumerate(lengths.tolist()):
+        h = [torch.zeros(1, model.hidden_size, device=x.device) for _ in model.cells]
+        for t in range(length):
+            x_t = x[i:i + 1, t]
+            for layer, cell in enumerate(model.cells):
+                h[layer] = cell(x_t, h[layer])
+                x_t = h[layer]
+        last_outputs.append(h[-1])
+    return model.sigmoid(model.fc(torch.cat(last_outputs))).squeeze()
+
+
+def time_run(run, repeats=20, warmup=3, backward=False):
+    """This function measures the median time of a run (forward only, or forward and backward) in milliseconds."""
+    times = []
+    for i in range(warmup + repeats):
+        start = time.perf_counter()
+        with torch.set_grad_enabled(backward):
+            out = run()
+            if backward:
+                out.sum().backward()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if i >= warmup:
+            times.append(1000 * (time.perf_counter() - start))
+    return float(np.median(times))
+
+
+def benchmark(input_size=8, hidden_size=64, num_layers=2, shapes=((1, 300), (16, 300), (64, 300)), device='cpu',
+              repeats=20):
+    """This function prints the forward and forward + backward times of the three implementations.
+    The lengths of the sequences are drawn between half and the full sequence length."""
+    torch.manual_seed(0)
+    model = GRUModel_LN(input_size, hidden_size, num_layers).to(device)
+    gru = GRUModel(input_size, hidden_size, num_layers).to(device)
+
+    x, lengths = example_inputs(input_size, 4, 50)
+    x = x.to(device)
+    with torch.no_grad():
+        diff = (model(x, lengths) - stepped_forward(model, x, lengths)).abs().max().item()
+    print(f'Max abs diff with the stepped cells: {diff:.2e}')
+
+    runs = [('GRUModel_LN', model), ('previous loop', lambda x, lengths: legacy_forward(model, x, lengths)),
+            ('nn.GRU (no cuDNN)', gru)]
+    print(f"{'batch':>6} {'sequence':>9} {'implementation':>18} {'forward (ms)':>13} {'forward+backward (ms)':>22}")
+    with torch.backends.cudnn.flags(enabled=False):
+        for batch_size, seq_len in shapes:
+            x, lengths = example_inputs(input_size, batch_size, seq_len)
+            x = x.to(device)
+            for name, run in runs:
+                forward = time_run(lambda: run(x, lengths), repeats)
+                backward = time_run(lambda: run(x, lengths), repeats, backward=True)
+                print(f'{batch_size:>6} {seq_len:>9} {name:>18} {forward:>13.2f} {backward:>22.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_size', type=int, default=8)
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    benchmark(args.input_size, args.hidden_size, args.num_layers, device=args.device, repeats=args.repeats)
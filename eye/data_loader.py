@@ -4,13 +4,27 @@ Author : Marie Huynh"""
 import pandas as pd
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 from sklearn.preprocessing import StandardScaler
+from feature_cache import load_feature_cache, RaggedDataset
 
 
-def load_data():
-    """This function loads the data from the csv files."""
+def load_data(use_cache=True):
+    """This function loads the data from the csv files.
+    Args:
+        use_cache (bool): whether to load the features from the binary feature cache (see feature_cache.py)
+        instead of parsing the csv files with eval. Default is True.
+    """
+    if use_cache:
+        features, y_train = load_feature_cache('splits/train.csv', ['eye_gazing_features'])
+        X_train = features['eye_gazing_features']
+        features, y_val = load_feature_cache('splits/val.csv', ['eye_gazing_features'])
+        X_val = features['eye_gazing_features']
+        features, y_test = load_feature_cache('splits/test.csv', ['eye_gazing_features'])
+        X_test = features['eye_gazing_features']
+        return X_train, y_train, X_val, y_val, X_test, y_test
+
     #We load the train, validation and test data
     df_train = pd.read_csv('splits/train.csv')
     df_val = pd.read_csv('splits/val.csv')
@@ -32,16 +46,8 @@ def load_data():
     
     return X_train, y_train, X_val, y_val, X_test, y_test
 
-class GazeDataset(Dataset):
-    def __init__(self, X, y):
-        self.X = [torch.from_numpy(np.array(x)).float() for x in X]
-        self.y = torch.from_numpy(y).long()
-
-    def __len__(self):
-        return len(self.X)
-
-    def __getitem__(self, index):
-        return self.X[index], self.y[index]
+class GazeDataset(RaggedDataset):
+    """Eye gazing dataset, its samples are views of the memory-mapped feature cache (see RaggedDataset)."""
 
 
 def collate_fn(batch):
@@ -56,8 +62,86 @@ def collate_fn(batch):
     
     return X_padded, y, X_lengths 
 
-def get_loader(batch_size=32, normalize=True):
-    """This function returns the dataloaders for the train, validation and test data."""
+class BucketBatchSampler(Sampler):
+    """Batch sampler grouping sequences of similar lengths so that batches need less padding.
+    At every epoch the indices are shuffled and split into chunks of batch_size * bucket_size samples,
+    each chunk is sorted by length and cut into batches, and the batches are shuffled.
+    Args:
+        lengths (list): sequence length of every sample of the dataset
+        batch_size (int): number of samples per batch
+        bucket_size (int): number of batches per chunk sorted together. Default is 50.
+        shuffle (bool): whether to shuffle the samples and the batches. If False, the samples are
+        sorted by length over the whole dataset. Default is True.
+        drop_last (bool): whether to drop the last incomplete batch of every chunk. Default is False.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=50, shuffle=True, drop_last=False):
+        self.lengths = torch.as_tensor(np.asarray(lengths), dtype=torch.long)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        return iter(self.make_batches())
+
+    def __len__(self):
+        n = len(self.lengths)
+        chunk_size = self.batch_size * self.bucket_size if self.shuffle else max(n, 1)
+        chunk_sizes = [chunk_size] * (n // chunk_size) + ([n % chunk_size] if n % chunk_size else [])
+        if self.drop_last:
+            return sum(size // self.batch_size for size in chunk_sizes)
+        return sum((size + self.batch_size - 1) // self.batch_size for size in chunk_sizes)
+
+    def make_batches(self):
+        """Returns the list of batches (lists of indices) of one epoch."""
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths))
+            chunks = torch.split(indices, self.batch_size * self.bucket_size)
+        else:
+            chunks = [torch.arange(len(self.lengths))]
+
+        batches = []
+        for chunk in chunks:
+            # Sort the chunk by decreasing length (stable, so the shuffle order breaks the ties)
+            order = torch.sort(self.lengths[chunk], descending=True, stable=True)[1]
+            for batch in torch.split(chunk[order], self.batch_size):
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def padding_efficiency(self):
+        """Returns the fraction of real (non padded) timesteps over one epoch of batches."""
+        return padding_efficiency(self.lengths, self.make_batches())
+
+
+def padding_efficiency(lengths, batches):
+    """This function computes the fraction of real (non padded) timesteps in padded batches.
+    Args:
+        lengths (list): sequence length of every sample of the dataset
+        batches (list): list of batches, each batch being a list of sample indices
+    Returns:
+        float: number of real timesteps / number of timesteps after padding each batch to its longest sequence
+    """
+    lengths = torch.as_tensor(np.asarray(lengths), dtype=torch.long)
+    real, padded = 0, 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += batch_lengths.sum().item()
+        padded += batch_lengths.max().item() * len(batch)
+    return real / max(padded, 1)
+
+
+def get_loader(batch_size=32, normalize=True, bucket_size=None):
+    """This function returns the dataloaders for the train, validation and test data.
+    Args:
+        batch_size (int): batch size
+        bucket_size (int): if set, the batches are built with a BucketBatchSampler grouping sequences of similar
+        lengths (chunks of batch_size * bucket_size samples) to reduce padding. Default is None (random batches).
+    """
     # Load the data
     X_train, y_train, X_val, y_val, X_test, y_test = load_data()
     train_dataset = GazeDataset(X_train, y_train)
@@ -65,9 +149,20 @@ def get_loader(batch_size=32, normalize=True):
     val_dataset = GazeDataset(X_val, y_val)
 
     # Create dataloaders
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    if bucket_size is None:
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+        test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+        val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    else:
+        train_sampler = BucketBatchSampler(train_dataset.X.lengths(), batch_size, bucket_size)
+        test_sampler = BucketBatchSampler(test_dataset.X.lengths(), batch_size, shuffle=False)
+        val_sampler = BucketBatchSampler(val_dataset.X.lengths(), batch_size, shuffle=False)
+        random_batches = torch.randperm(len(train_dataset)).split(batch_size)
+        print(f'Padding efficiency of the training batches: {train_sampler.padding_efficiency():.4f} '
+              f'(random batches: {padding_efficiency(train_sampler.lengths, random_batches):.4f})')
+        train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn)
+        test_loader = DataLoader(test_dataset, batch_sampler=test_sampler, collate_fn=collate_fn)
+        val_loader = DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=collate_fn)
 
     return train_loader, test_loader, val_loader
 
@@ -0,0 +1,94 @@
+"""This file contains the evaluation engine shared by the training scripts.
+The predictions and labels of every batch are written into preallocated tensors (no .item() per batch, so no
+device synchronization), and the loss, accuracy, confusion matrix, AUC and misclassifications per class are
+computed in one vectorized pass at the end."""
+
+import torch
+
+
+class Evaluator:
+    """Accumulates the outputs of a binary classifier over a dataset.
+    Args:
+        num_samples (int): number of samples of the dataset (size of the preallocated tensors)
+        num_classes (int): number of classes. Default is 2.
+        device: the device of the model outputs
+    """
+    def __init__(self, num_samples, num_classes=2, device='cpu'):
+        self.num_classes = num_classes
+        self.scores = torch.empty(num_samples, device=device)
+        self.predictions = torch.empty(num_samples, dtype=torch.long, device=device)
+        self.labels = torch.empty(num_samples, dtype=torch.long, device=device)
+        self.loss_sum = torch.zeros((), device=device)
+        self.count = 0
+
+    def update(self, outputs, labels, loss=None):
+        """Adds a batch.
+        Args:
+            outputs (torch.Tensor): either the probabilities of each class, shape (batch_size, num_classes),
+            or the probability of class 1, shape (batch_size,)
+            labels (torch.Tensor): labels of the batch
+            loss (torch.Tensor): mean loss of the batch, if any
+        """
+        n = labels.size(0)
+        outputs = outputs.detach().reshape(n, -1)
+        if outputs.size(1) == 1:
+            scores = outputs[:, 0]
+            predictions = torch.round(scores).long()
+        else:
+            scores = outputs[:, 1]
+            predictions = torch.max(outputs, 1)[1]
+
+        self.scores[self.count:self.count + n] = scores
+        self.predictions[self.count:self.count + n] = predictions
+        self.labels[self.count:self.count + n] = labels.long()
+        if loss is not None:
+            self.loss_sum += loss.detach() * n
+        self.count += n
+
+    def compute(self):
+        """Computes the metrics over all the batches.
+        Returns:
+            dict: 'loss', 'accuracy', 'auc', 'confusion_matrix' (rows are the true labels, columns the predictions)
+            and 'misclassifications' (number of misclassified samples per class)
+        """
+        scores = self.scores[:self.count]
+        predictions = self.predictions[:self.count]
+        labels = self.labels[:self.count]
+
+        confusion_matrix = torch.bincount(labels * self.num_classes + predictions,
+                                          minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+        misclassifications = confusion_matrix.sum(1) - confusion_matrix.diag()
+
+        return {
+            'loss': (self.loss_sum / max(self.count, 1)).item(),
+            'accuracy': (confusion_matrix.diag().sum().float() / max(self.count, 1)).item(),
+            'auc': roc_auc(scores, labels),
+            'confusion_matrix': confusion_matrix.cpu().numpy(),
+            'misclassifications': {c: count for c, count in enumerate(misclassifications.tolist())},
+        }
+
+
+def roc_auc(scores, labels):
+    """This function computes the area under the ROC curve with the Mann-Whitney U statistic.
+    Tied scores get their average rank. Returns nan if only one class is present."""
+    positives = labels == 1
+    n_positives = positives.sum().item()
+    n_negatives = labels.numel() - n_positives
+    if n_positives == 0 or n_negatives == 0:
+        return float('nan')
+
+    # Rank of every score (1-based), ties get the average of their ranks
+    _, inverse, counts = torch.unique(scores, sorted=True, return_inverse=True, return_counts=True)
+    average_ranks = counts.cumsum(0).double() - (counts.double() - 1) / 2
+    ranks = average_ranks[inverse]
+
+    u = ranks[positives].sum().item() - n_positives * (n_positives + 1) / 2
+    return u / (n_positives * n_negatives)
+
+
+def print_metrics(metrics, name='Test'):
+    """Prints the metrics returned by Evaluator.compute."""
+    print(f"{name} Loss: {metrics['loss']:.4f}, {name} Accuracy: {metrics['accuracy']:.4f}, {name} AUC: {metrics['auc']:.4f}")
+    print(f"Confusion matrix (rows: labels, columns: predictions):\n{metrics['confusion_matrix']}")
+    for class_label, misclassified_count in metrics['misclassifications'].items():
+        print(f'Misclassifications for class {class_label}: {misclassified_count}')
@@ -0,0 +1,237 @@
+"""This file exports the trained models to TorchScript and ONNX, so they can be scored on CPU without the training
+stack. The exported models take a padded batch x (batch, sequence, features) and its int64 lengths, with dynamic
+batch and sequence axes. Every export is checked against the eager model on several batch sizes and sequence lengths,
+and its latency is compared with the eager model.
+Usage: python export.py ../best_models/model_face.pt --output_dir exported --format torchscript onnx"""
+
+import os
+import sys
+import time
+import inspect
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from models import load_model, infer_model_config, pooled_lengths, GRUModel, GRUModel_LN, ModifiedGRUModel, \
+    ModifiedLSTMModel
+
+#(batch size, sequence length) of the inputs used by the parity checks
+PARITY_SHAPES = [(1, 20), (4, 50), (16, 300)]
+
+
+def example_inputs(input_size, batch_size=4, seq_len=50, seed=0):
+    """This function creates a random padded batch and its lengths (the first sequence has the full length)."""
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(batch_size, seq_len, input_size, generator=generator)
+    lengths = torch.randint(max(seq_len // 2, 1), seq_len + 1, (batch_size,), generator=generator)
+    lengths[0] = seq_len
+    for i, length in enumerate(lengths.tolist()):
+        x[i, length:] = 0
+    return x, lengths
+
+
+class PaddedGRUModel(nn.Module):
+    """GRUModel without the packing of the sequences, which the ONNX exporter specialises to the example lengths.
+    The GRU is causal, so its output at lengths - 1 on the padded batch is the output of the last time step of the
+    packed sequence."""
+    def __init__(self, model):
+        super(PaddedGRUModel, self).__init__()
+        self.model = model
+
+    def forward(self, x, lengths):
+        out, _ = self.model.gru(x)
+        last_output = out[torch.arange(x.size(0)), lengths - 1]
+        return self.model.sigmoid(self.model.fc(last_output)).squeeze()
+
+
+class PaddedModifiedModel(nn.Module):
+    """ModifiedGRUModel or ModifiedLSTMModel without the packing of the pooled sequences (see PaddedGRUModel): the
+    output of the top layer at the last pooled step computed from real frames is the last hidden state of the packed
+    sequence."""
+    def __init__(self, model):
+        super(PaddedModifiedModel, self).__init__()
+        self.model = model
+
+    def forward(self, x, lengths):
+        model = self.model
+        x = model.maxpool(model.relu(model.cnn(x.permute(0, 2, 1)))).permute(0, 2, 1)
+        out, _ = model.gru(x) if isinstance(model, ModifiedGRUModel) else model.lstm(x)
+        lengths = pooled_lengths(lengths, model.cnn.kernel_size[0], model.maxpool.kernel_size)
+        last_output = out[torch.arange(x.size(0)), lengths - 1]
+        return model.sigmoid(model.fc(last_output)).squeeze()
+
+
+@torch.jit.script
+def padded_layer_norm_gru_scan(gi, lengths, h, weight_hh, bias_hh, ln_hh_weight, ln_hh_bias, ln_ho_weight, ln_ho_bias,
+                               eps: float, hidden_size: int):
+    """This function runs one layer of LayerNormGRUCell over a padded batch (see layer_norm_gru_scan in models.py):
+    every sequence runs all the time steps, and its hidden state stops being updated after its length.
+    Args:
+        gi: input projections of the padded inputs, shape (batch_size, sequence, 3 * hidden_size)
+    Returns:
+        outputs: hidden states of every time step, shape (batch_size, sequence, hidden_size)
+        h_n: hidden state after the last time step of every sequence, shape (batch_size, hidden_size)
+    """
+    #The normalized shape is an argument, ONNX needs it to be a constant
+    hidden_shape = [hidden_size]
+    outputs = []
+    for t in range(gi.size(1)):
+        h_norm = F.layer_norm(h, hidden_shape, ln_hh_weight, ln_hh_bias, eps)
+        gh = F.linear(h_norm, weight_hh, bias_hh)
+        i_r, i_z, i_n = gi[:, t].chunk(3, 1)
+        h_r, h_z, h_n = gh.chunk(3, 1)
+        r = torch.sigmoid(i_r + h_r)
+        z = torch.sigmoid(i_z + h_z)
+        candidate = torch.tanh(i_n + r * h_n)
+        h_next = F.layer_norm((1 - z) * candidate + z * h_norm, hidden_shape, ln_ho_weight, ln_ho_bias, eps)
+        h = torch.where((lengths > t).unsqueeze(1), h_next, h)
+        outputs.append(h)
+    return torch.stack(outputs, 1), h
+
+
+class PaddedGRUModel_LN(nn.Module):
+    """GRUModel_LN over the padded batch with masked time steps, as the ONNX exporter cannot export the loop over the
+    packed time steps (its number of sequences per time step is data dependent)."""
+    def __init__(self, model):
+        super(PaddedGRUModel_LN, self).__init__()
+        self.model = model
+
+    def forward(self, x, lengths):
+        h0 = torch.zeros(x.size(0), self.model.hidden_size)
+        for cell in self.model.cells:
+            #The cast gives the exporter the type of the outputs of the previous layer
+            gi = F.linear(cell.ln_ih(x.float()), cell.gru_cell.weight_ih, cell.gru_cell.bias_ih)
+            x, h = padded_layer_norm_gru_scan(gi, lengths, h0, cell.gru_cell.weight_hh, cell.gru_cell.bias_hh,
+                                              cell.ln_hh.weight, cell.ln_hh.bias, cell.ln_ho.weight, cell.ln_ho.bias,
+                                              cell.ln_ho.eps, self.model.hidden_size)
+        return self.model.sigmoid(self.model.fc(h)).squeeze()
+
+
+#Wrappers of the models whose packed sequences the ONNX exporter cannot export
+PADDED_MODELS = {GRUModel: PaddedGRUModel, GRUModel_LN: PaddedGRUModel_LN, ModifiedGRUModel: PaddedModifiedModel,
+                 ModifiedLSTMModel: PaddedModifiedModel}
+
+
+def export_torchscript(model, path, example):
+    """This function scripts the model (or traces it if it cannot be scripted) and saves it.
+    A traced model is specialised to the control flow of the example, the parity check tells whether it generalises."""
+    try:
+        exported = torch.jit.script(model)
+    except Exception as e:
+        print(f'The model cannot be scripted ({type(e).__name__}), tracing it instead')
+        exported = torch.jit.trace(model, example, check_trace=False)
+    exported.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(model, path, example, opset_version=11):
+    """This function exports the model to ONNX with dynamic batch and sequence axes."""
+    if type(model) in PADDED_MODELS:
+        #The exporter restores the training mode of the wrapper on the model after the export
+        model = PADDED_MODELS[type(model)](model).eval()
+    #The dynamo exporter (the default of recent torch versions) needs onnxscript and ignores dynamic_axes, we use the
+    #TorchScript-based exporter
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(model, example, path, input_names=['x', 'lengths'], output_names=['probs'],
+                      dynamic_axes={'x': {0: 'batch', 1: 'sequence'}, 'lengths': {0: 'batch'}, 'probs': {0: 'batch'}},
+                      opset_version=opset_version, **options)
+
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    #The exporter drops the inputs the model does not use
+    input_names = [i.name for i in session.get_inputs()]
+
+    def run(x, lengths):
+        feeds = {'x': x.numpy(), 'lengths': lengths.numpy()}
+        return torch.from_numpy(session.run(None, {name: feeds[name] for name in input_names})[0])
+    return run
+
+
+def check_parity(model, run, input_size, shapes=PARITY_SHAPES, atol=1e-4):
+    """This function compares the outputs of an exported model with the eager model.
+    Returns:
+        float: the maximum absolute difference over all the shapes"""
+    max_diff = 0.0
+    with torch.no_grad():
+        for batch_size, seq_len in shapes:
+            x, lengths = example_inputs(input_size, batch_size, seq_len, seed=batch_size * seq_len)
+            diff = (model(x, lengths).reshape(-1) - run(x, lengths).reshape(-1)).abs().max().item()
+            print(f'  batch {batch_size:>3}, sequence {seq_len:>4}: max abs diff {diff:.2e}')
+            max_diff = max(max_diff, diff)
+    print(f"  parity {'OK' if max_diff <= atol else 'FAILED'} (tolerance {atol:.0e})")
+    return max_diff
+
+
+def benchmark_latency(run, x, lengths, repeats=50, warmup=5):
+    """This function measures the latency of a model on a batch.
+    Returns:
+        (float, float): median and 90th percentile latency in milliseconds"""
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            run(x, lengths)
+            if i >= warmup:
+                times.append(1000 * (time.perf_counter() - start))
+    return float(np.median(times)), float(np.percentile(times, 90))
+
+
+def export_model(weights_path, output_dir='exported', formats=('torchscript', 'onnx'), batch_size=1, seq_len=300,
+                 atol=1e-4):
+    """This function exports a trained model, checks the parity of every export and benchmarks them on CPU.
+    Returns:
+        dict: path, maximum difference with the eager model, median latency and parity status ('ok') of every export,
+        or the path and the error ('error') of the failed exports and of the exports that do not match the model"""
+    torch.set_grad_enabled(False)
+    model = load_model(weights_path)
+    input_size = infer_model_config(model.state_dict())['input_size']
+    name = os.path.splitext(os.path.basename(weights_path))[0]
+    os.makedirs(output_dir, exist_ok=True)
+
+    example = example_inputs(input_size)
+    x, lengths = example_inputs(input_size, batch_size, seq_len)
+    eager_latency, eager_p90 = benchmark_latency(model, x, lengths)
+    print(f'{name} ({type(model).__name__}) eager: {eager_latency:.2f} ms (p90 {eager_p90:.2f} ms) '
+          f'for batch {batch_size}, sequence {seq_len}')
+
+    results = {}
+    for export_format in formats:
+        try:
+            if export_format == 'torchscript':
+                path = os.path.join(output_dir, f'{name}.torchscript.pt')
+                run = export_torchscript(model, path, example)
+            else:
+                path = os.path.join(output_dir, f'{name}.onnx')
+                run = export_onnx(model, path, example)
+            print(f'{export_format}: {path}')
+            max_diff = check_parity(model, run, input_size, atol=atol)
+        except Exception as e:
+            error = f'{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ""}'
+            print(f'{export_format}: export of {name} FAILED ({error})')
+            results[export_format] = {'path': path, 'ok': False, 'error': error}
+            continue
+        latency, p90 = benchmark_latency(run, x, lengths)
+        print(f'  latency {latency:.2f} ms (p90 {p90:.2f} ms), {eager_latency / latency:.2f}x the eager model')
+        results[export_format] = {'path': path, 'max_diff': max_diff, 'latency_ms': latency, 'ok': max_diff <= atol}
+        if max_diff > atol:
+            results[export_format]['error'] = f'max abs diff {max_diff:.2e} above the tolerance {atol:.0e}'
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights', nargs='+', help='state dicts of the models to export (e.g. ../best_models/*.pt)')
+    parser.add_argument('--output_dir', type=str, default='exported')
+    parser.add_argument('--format', nargs='+', default=['torchscript', 'onnx'], choices=['torchscript', 'onnx'])
+    parser.add_argument('--batch_size', type=int, default=1, help='batch size of the latency benchmark')
+    parser.add_argument('--seq_len', type=int, default=300, help='sequence length of the latency benchmark')
+    args = parser.parse_args()
+
+    failed = []
+    for weights_path in args.weights:
+        results = export_model(weights_path, args.output_dir, args.format, args.batch_size, args.seq_len)
+        failed += [f'{weights_path} ({export_format})' for export_format, result in results.items() if not result['ok']]
+    if failed:
+        print(f"Failed exports: {', '.join(failed)}")
+        sys.exit(1)
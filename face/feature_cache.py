@@ -0,0 +1,193 @@
+"""This file contains the functions used to cache the split features in a binary columnar format.
+The features of the splits/*.csv files are stored as Python literals, so parsing them with eval is slow
+(especially for the 1434-dim face landmarks). We convert each feature column once into a flat float32
+values array and an int64 offsets array (ragged layout) saved as .npy files, which are then memory-mapped.
+The cache is keyed by a hash of the source csv so it is rebuilt whenever the csv changes.
+The datasets built on RaggedDataset return views of the memory-mapped values, so the DataLoader worker processes
+share the pages of the cache instead of each holding a copy of the whole split."""
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+CACHE_DIR = 'splits/cache'
+
+
+class RaggedFeatures:
+    """Sequence of variable-length samples stored in a flat values array and an offsets array.
+    Sample i is values[offsets[i]:offsets[i+1]], a (num_frames, num_features) view (no copy)."""
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """Returns the number of frames of every sample."""
+        return np.diff(self.offsets)
+
+    def __getstate__(self):
+        #A memory-mapped values array is pickled as its file name (e.g. for the DataLoader workers started with
+        #spawn, the default on macOS), otherwise every worker would receive a copy of the whole array
+        state = dict(self.__dict__)
+        if isinstance(self.values, np.memmap) and self.values.filename is not None:
+            state['values'] = None
+            state['values_file'] = (self.values.filename, self.values.mode)
+        return state
+
+    def __setstate__(self, state):
+        values_file = state.pop('values_file', None)
+        self.__dict__.update(state)
+        if values_file is not None:
+            self.values = np.load(values_file[0], mmap_mode=values_file[1])
+
+
+class RaggedDataset(Dataset):
+    """Dataset of variable-length samples stored in a RaggedFeatures (one values buffer plus offsets).
+    A sample is a float32 tensor sharing the memory of the values buffer, no copy is made in __init__ or __getitem__.
+    Args:
+        X: a RaggedFeatures (e.g. from load_feature_cache), or a list of (num_frames, num_features) arrays, which are
+        converted once into a single in-memory values buffer
+        y: labels of the samples
+    """
+    def __init__(self, X, y):
+        self.X = as_ragged(X)
+        self.y = torch.from_numpy(np.asarray(y)).long()
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.X[index]), self.y[index]
+
+
+def csv_hash(csv_path, chunk_size=1 << 20):
+    """This function computes the sha1 hash of a csv file.
+    Args:
+        csv_path (str): Path to the csv file.
+        chunk_size (int): Number of bytes read at a time.
+    Returns:
+        str: Hex digest of the file content."""
+    sha1 = hashlib.sha1()
+    with open(csv_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cache_path(csv_path, cache_dir=CACHE_DIR):
+    """This function returns the cache folder of a csv file, named after the csv file and its hash."""
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, f'{name}_{csv_hash(csv_path)[:16]}')
+
+
+def parse_feature(text):
+    """This function parses a feature cell (a Python literal list) into a float32 array.
+    json is much faster than eval, we only fall back to eval for literals json cannot read (None, nan, tuples)."""
+    try:
+        feature = json.loads(text)
+    except ValueError:
+        feature = eval(text)
+    return np.asarray(feature, dtype=np.float32)
+
+
+def to_ragged(sequences):
+    """This function converts a list of (num_frames, num_features) arrays into flat values and offsets arrays."""
+    lengths = np.array([len(x) for x in sequences], dtype=np.int64)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    non_empty = [x.reshape(len(x), -1) for x in sequences if len(x) > 0]
+    num_features = non_empty[0].shape[1] if non_empty else 0
+    values = np.empty((offsets[-1], num_features), dtype=np.float32)
+    for i, x in enumerate(sequences):
+        if len(x) > 0:
+            values[offsets[i]:offsets[i + 1]] = x.reshape(len(x), -1)
+    return values, offsets
+
+
+def as_ragged(X):
+    """This function returns X if it is a RaggedFeatures, otherwise it converts its samples (lists or arrays of shape
+    (num_frames, num_features)) into an in-memory RaggedFeatures."""
+    if isinstance(X, RaggedFeatures):
+        return X
+    return RaggedFeatures(*to_ragged([np.asarray(x, dtype=np.float32) for x in X]))
+
+
+def save_array(path, array):
+    """This function saves an array as a .npy file atomically: it is written to a temporary file in the same folder and
+    renamed, so an interrupted build never leaves a truncated file, and processes building the same cache at the same
+    time (e.g. the tuning workers) each replace the file with a complete one."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def build_feature_cache(csv_path, feature_columns, label_column='ASD', cache_dir=CACHE_DIR):
+    """This function converts the feature columns of a split csv into the binary cache.
+    Args:
+        csv_path (str): Path to the split csv.
+        feature_columns (list): Names of the feature columns to convert.
+        label_column (str): Name of the label column.
+        cache_dir (str): Folder where the caches are stored.
+    Returns:
+        str: Path to the cache folder."""
+    path = cache_path(csv_path, cache_dir)
+    os.makedirs(path, exist_ok=True)
+    df = pd.read_csv(csv_path, usecols=list(feature_columns) + [label_column])
+
+    for column in feature_columns:
+        values, offsets = to_ragged([parse_feature(x) for x in df[column]])
+        save_array(os.path.join(path, f'{column}_values.npy'), values)
+        save_array(os.path.join(path, f'{column}_offsets.npy'), offsets)
+    save_array(os.path.join(path, f'{label_column}.npy'), df[label_column].to_numpy(dtype=np.int64))
+    return path
+
+
+def load_feature_cache(csv_path, feature_columns, label_column='ASD', cache_dir=CACHE_DIR):
+    """This function loads the feature columns of a split csv from the binary cache, building it if needed.
+    Args:
+        csv_path (str): Path to the split csv.
+        feature_columns (list): Names of the feature columns to load.
+        label_column (str): Name of the label column.
+        cache_dir (str): Folder where the caches are stored.
+    Returns:
+        features (dict): Maps each feature column to a memory-mapped RaggedFeatures.
+        labels (np.ndarray): Labels of the samples."""
+    path = cache_path(csv_path, cache_dir)
+    files = [f'{column}_{part}.npy' for column in feature_columns for part in ('values', 'offsets')]
+    if not all(os.path.exists(os.path.join(path, f)) for f in files + [f'{label_column}.npy']):
+        build_feature_cache(csv_path, feature_columns, label_column, cache_dir)
+
+    features = {}
+    for column in feature_columns:
+        #Copy-on-write mapping: the pages are shared between the processes like a read-only mapping, but the
+        #samples are writable, so torch.from_numpy can wrap them without a copy
+        values = np.load(os.path.join(path, f'{column}_values.npy'), mmap_mode='c')
+        offsets = np.load(os.path.join(path, f'{column}_offsets.npy'))
+        features[column] = RaggedFeatures(values, offsets)
+    labels = np.load(os.path.join(path, f'{label_column}.npy'))
+    return features, labels
+
+
+if __name__ == '__main__':
+    # Usage: python feature_cache.py splits/train.csv eye_gazing_features [other_feature_columns...]
+    print(build_feature_cache(sys.argv[1], sys.argv[2:]))
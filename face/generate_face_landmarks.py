@@ -1,4 +1,20 @@
+"""This file is used to extract the MediaPipe face landmarks of the videos.
+The videos are distributed across a pool of worker processes, each with its own FaceMesh instance, and the
+landmarks of every video are written to its output file frame by frame.
+The landmarks are saved either as json (frame index -> 478 (x, y, z) tuples) or in a binary format: a
+(frames, 478, 3) array in {name}_landmarks.npy, the index of every frame in the video in {name}_frames.npy and its
+timestamp in milliseconds in {name}_timestamps.npy. face/data_loader.py memory-maps them directly (see load_landmarks).
+With --fps, only the frames sampled at that rate are decoded and processed. --max_side downsizes the frames and
+--roi_margin runs FaceMesh on a crop around the face of the previous frame; the ms/frame of every video is reported.
+Usage: python generate_face_landmarks.py --input_dir videos --output_dir landmarks --n_workers 8 --format npy"""
+
+import os
 import json
+import time
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import cv2
 import mediapipe as mp
 import numpy as np
@@ -7,8 +23,76 @@ import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 mp_face_mesh = mp.solutions.face_mesh
 
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv')
+
+#FaceMesh instances of the worker process, created once by init_worker (and by process_video for the crops)
+face_mesh = None
+roi_face_mesh = None
+
+
+def create_face_mesh(static_image_mode=False):
+    """This function creates a FaceMesh instance. In tracking mode (static_image_mode=False), FaceMesh keeps the face
+    region of the previous image, in coordinates normalized by that image, so every instance in tracking mode must
+    only be given the frames of one video at one size."""
+    return mp_face_mesh.FaceMesh(
+        static_image_mode=static_image_mode,
+        max_num_faces=1,
+        refine_landmarks=True,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.5)
+
+
+def run_face_mesh(face_mesh, image):
+    """This function runs FaceMesh on an image.
+    Returns:
+        np.ndarray: (478, 3) landmarks normalized by the width and height of the image, or None if there is no face."""
+    image.flags.writeable = False
+    results = face_mesh.process(image)
+    if not results.multi_face_landmarks:
+        return None
+    face = results.multi_face_landmarks[-1]
+    return np.array([(landmark.x, landmark.y, landmark.z) for landmark in face.landmark])
+
+
+def face_roi(points, width, height, margin, min_size=32):
+    """This function returns the bounding box (x0, y0, x1, y1) in pixels of the face of the previous frame,
+    expanded by margin times its size on every side, or None if it is too small to be tracked."""
+    x = points[:, 0] * width
+    y = points[:, 1] * height
+    dx = (x.max() - x.min()) * margin
+    dy = (y.max() - y.min()) * margin
+    x0, y0 = max(int(x.min() - dx), 0), max(int(y.min() - dy), 0)
+    x1, y1 = min(int(np.ceil(x.max() + dx)), width), min(int(np.ceil(y.max() + dy)), height)
+    if x1 - x0 < min_size or y1 - y0 < min_size:
+        return None
+    return x0, y0, x1, y1
+
 
-def generate_face_landmarks_dataset(filepath, outputpath):
+def extract_face_landmarks(filepath, face_mesh, fps=None, max_side=None, roi_margin=None, rgb=True, stats=None,
+                           roi_face_mesh=None):
+    """This function runs FaceMesh on the frames of a video.
+    Args:
+        filepath (str): Path to the video.
+        face_mesh: MediaPipe FaceMesh instance.
+        fps (float): Frames per second to process. The frames in between are grabbed without being decoded, and the
+        kept frames are the same as the ones of stream_frames in data_processing/video_preprocessing.py (every
+        frame_interval-th frame), so the sequences are aligned with the frames pipeline. Default is None (every frame).
+        max_side (int): The frames are downsized so that their largest side is at most max_side pixels before
+        running FaceMesh. Default is None (full resolution).
+        roi_margin (float): If set, FaceMesh runs on the bounding box of the face of the previous frame expanded by
+        roi_margin times its size, and on the full frame when there was no face in the previous frame or when the
+        face is lost in the crop. The crops, whose size and offset change at every frame, are given to roi_face_mesh,
+        in static image mode, and face_mesh only sees full frames. Default is None (always the full frame).
+        rgb (bool): Convert the frames to RGB as expected by MediaPipe. False reproduces the landmarks extracted
+        from the BGR frames before this option existed. Default is True.
+        stats (dict): If given, the number of processed frames, frames with a face, faces found in the tracked crop
+        (roi_frames), faces found in the full frame (full_frame_faces) and processing time in seconds are added to it.
+        roi_face_mesh: FaceMesh instance in static image mode used on the crops when roi_margin is set. Default is
+        None (an instance is created for the video).
+    Yields:
+        (int, float, np.ndarray): Index of the frame in the video, its timestamp in milliseconds and its (478, 3)
+        landmarks, for every processed frame with a face (x and y in pixels of the original frame, truncated to
+        integers, z in the scale of the original frame width)."""
     # create a VideoCapture object
     cap = cv2.VideoCapture(filepath)
 
@@ -19,50 +103,271 @@ def generate_face_landmarks_dataset(filepath, outputpath):
 
     frame_width = int(cap.get(3))
     frame_height = int(cap.get(4))
-    landmarks_per_frame = {}
-    frame_idx = 0
+    video_fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_interval = 1 if fps is None else max(round(int(video_fps) / fps), 1)
+    frame_index = -1
+
+    #Size of the frames given to FaceMesh
+    scale = 1.0
+    if max_side is not None and max(frame_width, frame_height) > max_side:
+        scale = max_side / max(frame_width, frame_height)
+    width, height = max(int(frame_width * scale), 1), max(int(frame_height * scale), 1)
 
-    with mp_face_mesh.FaceMesh(
-            max_num_faces=1,
-            refine_landmarks=True,
-            min_detection_confidence=0.5,
-            min_tracking_confidence=0.5) as face_mesh:
+    if stats is None:
+        stats = {}
+    for key in ['processed_frames', 'face_frames', 'roi_frames', 'full_frame_faces', 'seconds']:
+        stats.setdefault(key, 0)
+    roi = None
+    own_roi_face_mesh = roi_margin is not None and roi_face_mesh is None
+    if own_roi_face_mesh:
+        roi_face_mesh = create_face_mesh(static_image_mode=True)
 
+    try:
         while cap.isOpened():
-            # read the next frame from the video file
-            success, image = cap.read()
+            # grab the next frame from the video file, it is only decoded if we process it
+            success = cap.grab()
+            frame_index += 1
 
             if not success:
                 print("Video file finished. Total Frames: %d" % (cap.get(cv2.CAP_PROP_FRAME_COUNT)))
                 break
+            if (frame_index + 1) % frame_interval != 0:
+                continue
 
-            image.flags.writeable = False
-            results = face_mesh.process(image)
+            success, image = cap.retrieve()
+            if not success:
+                continue
+            timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
 
-            if results.multi_face_landmarks:
-                for face in results.multi_face_landmarks:
-                    landmarks_list = []
-                    for landmark in face.landmark:
-                        x = int(landmark.x * frame_width)
-                        y = int(landmark.y * frame_height)
-                        z = landmark.z
-                        landmarks_list.append((x, y, z))
+            start = time.perf_counter()
+            if scale != 1.0:
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            if rgb:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-                landmarks_per_frame[frame_idx] = landmarks_list
-                frame_idx += 1
+            #We look for the face in the crop around the previous face, the landmarks are brought back to
+            #coordinates normalized by the full frame
+            points = None
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                points = run_face_mesh(roi_face_mesh, image[y0:y1, x0:x1])
+                if points is not None:
+                    points[:, 0] = (x0 + points[:, 0] * (x1 - x0)) / width
+                    points[:, 1] = (y0 + points[:, 1] * (y1 - y0)) / height
+                    points[:, 2] = points[:, 2] * (x1 - x0) / width
+                    stats['roi_frames'] += 1
+            #We fall back to the full frame when the face is not tracked
+            if points is None:
+                points = run_face_mesh(face_mesh, image)
+                if points is not None:
+                    stats['full_frame_faces'] += 1
 
-            key = cv2.waitKey(25)
-            if key == ord('q'):
-                break
+            roi = None
+            if points is not None and roi_margin is not None:
+                roi = face_roi(points, width, height, roi_margin)
+            stats['seconds'] += time.perf_counter() - start
+            stats['processed_frames'] += 1
 
+            if points is not None:
+                stats['face_frames'] += 1
+                points[:, 0] = np.trunc(points[:, 0] * frame_width)
+                points[:, 1] = np.trunc(points[:, 1] * frame_height)
+                yield frame_index, timestamp, points
+    finally:
         cap.release()
+        if own_roi_face_mesh:
+            roi_face_mesh.close()
 
-    print(outputpath)
+
+def write_json(landmarks_iterator, outputpath):
+    """This function writes the landmarks to a json file mapping the index of every frame with a face
+    (counting only the frames with a face) to its (x, y, z) tuples, frame by frame."""
+    frame_idx = 0
     with open(outputpath, "w") as outfile:
-        json.dump(landmarks_per_frame, outfile)
+        outfile.write('{')
+        for _, _, landmarks in landmarks_iterator:
+            if frame_idx > 0:
+                outfile.write(', ')
+            landmarks_list = [(int(x), int(y), z) for x, y, z in landmarks.tolist()]
+            outfile.write(f'"{frame_idx}": {json.dumps(landmarks_list)}')
+            frame_idx += 1
+        outfile.write('}')
+    return frame_idx
+
+
+def write_npy(landmarks_iterator, landmarks_path, frames_path, timestamps_path, dtype='float32'):
+    """This function writes the landmarks to a (frames, 478, 3) array, the frame indices to an int64 array
+    and the timestamps (milliseconds) to a float64 array.
+    The landmarks of every frame are appended to a raw file as soon as they are extracted, and copied after the .npy
+    header once the number of frames is known, so only the frame indices and timestamps are kept in memory."""
+    frame_indices = []
+    timestamps = []
+    raw_path = landmarks_path + '.raw'
+    try:
+        with open(raw_path, 'wb') as raw:
+            for frame_index, timestamp, landmarks in landmarks_iterator:
+                frame_indices.append(frame_index)
+                timestamps.append(timestamp)
+                raw.write(np.ascontiguousarray(landmarks, dtype=dtype).tobytes())
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False,
+                  'shape': (len(frame_indices), 478, 3)}
+        with open(landmarks_path, 'wb') as f, open(raw_path, 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    with open(frames_path, 'wb') as f:
+        np.save(f, np.array(frame_indices, dtype=np.int64))
+    with open(timestamps_path, 'wb') as f:
+        np.save(f, np.array(timestamps, dtype=np.float64))
+    return len(frame_indices)
+
+
+def output_paths(outputpath, output_format):
+    """This function returns the files written for an output path: the json file, or the landmarks, frames and
+    timestamps .npy files of the binary format (outputpath is then the path without the suffixes)."""
+    if output_format == 'json':
+        return [outputpath]
+    return [outputpath + '_landmarks.npy', outputpath + '_frames.npy', outputpath + '_timestamps.npy']
+
+
+def generate_face_landmarks_dataset(filepath, outputpath, face_mesh=None, output_format='json', dtype='float32',
+                                    **extract_options):
+    """This function extracts the face landmarks of a video and writes them to the disk.
+    The landmarks are written frame by frame, those of the whole video are never held in memory.
+    Args:
+        filepath (str): Path to the video.
+        outputpath (str): Path to the json file, or path without the suffixes for the binary format.
+        face_mesh: FaceMesh instance to reuse. Default is None (a new instance is created).
+        output_format (str): 'json' or 'npy'.
+        dtype (str): 'float32' or 'float16', type of the landmarks in the binary format.
+        extract_options: fps, max_side, roi_margin, rgb, stats and roi_face_mesh options of extract_face_landmarks.
+    Returns:
+        int: Number of frames with a face."""
+    if face_mesh is None:
+        with create_face_mesh() as face_mesh:
+            return generate_face_landmarks_dataset(filepath, outputpath, face_mesh, output_format, dtype,
+                                                   **extract_options)
+
+    #We write to temporary files so an interrupted extraction does not leave incomplete outputs
+    paths = output_paths(outputpath, output_format)
+    landmarks_iterator = extract_face_landmarks(filepath, face_mesh, **extract_options)
+    if output_format == 'json':
+        frames = write_json(landmarks_iterator, paths[0] + '.part')
+    else:
+        frames = write_npy(landmarks_iterator, *[path + '.part' for path in paths], dtype)
+    for path in paths:
+        os.replace(path + '.part', path)
+    print(outputpath)
+    return frames
+
+
+def init_worker():
+    """This function creates the FaceMesh instance of a worker process."""
+    global face_mesh
+    face_mesh = create_face_mesh()
+
+
+def process_video(filepath, outputpath, output_format='json', dtype='float32', extract_options=None):
+    """This function extracts the landmarks of a video in a worker process.
+    Returns:
+        dict: Status of the video (number of frames with a face, time taken, milliseconds of processing per frame,
+        frames found in the tracked crop and error if any)."""
+    global roi_face_mesh
+    start = time.perf_counter()
+    #We reset the tracking state so the previous video does not influence the first frames of this one
+    if hasattr(face_mesh, 'reset'):
+        face_mesh.reset()
+    extract_options = dict(extract_options or {})
+    if extract_options.get('roi_margin') is not None:
+        #The crops get their own instance in static image mode, created once per worker
+        if roi_face_mesh is None:
+            roi_face_mesh = create_face_mesh(static_image_mode=True)
+        extract_options['roi_face_mesh'] = roi_face_mesh
+    stats = {}
+    try:
+        frames = generate_face_landmarks_dataset(filepath, outputpath, face_mesh, output_format, dtype, stats=stats,
+                                                 **extract_options)
+    except Exception as e:
+        return {'video': filepath, 'status': 'failed', 'error': repr(e), 'frames': 0,
+                'seconds': time.perf_counter() - start}
+    processed_frames = max(stats['processed_frames'], 1)
+    return {'video': filepath, 'status': 'done', 'frames': frames, 'seconds': time.perf_counter() - start,
+            'processed_frames': stats['processed_frames'],
+            'ms_per_frame': 1000 * stats['seconds'] / processed_frames,
+            'roi_proportion': stats['roi_frames'] / processed_frames}
+
+
+def output_path(filepath, output_dir, output_format='json'):
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(output_dir, name + '.json' if output_format == 'json' else name)
+
+
+def generate_all_face_landmarks(filepaths, output_dir, n_workers=None, overwrite=False, output_format='json',
+                                dtype='float32', **extract_options):
+    """This function extracts the face landmarks of many videos with a pool of processes.
+    Args:
+        filepaths (list): Paths to the videos.
+        output_dir (str): Folder where the landmarks of every video are written.
+        n_workers (int): Number of processes. Default is the number of CPUs.
+        overwrite (bool): Extract again the videos whose output already exists.
+        output_format (str): 'json' or 'npy'.
+        dtype (str): 'float32' or 'float16', type of the landmarks in the binary format.
+        extract_options: fps, max_side, roi_margin and rgb options of extract_face_landmarks.
+    Returns:
+        list: Status of every video."""
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(filepath, output_path(filepath, output_dir, output_format)) for filepath in filepaths]
+    if not overwrite:
+        jobs = [(filepath, outputpath) for filepath, outputpath in jobs
+                if not all(os.path.exists(path) for path in output_paths(outputpath, output_format))]
+    print(f'{len(filepaths) - len(jobs)} videos already extracted, {len(jobs)} videos to process')
+
+    statuses = []
+    frames = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker) as executor:
+        futures = [executor.submit(process_video, filepath, outputpath, output_format, dtype, extract_options)
+                   for filepath, outputpath in jobs]
+        for future in as_completed(futures):
+            status = future.result()
+            statuses.append(status)
+            frames += status['frames']
+            elapsed = time.perf_counter() - start
+            if status['status'] == 'done':
+                print(f"{status['video']} done ({status['frames']}/{status['processed_frames']} frames with a face in "
+                      f"{status['seconds']:.1f}s, {status['ms_per_frame']:.1f} ms/frame, "
+                      f"{100 * status['roi_proportion']:.0f}% tracked) - "
+                      f"{len(statuses)}/{len(jobs)} videos, {frames / elapsed:.1f} frames/s overall")
+            else:
+                print(f"{status['video']} failed ({status['error']}) - {len(statuses)}/{len(jobs)} videos")
+    return statuses
 
 
 if __name__ == "__main__":
-    filepath = 'GuessWhatTest.mp4'
-    outputpath = 'GuessWhatTest.json'
-    generate_face_landmarks_dataset(filepath, outputpath)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('videos', nargs='*', help='Videos to process')
+    parser.add_argument('--input_dir', type=str, default=None, help='Folder of the videos to process')
+    parser.add_argument('--output_dir', type=str, default='landmarks')
+    parser.add_argument('--n_workers', type=int, default=None)
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--format', type=str, default='json', choices=['json', 'npy'])
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--fps', type=float, default=None,
+                        help='Frames per second to process, e.g. 10 like the frames pipeline. Default is every frame')
+    parser.add_argument('--max_side', type=int, default=None, help='Downsize the frames to this largest side')
+    parser.add_argument('--roi_margin', type=float, default=None,
+                        help='Run FaceMesh on the previous face bounding box expanded by this margin (e.g. 0.25)')
+    parser.add_argument('--bgr', action='store_true', help='Give the BGR frames to FaceMesh like the first extractions')
+    args = parser.parse_args()
+
+    filepaths = list(args.videos)
+    if args.input_dir is not None:
+        filepaths += sorted(os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir)
+                            if f.lower().endswith(VIDEO_EXTENSIONS))
+    if not filepaths:
+        filepaths = ['GuessWhatTest.mp4']
+    generate_all_face_landmarks(filepaths, args.output_dir, args.n_workers, args.overwrite, args.format, args.dtype,
+                                fps=args.fps, max_side=args.max_side, roi_margin=args.roi_margin, rgb=not args.bgr)
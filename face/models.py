@@ -10,6 +10,8 @@ import argparse
 import torch
 import torch.nn as nn
 import torch.nn.utils.rnn as rnn_utils
+import torch.nn.functional as F
+from typing import List
 from transformers import BertModel, BertTokenizer
 
 class LSTMModel(nn.Module):
@@ -92,7 +94,48 @@ class GRUModel(nn.Module):
         out = self.sigmoid(out)
 
         return out.squeeze()
-    
+
+
+@torch.jit.script
+def layer_norm_gru_scan(gi, batch_sizes, h, weight_hh, bias_hh, ln_hh_weight, ln_hh_bias, ln_ho_weight, ln_ho_bias,
+                        eps: float):
+    """This function runs one layer of LayerNormGRUCell over packed sequences, given the input projections of all
+    their time steps. Only the hidden projection is computed at each time step, and only for the sequences that have
+    not ended (the sequences are sorted by decreasing length, as in a PackedSequence), so the padding costs nothing.
+    Args:
+        gi: input projections W_ih ln_ih(x) + b_ih of the packed inputs, shape (sum of the lengths, 3 * hidden_size)
+        batch_sizes: number of sequences at each time step
+        h: initial hidden state, shape (batch_size, hidden_size)
+    Returns:
+        outputs: packed hidden states of every time step, shape (sum of the lengths, hidden_size)
+        h_n: hidden state after the last time step of every sequence, shape (batch_size, hidden_size)
+    """
+    hidden_shape = [h.size(1)]
+    sizes: List[int] = batch_sizes.tolist()
+    # Splitting once (instead of slicing at every step) keeps the backward pass linear in the sequence length
+    gi_steps = gi.split(sizes)
+    outputs = []
+    finished = []
+    for t in range(len(sizes)):
+        n = sizes[t]
+        if n < h.size(0):
+            # The last sequences have ended, we keep their final hidden state aside
+            finished.append(h[n:])
+            h = h[:n]
+        h_norm = F.layer_norm(h, hidden_shape, ln_hh_weight, ln_hh_bias, eps)
+        gh = F.linear(h_norm, weight_hh, bias_hh)
+        i_r, i_z, i_n = gi_steps[t].chunk(3, 1)
+        h_r, h_z, h_n = gh.chunk(3, 1)
+        r = torch.sigmoid(i_r + h_r)
+        z = torch.sigmoid(i_z + h_z)
+        candidate = torch.tanh(i_n + r * h_n)
+        h = F.layer_norm((1 - z) * candidate + z * h_norm, hidden_shape, ln_ho_weight, ln_ho_bias, eps)
+        outputs.append(h)
+    finished.append(h)
+    finished.reverse()
+    return torch.cat(outputs), torch.cat(finished)
+
+
 class GRUModel_LN(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers):
         super(GRUModel_LN, self).__init__()
@@ -106,29 +149,48 @@ class GRUModel_LN(nn.Module):
         self.fc = nn.Linear(hidden_size, 2)
         self.sigmoid = nn.Sigmoid()
 
-    def forward(self, x, lengths):
-        batch_size, seq_len, _ = x.size()
-        h = torch.zeros(batch_size, self.hidden_size).to(x.device)
-        out = []
+    def recurrence(self, data, batch_sizes, h0):
+        """Runs the layers one after the other over packed sequences, each layer with its own hidden state.
+        Args:
+            data: packed inputs, shape (sum of the lengths, input_size)
+            batch_sizes: number of sequences at each time step (on the CPU)
+            h0: initial hidden state of every layer, shape (num_layers, batch_size, hidden_size)
+        Returns:
+            torch.Tensor: hidden state of every layer after the last time step, shape (num_layers, batch, hidden_size)
+        """
+        h_n = []
+        for i, cell in enumerate(self.cells):
+            # The input projections of all the time steps are computed at once
+            gi = F.linear(cell.ln_ih(data), cell.gru_cell.weight_ih, cell.gru_cell.bias_ih)
+            data, h = layer_norm_gru_scan(gi, batch_sizes, h0[i], cell.gru_cell.weight_hh, cell.gru_cell.bias_hh,
+                                          cell.ln_hh.weight, cell.ln_hh.bias, cell.ln_ho.weight, cell.ln_ho.bias,
+                                          cell.ln_ho.eps)
+            h_n.append(h)
+        return torch.stack(h_n)
 
-        # Unpack the sequence and apply the GRU cells
-        for t in range(seq_len):
-            x_t = x[:, t, :]
-            for i in range(self.num_layers):
-                h = self.cells[i](x_t, h)
-                x_t = h
-            out.append(h.unsqueeze(1))
+    def forward(self, x, lengths):
+        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
 
-        out = torch.cat(out, dim=1)
+        # Pack the padded sequences
+        packed_input = rnn_utils.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        h_n = self.recurrence(packed_input.data, packed_input.batch_sizes, h0)
 
-        # Take the output of the last time step
-        last_output = out[torch.arange(len(out)), lengths - 1]
+        # Take the output of the last time step, in the original order of the batch
+        last_output = h_n[-1][packed_input.unsorted_indices]
 
         out = self.fc(last_output)
         out = self.sigmoid(out)
 
         return out.squeeze()
 
+def pooled_lengths(lengths, kernel_size: int, pool_size: int):
+    """This function computes the lengths of the sequences after the Conv1d (without padding) and the MaxPool1d of
+    the Modified models: the number of pooled steps computed from real frames only (at least 1)."""
+    lengths = torch.div(torch.as_tensor(lengths) - kernel_size + 1, pool_size, rounding_mode='floor')
+    # torch.where rather than torch.clamp, which ONNX does not support on integers
+    return torch.where(lengths > 0, lengths, torch.ones_like(lengths))
+
+
 class ModifiedLSTMModel(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers, cnn_out_channels=32, cnn_kernel_size=3, pool_kernel_size=2, dropout_prob=0.2):
         super(ModifiedLSTMModel, self).__init__()
@@ -155,10 +217,14 @@ class ModifiedLSTMModel(nn.Module):
         x = self.maxpool(x)
         x = x.permute(0, 2, 1)
 
+        # Pack the pooled sequences, so the LSTM stops at the last step computed from real frames
+        lengths = pooled_lengths(lengths, self.cnn.kernel_size[0], self.maxpool.kernel_size)
+        packed_input = rnn_utils.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+
         # LSTM layer
         h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
         c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        output, (h_n, c_n) = self.lstm(x, (h0, c0))
+        output, (h_n, c_n) = self.lstm(packed_input, (h0, c0))
         x = self.dropout_lstm(h_n[-1])
 
         # Fully connected layer
@@ -185,6 +251,7 @@ class ModifiedGRUModel(nn.Module):
         #self.fc = nn.Linear(hidden_size, 1)
         self.fc = nn.Linear(hidden_size, 2)  # Change this line
         self.sigmoid = nn.Sigmoid()
+        self.relu = nn.ReLU()
 
     def forward(self, x, lengths):
         x = x.permute(0, 2, 1)  # Reshape input for Conv1d
@@ -194,9 +261,13 @@ class ModifiedGRUModel(nn.Module):
         x = self.maxpool(x)
         x = x.permute(0, 2, 1)
 
+        # Pack the pooled sequences, so the GRU stops at the last step computed from real frames
+        lengths = pooled_lengths(lengths, self.cnn.kernel_size[0], self.maxpool.kernel_size)
+        packed_input = rnn_utils.pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+
         # GRU layer
         h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-        output, h_n = self.gru(x, h0)
+        output, h_n = self.gru(packed_input, h0)
         x = self.dropout_gru(h_n[-1])
 
         # Fully connected layer
@@ -204,3 +275,64 @@ class ModifiedGRUModel(nn.Module):
         x = self.sigmoid(x)
 
         return x.squeeze()
+
+
+MODEL_CLASSES = {'lstm': LSTMModel, 'gru': GRUModel, 'modifiedlstm': ModifiedLSTMModel,
+                 'modifiedgru': ModifiedGRUModel, 'gru_ln': GRUModel_LN}
+
+
+def infer_model_config(state_dict):
+    """This function infers the type and the sizes of a model from its weights (the checkpoints only contain the
+    state dict).
+    Returns:
+        dict: 'model_type' (a key of MODEL_CLASSES) and the arguments of the model class."""
+    if 'cells.0.gru_cell.weight_ih' in state_dict:
+        num_layers = len({key.split('.')[1] for key in state_dict if key.startswith('cells.')})
+        return {'model_type': 'gru_ln',
+                'input_size': state_dict['cells.0.gru_cell.weight_ih'].shape[1],
+                'hidden_size': state_dict['cells.0.gru_cell.weight_hh'].shape[1],
+                'num_layers': num_layers}
+
+    rnn = 'lstm' if 'lstm.weight_ih_l0' in state_dict else 'gru'
+    config = {'model_type': rnn,
+              'input_size': state_dict[f'{rnn}.weight_ih_l0'].shape[1],
+              'hidden_size': state_dict[f'{rnn}.weight_hh_l0'].shape[1],
+              'num_layers': sum(1 for key in state_dict if key.startswith(f'{rnn}.weight_ih_l'))}
+    if 'cnn.weight' in state_dict:
+        cnn_out_channels, input_size, cnn_kernel_size = state_dict['cnn.weight'].shape
+        config.update({'model_type': 'modified' + rnn, 'input_size': input_size,
+                       'cnn_out_channels': cnn_out_channels, 'cnn_kernel_size': cnn_kernel_size})
+    return config
+
+
+def quantize_model(model):
+    """This function applies dynamic int8 quantization to the recurrent and linear layers of a model, for CPU
+    inference: their weights are stored in int8 and the activations are quantized on the fly. The Conv1d front end of
+    the Modified models stays in float32 (dynamic quantization does not support convolutions), and so do the cells of
+    GRUModel_LN, whose recurrence uses their weights directly (see layer_norm_gru_scan)."""
+    return torch.quantization.quantize_dynamic(model, {nn.GRU, nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(path, device='cpu', quantize=False):
+    """This function loads a trained model (e.g. from best_models/) in evaluation mode.
+    Args:
+        path (str): path to the state dict (or to a whole pickled model)
+        device: the device to load the model on. Default is 'cpu'.
+        quantize (bool): whether to apply dynamic int8 quantization (see quantize_model), CPU only. Default is False.
+    Returns:
+        nn.Module: the model
+    """
+    if quantize and torch.device(device).type != 'cpu':
+        raise ValueError('Quantized models can only run on the CPU')
+    state = torch.load(path, map_location='cpu')
+    if isinstance(state, nn.Module):
+        model = state
+    else:
+        config = infer_model_config(state)
+        model_class = MODEL_CLASSES[config.pop('model_type')]
+        model = model_class(**config)
+        model.load_state_dict(state)
+    model = model.to(device).eval()
+    if quantize:
+        model = quantize_model(model)
+    return model
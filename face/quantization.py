@@ -0,0 +1,69 @@
+"""This file compares a trained model with its dynamic int8 quantized version (see quantize_model in models.py):
+accuracy and AUC on the validation split, agreement of the predictions, size of the weights and CPU latency.
+Usage: python quantization.py ../best_models/model_face.pt [other weights ...]"""
+
+import io
+import argparse
+import torch
+from models import load_model, infer_model_config
+from data_loader import get_loader
+from evaluation import Evaluator
+from export import example_inputs, benchmark_latency
+
+
+def predict(model, loader):
+    """This function computes the metrics and the predictions of a model on a split (on the CPU)."""
+    evaluator = Evaluator(len(loader.dataset))
+    with torch.inference_mode():
+        for inputs, labels, input_lengths in loader:
+            evaluator.update(model(inputs, input_lengths), labels)
+    return evaluator.compute(), evaluator.predictions[:evaluator.count]
+
+
+def model_size_mb(model):
+    """This function returns the size in MB of the serialized weights of a model."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
+
+
+def compare_quantization(weights_path, val_loader, batch_size=1, seq_len=300):
+    """This function prints and returns the accuracy delta, size and latency of the quantized model against the
+    float32 model."""
+    float_model = load_model(weights_path)
+    quantized_model = load_model(weights_path, quantize=True)
+    input_size = infer_model_config(float_model.state_dict())['input_size']
+    x, lengths = example_inputs(input_size, batch_size, seq_len)
+
+    results = {}
+    for name, model in [('float32', float_model), ('int8', quantized_model)]:
+        metrics, predictions = predict(model, val_loader)
+        latency, p90 = benchmark_latency(model, x, lengths)
+        results[name] = {'accuracy': metrics['accuracy'], 'auc': metrics['auc'], 'predictions': predictions,
+                         'size_mb': model_size_mb(model), 'latency_ms': latency, 'latency_p90_ms': p90}
+
+    float_results, int8_results = results['float32'], results['int8']
+    agreement = (float_results['predictions'] == int8_results['predictions']).float().mean().item()
+    print(f'{weights_path} ({type(float_model).__name__})')
+    print(f"{'':>8} {'accuracy':>9} {'AUC':>7} {'size (MB)':>10} {'latency (ms)':>13} {'p90 (ms)':>9}")
+    for name, r in results.items():
+        print(f"{name:>8} {r['accuracy']:>9.4f} {r['auc']:>7.4f} {r['size_mb']:>10.3f} {r['latency_ms']:>13.2f} "
+              f"{r['latency_p90_ms']:>9.2f}")
+    print(f"Accuracy delta: {int8_results['accuracy'] - float_results['accuracy']:+.4f}, "
+          f"AUC delta: {int8_results['auc'] - float_results['auc']:+.4f}, prediction agreement: {agreement:.4f}, "
+          f"{float_results['size_mb'] / int8_results['size_mb']:.2f}x smaller, "
+          f"{float_results['latency_ms'] / int8_results['latency_ms']:.2f}x faster "
+          f"(batch {batch_size}, sequence {seq_len})")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights', nargs='+', help='state dicts of the models to compare (e.g. ../best_models/*.pt)')
+    parser.add_argument('--batch_size', type=int, default=1, help='batch size of the latency benchmark')
+    parser.add_argument('--seq_len', type=int, default=300, help='sequence length of the latency benchmark')
+    args = parser.parse_args()
+
+    _, _, val_loader = get_loader(batch_size=20, normalize=True)
+    for weights_path in args.weights:
+        compare_quantization(weights_path, val_loader, args.batch_size, args.seq_len)
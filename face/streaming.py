@@ -0,0 +1,139 @@
+"""This file contains the streaming inference API used to score live GuessWhat sessions.
+A session keeps the hidden state of the recurrent layers (and, for the Modified models, the last frames needed by the
+Conv1d and the convolution outputs waiting to be max-pooled), so every chunk of new feature frames is scored in
+O(chunk) time. After the whole video, the probability is the one the model gives on the full sequence.
+Usage: python streaming.py ../best_models/model_face.pt --chunk_size 10"""
+
+import argparse
+import numpy as np
+import torch
+from models import load_model, LSTMModel, GRUModel, GRUModel_LN, ModifiedLSTMModel, ModifiedGRUModel
+
+
+class StreamingSession:
+    """Incremental scoring of one sequence.
+    Args:
+        model: a LSTMModel, GRUModel, GRUModel_LN, ModifiedLSTMModel or ModifiedGRUModel in evaluation mode, possibly
+        quantized (see quantize_model)
+    """
+    def __init__(self, model):
+        if not isinstance(model, (LSTMModel, GRUModel, GRUModel_LN, ModifiedLSTMModel, ModifiedGRUModel)):
+            raise TypeError(f'Streaming is not supported for {type(model).__name__}')
+        self.model = model.eval()
+        #The dynamically quantized GRUModel and LSTMModel have no float parameters left, they run on the CPU
+        parameter = next(model.parameters(), None)
+        self.device = parameter.device if parameter is not None else torch.device('cpu')
+        self.modified = isinstance(model, (ModifiedLSTMModel, ModifiedGRUModel))
+        self.state = None
+        self.buffer = None
+        self.pending = None
+        self.num_frames = 0
+        self.probability = None
+
+    def update(self, frames):
+        """Adds new frames to the sequence.
+        Args:
+            frames: array of shape (chunk, features), or (features,) for a single frame
+        Returns:
+            float: probability of ASD given all the frames so far, or None if the sequence is still too short for
+            the model (the Modified models need kernel_size + pool_size - 1 frames)
+        """
+        x = torch.as_tensor(np.asarray(frames, dtype=np.float32), device=self.device)
+        if x.dim() == 1:
+            x = x.unsqueeze(0)
+        self.num_frames += len(x)
+
+        with torch.inference_mode():
+            if self.modified:
+                x = self._conv_pool(x)
+            if len(x) > 0:
+                self.probability = self._recurrent(x)[1].item()
+        return self.probability
+
+    def _conv_pool(self, x):
+        """Runs the Conv1d and the MaxPool1d of the Modified models on the new frames only."""
+        model = self.model
+        kernel_size = model.cnn.kernel_size[0]
+        pool_size = model.maxpool.kernel_size
+
+        #We prepend the last kernel_size - 1 frames of the previous chunks so the convolution windows overlapping
+        #two chunks are computed once
+        if self.buffer is not None:
+            x = torch.cat([self.buffer, x])
+        self.buffer = x[max(len(x) - (kernel_size - 1), 0):]
+        if len(x) >= kernel_size:
+            conv = model.relu(model.cnn(x.t().unsqueeze(0)))[0].t()
+        else:
+            conv = x.new_zeros(0, model.cnn.out_channels)
+
+        #We only pool complete windows, the remaining convolution outputs wait for the next chunk
+        if self.pending is not None:
+            conv = torch.cat([self.pending, conv])
+        num_pooled = len(conv) // pool_size
+        self.pending = conv[num_pooled * pool_size:]
+        return conv[:num_pooled * pool_size].reshape(num_pooled, pool_size, conv.size(1)).max(1)[0]
+
+    def _recurrent(self, x):
+        """Runs the recurrent layers from the saved state and returns the output probabilities of the model."""
+        model = self.model
+        if isinstance(model, GRUModel_LN):
+            #A single sequence is a packed sequence with one sequence at every time step
+            h0 = self.state if self.state is not None else x.new_zeros(model.num_layers, 1, model.hidden_size)
+            self.state = model.recurrence(x, torch.ones(len(x), dtype=torch.long), h0)
+            return model.sigmoid(model.fc(self.state[-1]))[0]
+
+        rnn = model.lstm if isinstance(model, (LSTMModel, ModifiedLSTMModel)) else model.gru
+        _, self.state = rnn(x.unsqueeze(0), self.state)
+        h_n = self.state[0] if isinstance(self.state, tuple) else self.state
+        if isinstance(model, LSTMModel):
+            out = model.dropout(model.relu(model.fc(h_n.view(-1, model.hidden_size * model.num_layers))))
+        elif isinstance(model, ModifiedLSTMModel):
+            out = model.fc(model.dropout_lstm(h_n[-1]))
+        elif isinstance(model, ModifiedGRUModel):
+            out = model.fc(model.dropout_gru(h_n[-1]))
+        else:
+            out = model.fc(h_n[-1])
+        return model.sigmoid(out)[0]
+
+
+class StreamingScorer:
+    """Keeps one StreamingSession per live session, all sharing the same model.
+    Args:
+        model: the model used to score the sessions
+    """
+    def __init__(self, model):
+        self.model = model.eval()
+        self.sessions = {}
+
+    def update(self, session_id, frames):
+        """Adds new frames to a session (created at its first chunk) and returns its updated probability of ASD."""
+        if session_id not in self.sessions:
+            self.sessions[session_id] = StreamingSession(self.model)
+        return self.sessions[session_id].update(frames)
+
+    def end_session(self, session_id):
+        """Closes a session and returns its final probability of ASD."""
+        return self.sessions.pop(session_id).probability
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights', type=str, help='state dict of the model (e.g. ../best_models/model_face.pt)')
+    parser.add_argument('--seq_len', type=int, default=300, help='length of the random test sequence')
+    parser.add_argument('--chunk_size', type=int, default=10, help='number of frames per chunk')
+    parser.add_argument('--quantize', action='store_true', help='apply dynamic int8 quantization to the model')
+    args = parser.parse_args()
+
+    #We check that streaming a random sequence chunk by chunk gives the probability of the full sequence
+    model = load_model(args.weights, quantize=args.quantize)
+    input_size = model.cnn.in_channels if isinstance(model, (ModifiedLSTMModel, ModifiedGRUModel)) else \
+        (model.cells[0].input_size if isinstance(model, GRUModel_LN) else
+         (model.lstm if isinstance(model, LSTMModel) else model.gru).input_size)
+    x = torch.randn(args.seq_len, input_size)
+    scorer = StreamingScorer(model)
+    for start in range(0, args.seq_len, args.chunk_size):
+        probability = scorer.update('session', x[start:start + args.chunk_size])
+    with torch.inference_mode():
+        full_probability = model(x.unsqueeze(0), torch.tensor([args.seq_len])).reshape(-1)[1].item()
+    print(f'Streaming: {probability:.6f}, full sequence: {full_probability:.6f}, '
+          f'difference: {abs(probability - full_probability):.2e}')
@@ -8,11 +8,18 @@ from tqdm import tqdm
 from data_loader import *
 import argparse
 from models import * 
+from evaluation import Evaluator, print_metrics
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
 import optuna
+import os
+import multiprocessing
+from optuna.storages import JournalStorage, JournalFileStorage
+from optuna.trial import TrialState
 
-def train(train_loader, val_loader, model, criterion, optimizer, num_epochs=10):
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def train(train_loader, val_loader, model, criterion, optimizer, num_epochs=10, checkpoint_path='model.pt', trial=None, plot=True):
     """This function trains the model for a specified number of epochs.
 
     Args:
@@ -20,6 +27,10 @@ def train(train_loader, val_loader, model, criterion, optimizer, num_epochs=10):
         model: the model to be trained
         optimizer: the optimizer
         num_epochs: the number of epochs to train the model
+        checkpoint_path: where the model with the best validation loss is saved. Default is 'model.pt'.
+        trial: the Optuna trial being run, if any. The validation loss is reported to it after every epoch
+        and the training stops early (optuna.TrialPruned) if the pruner decides the trial is not promising.
+        plot: whether to plot the training and validation losses. Default is True.
     """
     # Initialize list to store losses for each epoch
     train_losses = []
@@ -74,12 +85,21 @@ def train(train_loader, val_loader, model, criterion, optimizer, num_epochs=10):
         # save model if validation loss has decreased
         if val_epoch_loss <= best_val_loss:
             print(f'Validation loss decreased ({best_val_loss:.6f} --> {val_epoch_loss:.6f}).  Saving model ...')
-            torch.save(model.state_dict(), 'model.pt')
+            torch.save(model.state_dict(), checkpoint_path)
             best_val_loss = val_epoch_loss
             best_val_acc = val_epoch_acc
 
+        # Stop unpromising trials early
+        if trial is not None:
+            trial.report(val_epoch_loss, epoch)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+
     print(f'Best validation loss: {best_val_loss:.6f}, Best validation accuracy: {best_val_acc:.6f}')
 
+    if not plot:
+        return
+
     # After training is complete, plot the losses and save the figure locally
     plt.plot(range(1, num_epochs + 1), train_losses, label='Training Loss')
     plt.plot(range(1, num_epochs + 1), val_losses, label='Validation Loss')
@@ -97,49 +117,30 @@ def evaluate(model, test_loader, criterion, print_info=False):
         model: the model to be evaluated
         test_loader: the data loader for the test data
         criterion: the criterion to compute the loss
-        print_info: whether to print the loss, the accuracy and the misclassifications per class. Default is False.
+        print_info: whether to print the loss, the accuracy, the AUC, the confusion matrix and the misclassifications per class. Default is False.
     """
     model.eval()
-    test_correct = 0
-    test_total = 0
-    misclassifications = {0: 0, 1: 0}  # Initialize misclassifications per class
-    test_loss = 0
+    evaluator = Evaluator(len(test_loader.dataset), device=device)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for inputs, labels, input_lengths in test_loader:
             inputs = inputs.to(device)
             labels = labels.to(device)
 
             test_outputs = model(inputs, input_lengths)
-            labels = labels.long()  # Convert labels to long
-
-            test_predicted = torch.max(test_outputs, 1)[1]  # get the index of the max log-probability
-            test_correct += (test_predicted == labels).sum().item()
-            test_total += labels.size(0)
-
-            # Track misclassifications per class
-            for i in range(labels.size(0)):
-                if test_predicted[i] != labels[i]:
-                    misclassifications[int(labels[i].item())] += 1
-
-            #Compute the loss and accumulate it
-            loss = criterion(test_outputs, labels)
-            test_loss += loss.item() * inputs.size(0)
+            evaluator.update(test_outputs, labels, criterion(test_outputs, labels))
 
-    #Calculate the average test loss over all batches
-    test_loss = test_loss / len(test_loader.dataset)
-    test_accuracy = test_correct / test_total
+    # Compute all the metrics at once
+    metrics = evaluator.compute()
 
     #Print the loss, the accuracy and the misclassifications per class
     if print_info:
-        print(f'Test Loss: {test_loss:.4f}, Test Accuracy: {test_accuracy:.4f}')
-        for class_label, misclassified_count in misclassifications.items():
-            print(f'Misclassifications for class {class_label}: {misclassified_count}')
+        print_metrics(metrics)
     
-    return test_loss, test_accuracy
+    return metrics['loss'], metrics['accuracy']
 
 
-def objective(trial, train_loader, val_loader, input_size, device):
+def objective(trial, train_loader, val_loader, input_size, device, criterion, num_epochs=25, checkpoint_dir='checkpoints'):
     """Function to be optimized by Optuna.
     Args:
         trial: the current trial
@@ -147,6 +148,9 @@ def objective(trial, train_loader, val_loader, input_size, device):
         val_loader: the data loader for the validation data
         input_size: the size of the input
         device: the device to be used for training
+        criterion: the criterion to compute the loss
+        num_epochs: the maximum number of epochs of the trial
+        checkpoint_dir: the folder where each trial saves its best model
         """
     # Hyperparameters to be tuned
     batch_size = trial.suggest_categorical('batch_size', [8, 15, 20, 31])
@@ -171,17 +175,50 @@ def objective(trial, train_loader, val_loader, input_size, device):
     # Create the optimizer
     optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=weight_decay)
 
+    # Each trial has its own checkpoint so that trials can run in parallel
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint_path = os.path.join(checkpoint_dir, f'trial_{trial.number}.pt')
+    trial.set_user_attr('checkpoint_path', checkpoint_path)
+
     # Train and evaluate the model, then return the validation loss
-    train(train_loader, val_loader, model, criterion, optimizer, num_epochs=num_epochs)
+    train(train_loader, val_loader, model, criterion, optimizer, num_epochs=num_epochs,
+          checkpoint_path=checkpoint_path, trial=trial, plot=False)
 
     # Load the best model
-    model.load_state_dict(torch.load('model.pt'))
+    model.load_state_dict(torch.load(checkpoint_path))
 
     val_loss, val_acc = evaluate(model, val_loader, criterion)
 
     return val_loss
 
-def hyperparameter_tuning(train_loader, val_loader, test_loader, input_size, device, num_trials=50):
+def get_pruner(pruner):
+    """Returns the Optuna pruner named pruner ('median', 'asha' or 'none')."""
+    if pruner == 'median':
+        return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=5)
+    elif pruner == 'asha':
+        return optuna.pruners.SuccessiveHalvingPruner()
+    return optuna.pruners.NopPruner()
+
+def get_storage(storage):
+    """Returns the Optuna storage of the study: a journal file if storage ends with '.log',
+    otherwise storage is used as a database URL (e.g. 'sqlite:///optuna.db')."""
+    if storage is not None and storage.endswith('.log'):
+        return JournalStorage(JournalFileStorage(storage))
+    return storage
+
+def tuning_worker(study_name, storage, pruner, num_trials, input_size, batch_size, bucket_size=None):
+    """Runs trials of a shared study in a worker process until the study has num_trials finished trials.
+    The worker loads its own data since the data loaders cannot be shared between processes."""
+    train_loader, test_loader, val_loader = get_loader(batch_size=batch_size, normalize=True, bucket_size=bucket_size)
+    criterion = nn.CrossEntropyLoss(weight=class_weights(train_loader).to(device))
+
+    study = optuna.load_study(study_name=study_name, storage=get_storage(storage), pruner=get_pruner(pruner))
+    stop = optuna.study.MaxTrialsCallback(num_trials, states=(TrialState.COMPLETE, TrialState.PRUNED))
+    study.optimize(lambda trial: objective(trial, train_loader, val_loader, input_size, device, criterion),
+                   callbacks=[stop])
+
+def hyperparameter_tuning(train_loader, val_loader, test_loader, input_size, device, num_trials=50, criterion=None,
+                          n_workers=1, storage='optuna_journal.log', pruner='median', study_name=None, batch_size=20, bucket_size=None):
     """Function to tune the hyperparameters of the model using Optuna.
     Args:
         num_trials (int): Number of hyperparameter tuning trials to run.
@@ -189,9 +226,29 @@ def hyperparameter_tuning(train_loader, val_loader, test_loader, input_size, dev
         val_loader: the data loader for the validation data
         input_size: the size of the input
         device: the device to be used for training
+        criterion: the criterion to compute the loss
+        n_workers (int): number of worker processes running trials in parallel. Default is 1 (in this process).
+        storage (str): shared storage of the study, a journal file ('.log') or a database URL. Only used if n_workers > 1.
+        pruner (str): pruner stopping unpromising trials early ('median', 'asha' or 'none'). Default is 'median'.
+        study_name (str): name of the study in the storage. Default is a new name for every call.
+        batch_size, bucket_size: used by the worker processes to build their data loaders
     """
-    study = optuna.create_study(direction='minimize')
-    study.optimize(lambda trial: objective(trial, train_loader, val_loader, input_size, device), n_trials=num_trials)
+    if n_workers > 1:
+        study_name = study_name or f'tuning_{os.getpid()}'
+        study = optuna.create_study(study_name=study_name, storage=get_storage(storage), direction='minimize',
+                                    pruner=get_pruner(pruner), load_if_exists=True)
+        # We use spawn so that each worker can safely initialize CUDA
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=tuning_worker,
+                                   args=(study_name, storage, pruner, num_trials, input_size, batch_size, bucket_size))
+                   for _ in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        study = optuna.create_study(direction='minimize', pruner=get_pruner(pruner))
+        study.optimize(lambda trial: objective(trial, train_loader, val_loader, input_size, device, criterion), n_trials=num_trials)
 
     print('Best trial:')
     trial = study.best_trial
@@ -242,6 +299,11 @@ if __name__ == '__main__':
     parser.add_argument('--input_size', type=int, default=61, help='number of input features')
     parser.add_argument('--weight_decay', type=float, default=0.0001, help='weight decay')
     parser.add_argument('--tune_hyperparameters', action='store_true', help='tune hyperparameters')
+    parser.add_argument('--num_trials', type=int, default=10, help='number of hyperparameter tuning trials')
+    parser.add_argument('--n_workers', type=int, default=1, help='number of processes running tuning trials in parallel')
+    parser.add_argument('--storage', type=str, default='optuna_journal.log', help='shared Optuna storage (journal .log file or database URL) used when n_workers > 1')
+    parser.add_argument('--pruner', type=str, default='median', choices=['median', 'asha', 'none'], help='pruner stopping unpromising trials early')
+    parser.add_argument('--bucket_size', type=int, default=None, help='number of batches per length-sorted chunk (batches of similar lengths to reduce padding)')
     args = parser.parse_args()
 
     # Set the device (GPU if available, otherwise CPU)
@@ -273,7 +335,7 @@ if __name__ == '__main__':
    
     
     # Create data loaders for training and testing
-    train_loader, test_loader, val_loader = get_loader(batch_size=batch_size, normalize=True)   
+    train_loader, test_loader, val_loader = get_loader(batch_size=batch_size, normalize=True, bucket_size=args.bucket_size)
 
     # Define the loss function and optimizer
     class_weights = class_weights(train_loader)
@@ -293,4 +355,6 @@ if __name__ == '__main__':
 
     # Create the study and optimize
     if tune_hyperparameters:
-        hyperparameter_tuning(num_trials=10, train_loader=train_loader, val_loader=val_loader, test_loader=test_loader, input_size=input_size, device=device)
\ No newline at end of file
+        hyperparameter_tuning(num_trials=args.num_trials, train_loader=train_loader, val_loader=val_loader, test_loader=test_loader,
+                              input_size=input_size, device=device, criterion=criterion, n_workers=args.n_workers,
+                              storage=args.storage, pruner=args.pruner, batch_size=batch_size, bucket_size=args.bucket_size)
\ No newline at end of file